@@ -0,0 +1,74 @@
+"""
+Compare rows/sec of dbimport default path (`full_clean` and `bulk_create`)
+with `--fast` path (precompiled checks and COPY) on the configured postgres.
+Rows are inserted in rolled back transactions.
+
+    $ python benchmarks/bench_dbimport.py --items 20000 --batch 1000
+"""
+import os
+import time
+import argparse
+import datetime
+
+import django
+
+
+def build_items(count):
+    from craigslist.item import CraigsListItem
+    from craigslist.utils import MsgPackSerializer
+
+    serializer = MsgPackSerializer()
+    # items as they come from kafka
+    return [
+        serializer.loads_row(serializer.dumps(CraigsListItem(
+            url='https://sfbay.craigslist.org/pen/bik/%s.html' % (
+                5400000000 + i
+            ),
+            session_id='kidbike',
+            city_code='sfbay',
+            title='kid bike %s - $%s (palo alto)' % (i, i % 300),
+            price=(i % 300) * 100,
+            photos=[
+                'http://images.craigslist.org/%05d_kN64FieYYgT_600x450.jpg'
+                % (i + j) for j in range(i % 8)
+            ],
+            description='nice kid bike, 16 inch wheels, '
+                        'training wheels included. ' * (1 + i % 4),
+            ts_created=datetime.datetime.now(datetime.timezone.utc),
+        ))) for i in range(count)
+    ]
+
+
+def measure(insert, items, batch):
+    from django.db import transaction
+
+    start = time.time()
+    imported = 0
+    with transaction.atomic():
+        for i in range(0, len(items), batch):
+            with transaction.atomic():
+                imported += insert(items[i:i + batch])
+        transaction.set_rollback(True)
+    assert imported == len(items)
+    return imported / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=1000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dataview.settings')
+    django.setup()
+
+    from dataview.items.management.commands.dbimport import Command
+
+    items = build_items(args.items)
+    command = Command()
+
+    rps = measure(command.bulk_insert, items, args.batch)
+    print('full_clean and bulk_create: %.1f rows/s' % rps)
+
+    rps = measure(command.copy_insert, items, args.batch)
+    print('precompiled checks and COPY: %.1f rows/s' % rps)
@@ -0,0 +1,64 @@
+"""
+Redis memory per remembered url of each dedup backend, measured by
+`MEMORY USAGE` of backend keys (redis >= 4.0).
+
+    $ python benchmarks/bench_dedup.py --urls 100000 --sessions 10
+"""
+import time
+import asyncio
+import argparse
+
+import aioredis
+
+from craigslist.utils import get_redis_endpoint
+from craigslist.queue import RedisQueue
+from craigslist.crawler import ItemRequest
+from craigslist.dedup import SetDedup, SessionSetDedup, BloomDedup
+
+
+@asyncio.coroutine
+def main(loop, args):
+    redis = yield from aioredis.create_redis(get_redis_endpoint(), loop=loop)
+
+    for dedup in (
+            SetDedup(),
+            SessionSetDedup(),
+            BloomDedup(capacity=args.urls, error_rate=args.error_rate)):
+
+        yield from redis.flushall()
+        queue = RedisQueue(redis, dedup=dedup)
+
+        start = time.time()
+        for offset in range(0, args.urls, 1000):
+            yield from queue.put_requests([
+                ItemRequest(
+                    session_id='session%s' % (i % args.sessions),
+                    city_code='sfbay',
+                    url='https://sfbay.craigslist.org/bik/%s.html' % i,
+                ) for i in range(offset, min(offset + 1000, args.urls))
+            ])
+        elapsed = time.time() - start
+
+        used = 0
+        for key in (yield from dedup.get_keys(redis)):
+            used += yield from redis.execute(b'MEMORY', b'USAGE', key)
+
+        print('%s: %.1f bytes/url, %s urls remembered, %.1f urls/s' % (
+            dedup.__class__.__name__,
+            used / float(args.urls),
+            (yield from dedup.size(redis)),
+            args.urls / elapsed,
+        ))
+
+    yield from redis.flushall()
+    redis.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--urls', type=int, default=100000)
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.001)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, parser.parse_args()))
@@ -0,0 +1,96 @@
+"""
+Compare requests/sec of per-request `aiohttp.get` (old downloader behaviour)
+with pooled keep-alive session of `AiohttpDownloader` against a local stub
+server.
+
+    $ python benchmarks/bench_downloader.py --requests 2000 --concurrency 20
+"""
+import time
+import asyncio
+import argparse
+
+import aiohttp
+from aiohttp import web
+
+from craigslist.downloader import AiohttpDownloader, AiohttpRequest
+
+
+BODY = b'<html><body>' + b'x' * 16 * 1024 + b'</body></html>'
+
+
+@asyncio.coroutine
+def handler(request):
+    return web.Response(body=BODY)
+
+
+@asyncio.coroutine
+def start_server(loop, host, port):
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/{path:.*}', handler)
+    return (yield from loop.create_server(app.make_handler(), host, port))
+
+
+@asyncio.coroutine
+def fetch_without_session(url):
+    r = yield from aiohttp.get(url)
+    yield from r.text()
+
+
+@asyncio.coroutine
+def run(fetch, urls, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    @asyncio.coroutine
+    def _fetch(url):
+        with (yield from semaphore):
+            yield from fetch(url)
+
+    start = time.time()
+    yield from asyncio.gather(*[_fetch(url) for url in urls])
+    return len(urls) / (time.time() - start)
+
+
+@asyncio.coroutine
+def main(loop, args):
+    server = yield from start_server(loop, args.host, args.port)
+    urls = [
+        'http://%s:%s/%s' % (args.host, args.port, i)
+        for i in range(args.requests)
+    ]
+
+    rps = yield from run(fetch_without_session, urls, args.concurrency)
+    print('aiohttp.get per request: %.1f req/s' % rps)
+
+    downloader = AiohttpDownloader(
+        max_connections_per_host=args.concurrency,
+        # do not throttle the stub server
+        host_window={
+            'initial': args.concurrency,
+            'maximum': args.concurrency,
+            'rate': 10 ** 6,
+        },
+    )
+    downloader.prepare()
+
+    @asyncio.coroutine
+    def fetch_with_session(url):
+        future = asyncio.Future()
+        yield from downloader._fetch(AiohttpRequest(url), future)
+        future.result()
+
+    rps = yield from run(fetch_with_session, urls, args.concurrency)
+    print('AiohttpDownloader pooled session: %.1f req/s' % rps)
+
+    downloader.stop()
+    server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, parser.parse_args()))
@@ -0,0 +1,63 @@
+"""
+Decode items/sec of kafka item formats: first version maps decoded as
+before (bytes keys rebuilt to str keys, datetimes parsed from strings),
+the same maps read by current serializer and current fixed-order arrays
+decoded to dicts and to rows.
+
+    $ python benchmarks/bench_item_decode.py --items 100000
+"""
+import time
+import argparse
+import datetime
+
+import msgpack
+
+from craigslist.utils import MsgPackSerializer
+
+from bench_pipeline import build_items
+
+
+def dumps_v1(item):
+    def _encode(obj):
+        if isinstance(obj, datetime.datetime):
+            return {
+                '__datetime__': True,
+                'as_str': obj.strftime("%Y%m%dT%H:%M:%S.%f")
+            }
+        return obj
+    return msgpack.packb(item, default=_encode, use_bin_type=False)
+
+
+def loads_v1(data):
+    def _decode(obj):
+        if b'__datetime__' in obj:
+            obj = datetime.datetime.strptime(
+                obj[b'as_str'].decode(), "%Y%m%dT%H:%M:%S.%f"
+            )
+        return obj
+    item = msgpack.unpackb(data, raw=True, object_hook=_decode)
+    # importer rebuilt every item with str keys
+    return dict((k.decode(), v) for k, v in item.items())
+
+
+def run(name, loads, packed):
+    start = time.time()
+    for data in packed:
+        loads(data)
+    print('%s: %.0f items/s' % (name, len(packed) / (time.time() - start)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=100000)
+    args = parser.parse_args()
+
+    serializer = MsgPackSerializer()
+    items = build_items(args.items)
+    packed_v1 = [dumps_v1(item) for item in items]
+    packed_v2 = [serializer.dumps(item) for item in items]
+
+    run('v1 maps, previous decode', loads_v1, packed_v1)
+    run('v1 maps, loads_row', serializer.loads_row, packed_v1)
+    run('v2 arrays, loads', serializer.loads, packed_v2)
+    run('v2 arrays, loads_row', serializer.loads_row, packed_v2)
@@ -0,0 +1,71 @@
+"""
+Parse throughput of CraigsListCrawler in process pool over `tests/data`
+pages, pages/sec for each pool size and per core.
+
+    $ python benchmarks/bench_parse.py --pages 2000
+"""
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from craigslist.crawler import (
+    CraigsListCrawler, ListRequest, ItemRequest, pack_request,
+    _run_parse_worker,
+)
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def load_pages():
+    pages = []
+    for filename, request_class in (
+            ('list_rows.html', ListRequest),
+            ('item.html', ItemRequest)):
+        with open(os.path.join(DATA_DIR, filename), 'r') as f:
+            pages.append((f.read(), pack_request(request_class(
+                session_id='bench',
+                city_code='sfbay',
+                url='https://sfbay.craigslist.org/',
+            ))))
+    return pages
+
+
+def run(executor_class, pool_size, pages, count):
+    bodies = [pages[i % len(pages)][0] for i in range(count)]
+    requests = [pages[i % len(pages)][1] for i in range(count)]
+    with executor_class(max_workers=pool_size) as executor:
+        # warm up workers
+        list(executor.map(
+            _run_parse_worker, [CraigsListCrawler] * pool_size,
+            bodies[:pool_size], requests[:pool_size],
+        ))
+
+        start = time.time()
+        list(executor.map(
+            _run_parse_worker, [CraigsListCrawler] * count,
+            bodies, requests, chunksize=1,
+        ))
+        return count / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument(
+        '--executor', choices=('process', 'thread'), default='process',
+    )
+    args = parser.parse_args()
+
+    executor_class = {
+        'process': ProcessPoolExecutor,
+        'thread': ThreadPoolExecutor,
+    }[args.executor]
+    pages = load_pages()
+
+    for pool_size in range(1, (os.cpu_count() or 1) + 1):
+        pps = run(executor_class, pool_size, pages, args.pages)
+        print('%s workers: %.1f pages/s, %.1f pages/s per core' % (
+            pool_size, pps, pps / pool_size,
+        ))
@@ -0,0 +1,145 @@
+"""
+KafkaPipeline throughput: items/sec of `process` and bytes on the wire for
+each compression type.
+
+By default items are sent to in-process fake producer which groups them in
+batches of `--batch-size` bytes and compresses batches by kafka codecs.
+With `--broker` items are sent to the kafka broker from environment and
+producer metrics are reported.
+
+    $ python benchmarks/bench_pipeline.py --items 100000
+    $ python benchmarks/bench_pipeline.py --items 100000 --broker
+"""
+import os
+import time
+import argparse
+
+from kafka import codec
+
+from craigslist.item import CraigsListItem
+from craigslist.pipeline import KafkaPipeline
+
+
+CODECS = {
+    None: (lambda: True, lambda data: data),
+    'gzip': (codec.has_gzip, codec.gzip_encode),
+    'snappy': (codec.has_snappy, codec.snappy_encode),
+    'lz4': (codec.has_lz4, codec.lz4_encode),
+    'zstd': (getattr(codec, 'has_zstd', lambda: False),
+             getattr(codec, 'zstd_encode', None)),
+}
+
+
+class BatchingFakeProducer(object):
+
+    def __init__(self, batch_size, compression_type, **kwargs):
+        self.batch_size = batch_size
+        self.encode = CODECS[compression_type][1]
+        self.batch = []
+        self.batch_bytes = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def send(self, topic, value):
+        self.batch.append(value)
+        self.batch_bytes += len(value)
+        if self.batch_bytes >= self.batch_size:
+            self.flush()
+        return self
+
+    # future interface
+    def add_callback(self, f):
+        return self
+
+    def add_errback(self, f):
+        return self
+
+    def flush(self):
+        if self.batch:
+            data = b''.join(self.batch)
+            self.raw_bytes += len(data)
+            self.wire_bytes += len(self.encode(data))
+        self.batch = []
+        self.batch_bytes = 0
+
+    def close(self):
+        pass
+
+
+def build_items(count):
+    return [
+        CraigsListItem(
+            url='https://sfbay.craigslist.org/pen/bik/%s.html' % (
+                5400000000 + i
+            ),
+            session_id='kidbike',
+            city_code='sfbay',
+            title='kid bike %s - $%s (palo alto)' % (i, i % 300),
+            price=(i % 300) * 100,
+            photos=[
+                'http://images.craigslist.org/%05d_kN64FieYYgT_600x450.jpg'
+                % (i + j) for j in range(i % 8)
+            ],
+            description='nice kid bike, 16 inch wheels, '
+                        'training wheels included. ' * (1 + i % 4),
+        ) for i in range(count)
+    ]
+
+
+def run(compression_type, items, args):
+    if args.broker:
+        pipeline = KafkaPipeline(
+            batch_size=args.batch_size,
+            linger_ms=args.linger_ms,
+            compression_type=compression_type,
+        )
+    else:
+        # fake producer does not connect anywhere
+        os.environ.setdefault('KAFKA_1_PORT_9092_TCP_ADDR', 'localhost')
+        os.environ.setdefault('KAFKA_1_PORT_9092_TCP_PORT', '9092')
+        pipeline = KafkaPipeline(
+            batch_size=args.batch_size,
+            compression_type=compression_type,
+            producer_class=lambda **kwargs: BatchingFakeProducer(**kwargs),
+        )
+    pipeline.TOPIC = args.topic
+    pipeline.start(None)
+
+    start = time.time()
+    for item in items:
+        pipeline.process(None, item)
+    pipeline.producer.flush()
+    elapsed = time.time() - start
+
+    if args.broker:
+        metrics = pipeline.producer.metrics()['producer-metrics']
+        print('%s: %.0f items/s, compression rate %.2f, %.0f bytes/s' % (
+            compression_type, len(items) / elapsed,
+            metrics['compression-rate-avg'],
+            metrics['outgoing-byte-rate'],
+        ))
+    else:
+        producer = pipeline.producer
+        print('%s: %.0f items/s, %.1f bytes/item on wire (%.1f raw)' % (
+            compression_type, len(items) / elapsed,
+            producer.wire_bytes / float(len(items)),
+            producer.raw_bytes / float(len(items)),
+        ))
+    pipeline.stop(None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=256 * 1024)
+    parser.add_argument('--linger-ms', type=int, default=50)
+    parser.add_argument('--topic', default='bench_pipeline')
+    parser.add_argument('--broker', action='store_true')
+    args = parser.parse_args()
+
+    items = build_items(args.items)
+    for compression_type in (None, 'gzip', 'snappy', 'lz4', 'zstd'):
+        if not CODECS[compression_type][0]():
+            print('%s: codec is not installed' % compression_type)
+            continue
+        run(compression_type, items, args)
@@ -0,0 +1,65 @@
+"""
+Enqueue throughput of RedisQueue against local redis-server: one request
+per `put_requests` call (one round trip per request) against all requests
+of a list page in one call.
+
+    $ python benchmarks/bench_queue.py --pages 100 --page-size 120
+"""
+import time
+import asyncio
+import argparse
+
+import aioredis
+
+from craigslist.utils import get_redis_endpoint
+from craigslist.queue import RedisQueue
+from craigslist.crawler import ItemRequest
+
+
+def build_pages(prefix, pages, page_size):
+    return [
+        [
+            ItemRequest(
+                session_id='bench',
+                city_code='sfbay',
+                url='https://sfbay.craigslist.org/%s/%s/%s.html' % (
+                    prefix, page, i,
+                ),
+            ) for i in range(page_size)
+        ] for page in range(pages)
+    ]
+
+
+@asyncio.coroutine
+def main(loop, args):
+    redis = yield from aioredis.create_redis(get_redis_endpoint(), loop=loop)
+    yield from redis.flushall()
+    queue = RedisQueue(redis)
+    total = args.pages * args.page_size
+
+    start = time.time()
+    for page in build_pages('single', args.pages, args.page_size):
+        for request in page:
+            yield from queue.put_requests(request)
+    print('one request per call: %.1f requests/s' % (
+        total / (time.time() - start)
+    ))
+
+    start = time.time()
+    for page in build_pages('batch', args.pages, args.page_size):
+        yield from queue.put_requests(page)
+    print('one list page per call: %.1f requests/s' % (
+        total / (time.time() - start)
+    ))
+
+    yield from redis.flushall()
+    redis.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--page-size', type=int, default=120)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, parser.parse_args()))
@@ -0,0 +1,78 @@
+"""
+Extraction time per page of `tests/data` pages by xpath strings evaluated
+as before and by precompiled crawler rules, with time of every rule.
+Rows of the list page are `<p data-pid>`, they are renamed to `<li>` rows
+which crawler expects.
+
+    $ python benchmarks/bench_rules.py --pages 2000
+"""
+import os
+import time
+import argparse
+
+from lxml import html
+
+from craigslist.crawler import CraigsListCrawler
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def load_page(filename):
+    with open(os.path.join(DATA_DIR, filename), 'r') as f:
+        return html.fromstring(f.read())
+
+
+def extract_list_strings(tree):
+    links = [
+        ''.join(item.xpath('a/@href'))
+        for item in tree.xpath('//li[@data-pid]')
+    ]
+    return links, tree.xpath("(//a[@title='next page']/@href)[1]")
+
+
+def extract_item_strings(tree):
+    return (
+        tree.xpath("(//title/text())[1]")[0],
+        tree.xpath(
+            "//span[@class='postingtitletext']/span[@class='price']/text()"
+        )[0],
+        tree.xpath("//section[@id='postingbody']")[0],
+    )
+
+
+def run(name, extract, tree, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        extract(tree)
+    print('%s: %.1f us/page' % (
+        name, (time.perf_counter() - start) / count * 10 ** 6,
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=2000)
+    args = parser.parse_args()
+
+    list_rules = CraigsListCrawler.get_list_rules()
+    item_rules = CraigsListCrawler.get_item_rules()
+    list_tree = load_page('list_rows.html')
+    item_tree = load_page('item.html')
+    print('list rows: %s' % len(list_tree.xpath('//li[@data-pid]')))
+
+    run('list, xpath strings', extract_list_strings, list_tree, args.pages)
+    run('list, compiled rules', list_rules.extract, list_tree, args.pages)
+    run('item, xpath strings', extract_item_strings, item_tree, args.pages)
+    run('item, compiled rules', item_rules.extract, item_tree, args.pages)
+
+    print('\nrule timing:')
+    for rules, tree in ((list_rules, list_tree), (item_rules, item_tree)):
+        for name, rule in rules.rules.items():
+            start = time.perf_counter()
+            for _ in range(args.pages):
+                rule(tree)
+            spent = time.perf_counter() - start
+            print('  %-12s %8d calls %8.3fs %8.1f us/call' % (
+                name, args.pages, spent, spent / args.pages * 10 ** 6,
+            ))
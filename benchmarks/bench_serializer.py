@@ -0,0 +1,56 @@
+"""
+Bytes per queue entry and dumps/loads ops/sec of pickle and compact
+msgpack request serializer.
+
+    $ python benchmarks/bench_serializer.py --count 100000
+"""
+import time
+import pickle
+import argparse
+
+from craigslist.crawler import ListRequest, ItemRequest, RequestSerializer
+
+
+def build_requests(count):
+    return [
+        ItemRequest(
+            session_id='kidbike',
+            city_code='sfbay',
+            url='https://sfbay.craigslist.org/pen/bik/%s.html' % (
+                5400000000 + i
+            ),
+        ) if i % 10 else ListRequest(
+            session_id='kidbike',
+            city_code='sfbay',
+            url='https://sfbay.craigslist.org/search/bia?s=%s' % (i * 100),
+            page_number=i % 3,
+        ) for i in range(count)
+    ]
+
+
+def run(name, serializer, requests):
+    start = time.time()
+    entries = [serializer.dumps(r) for r in requests]
+    dumps_ops = len(requests) / (time.time() - start)
+
+    start = time.time()
+    for entry in entries:
+        serializer.loads(entry)
+    loads_ops = len(requests) / (time.time() - start)
+
+    print('%s: %.1f bytes/entry, dumps %.0f ops/s, loads %.0f ops/s' % (
+        name,
+        sum(len(e) for e in entries) / float(len(entries)),
+        dumps_ops,
+        loads_ops,
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    requests = build_requests(args.count)
+    run('pickle', pickle, requests)
+    run('msgpack', RequestSerializer(), requests)
@@ -0,0 +1,258 @@
+import os
+import gzip
+import time
+import sqlite3
+import hashlib
+import logging
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from pomp.core.base import BaseCrawlException
+
+from craigslist.downloader import AiohttpDownloader, AiohttpResponse
+
+
+log = logging.getLogger(__name__)
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class ResponseCache(object):
+    """On-disk cache of downloaded pages
+
+    Bodies are stored once per content as gzipped blobs named by sha1 of
+    the body, sqlite index maps request key (url) to the blob and keeps
+    size of every blob, so eviction does not walk the blobs directory.
+
+    Methods do blocking disk io, :class:`CachingDownloader` calls them in
+    its own thread.
+
+    :param path: cache directory
+    :param ttl: seconds while cached response is fresh, None - forever
+    :param max_size: max total size of blobs in bytes, older responses
+                     are evicted first
+    :param commit_every: commit index after this number of stored pages
+    """
+
+    def __init__(self, path, ttl=None, max_size=1024 ** 3, commit_every=100):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.blobs_path = os.path.join(path, 'blobs')
+        os.makedirs(self.blobs_path, exist_ok=True)
+
+        # connection is created in the loop thread and used by the cache
+        # thread only
+        self.db = sqlite3.connect(
+            os.path.join(path, 'index.sqlite'), check_same_thread=False,
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' key TEXT PRIMARY KEY,'
+            ' url TEXT NOT NULL,'
+            ' digest TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' ts REAL NOT NULL'
+            ')'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS responses_ts ON responses (ts)'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS responses_digest'
+            ' ON responses (digest)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS blobs ('
+            ' digest TEXT PRIMARY KEY,'
+            ' size INTEGER NOT NULL'
+            ')'
+        )
+        # index of cache created without blobs table
+        self.db.execute(
+            'INSERT OR IGNORE INTO blobs (digest, size)'
+            ' SELECT digest, max(size) FROM responses GROUP BY digest'
+        )
+        self.db.commit()
+
+    @staticmethod
+    def get_key(request):
+        return hashlib.md5(request.url.encode()).hexdigest()
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blobs_path, digest[:2], digest + '.gz')
+
+    def get(self, request, ignore_ttl=False):
+        """Cached body of the request or None"""
+        row = self.db.execute(
+            'SELECT digest, ts FROM responses WHERE key = ?',
+            (self.get_key(request), ),
+        ).fetchone()
+        if row is None:
+            return None
+        digest, ts = row
+        if not ignore_ttl and self.ttl is not None \
+                and ts < time.time() - self.ttl:
+            return None
+        try:
+            with gzip.open(self._blob_path(digest), 'rb') as f:
+                return f.read().decode()
+        except FileNotFoundError:
+            return None
+
+    def put(self, request, body):
+        data = body.encode()
+        digest = hashlib.sha1(data).hexdigest()
+        row = self.db.execute(
+            'SELECT size FROM blobs WHERE digest = ?', (digest, ),
+        ).fetchone()
+        if row is None:
+            path = self._blob_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to temporary file to not leave broken blob on crash
+            with gzip.open(path + '.tmp', 'wb', compresslevel=6) as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            size = os.path.getsize(path)
+            self.db.execute(
+                'INSERT INTO blobs (digest, size) VALUES (?, ?)',
+                (digest, size),
+            )
+        else:
+            size = row[0]
+        self.db.execute(
+            'INSERT OR REPLACE INTO responses (key, url, digest, size, ts)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (self.get_key(request), request.url, digest, size, time.time()),
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def evict(self):
+        """Drop expired responses and the oldest responses over `max_size`,
+        return number of removed blobs"""
+        if self.ttl is not None:
+            self.db.execute(
+                'DELETE FROM responses WHERE ts < ?',
+                (time.time() - self.ttl, ),
+            )
+
+        # size of each blob is counted once
+        blobs = self.db.execute(
+            'SELECT digest, size, max(ts) AS last_ts FROM responses'
+            ' GROUP BY digest ORDER BY last_ts DESC'
+        ).fetchall()
+        total = 0
+        for digest, size, _ in blobs:
+            total += size
+            if total > self.max_size:
+                self.db.execute(
+                    'DELETE FROM responses WHERE digest = ?', (digest, ),
+                )
+
+        unused = [
+            digest for digest, in self.db.execute(
+                'SELECT digest FROM blobs WHERE digest NOT IN'
+                ' (SELECT digest FROM responses)'
+            )
+        ]
+        for digest in unused:
+            try:
+                os.remove(self._blob_path(digest))
+            except FileNotFoundError:
+                pass
+            self.db.execute('DELETE FROM blobs WHERE digest = ?', (digest, ))
+        self.commit()
+        log.debug("[ResponseCache] Evicted %s blobs", len(unused))
+        return len(unused)
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class CachingDownloader(AiohttpDownloader):
+    """Downloader which serves pages from the :class:`ResponseCache` and
+    stores to it downloaded pages
+
+    Cache is used by a single thread out of the event loop, so lookups,
+    stores and eviction keep their order and do not block crawling.
+
+    :param cache: instance of :class:`ResponseCache`
+    :param replay: serve all requests from the cache only, cache misses are
+                   crawl exceptions, host windows are not applied
+    :param evict_every: run cache eviction after this number of stored pages
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.cache = kwargs.pop('cache')
+        self.replay = kwargs.pop('replay', False)
+        self.evict_every = kwargs.pop('evict_every', 1000)
+        self.stored_count = 0
+        self.cache_executor = ThreadPoolExecutor(max_workers=1)
+        super(CachingDownloader, self).__init__(*args, **kwargs)
+
+    def _call_cache(self, method, *args, **kwargs):
+        return asyncio.get_event_loop().run_in_executor(
+            self.cache_executor, partial(method, *args, **kwargs),
+        )
+
+    def _call_cache_later(self, method, *args):
+        self._call_cache(method, *args).add_done_callback(self._cache_done)
+
+    def _cache_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error(
+                "[CachingDownloader] Cache failed",
+                exc_info=future.exception(),
+            )
+
+    def prepare(self):
+        if not self.replay:
+            self._call_cache_later(self.cache.evict)
+            super(CachingDownloader, self).prepare()
+
+    def stop(self):
+        super(CachingDownloader, self).stop()
+        # wait for pending stores
+        self.cache_executor.shutdown(wait=True)
+        self.cache.close()
+
+    @asyncio.coroutine
+    def _get(self, request, headers=None):
+        status, body, response_headers = yield from super(
+            CachingDownloader, self,
+        )._get(request, headers)
+        if status == 200:
+            # store in background, the page is already downloaded
+            self._call_cache_later(self.cache.put, request, body)
+            self.stored_count += 1
+            if self.stored_count % self.evict_every == 0:
+                self._call_cache_later(self.cache.evict)
+        return status, body, response_headers
+
+    @asyncio.coroutine
+    def _fetch(self, request, future):
+        body = yield from self._call_cache(
+            self.cache.get, request, ignore_ttl=self.replay,
+        )
+        if body is not None:
+            log.debug("[CachingDownloader] Hit %s", request.url)
+            future.set_result(AiohttpResponse(request, body))
+        elif self.replay:
+            log.debug("[CachingDownloader] Miss %s", request.url)
+            future.set_result(BaseCrawlException(
+                request, exception=CacheMissError(request.url),
+            ))
+        else:
+            yield from super(CachingDownloader, self)._fetch(request, future)
@@ -0,0 +1,228 @@
+import os
+import time
+import logging
+import asyncio
+
+from craigslist.utils import (
+    HOSTNAME, get_statsd_client, METRIC_QUEUE_SIZE_KEY,
+    METRIC_QUEUE_FLOW_SIZE_KEY, METRIC_QUEUE_IN_FLIGHT_KEY,
+    METRIC_DEDUP_SIZE_KEY, METRIC_CLUSTER_NODES_KEY,
+    METRIC_CLUSTER_EXPIRED_KEY, METRIC_CLUSTER_THROUGHPUT_KEY,
+    METRIC_NODE_IN_FLIGHT_KEY, METRIC_NODE_THROUGHPUT_KEY,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+# take leadership by SET NX PX or prolong it when KEYS[1] is held by
+# ARGV[1] node, ARGV[2] is lease timeout in milliseconds
+elect_lua = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# drop leadership only when it is held by ARGV[1] node
+resign_lua = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# stats of every worker registered in KEYS[1] set by one round trip -
+# worker id, size of processing list (ARGV[1] prefix), lease is alive
+# (ARGV[2] prefix), `dequeued` and `ts` of the heartbeat (ARGV[3] prefix)
+nodes_stats_lua = """
+local result = {}
+for _, worker in ipairs(redis.call('smembers', KEYS[1])) do
+    local heartbeat = redis.call('hmget', ARGV[3] .. worker, 'dequeued', 'ts')
+    table.insert(result, {
+        worker,
+        redis.call('llen', ARGV[1] .. worker),
+        redis.call('exists', ARGV[2] .. worker),
+        heartbeat[1] or '',
+        heartbeat[2] or '',
+    })
+end
+return result
+"""
+
+
+def get_metric_name(value):
+    """Part of the metric key from arbitrary value"""
+    for char in '.:|@ ':
+        value = value.replace(char, '_')
+    return value or 'none'
+
+
+class ClusterNode(object):
+    """Crawler node of the cluster
+
+    Every node writes heartbeat with number of taken requests every
+    `interval` seconds and takes part in the leader election, the leader
+    holds `leader_key` by SET NX PX lease of `lease_timeout` seconds.
+    Only the leader publishes cluster metrics - queue size of every
+    session:city flow, dedup size, in-flight requests of worker leases,
+    expired leases and throughput of every node - and returns to the queue
+    requests of workers with expired lease, so number of redis calls per
+    node does not grow with the cluster.
+
+    :param redis: aioredis connection
+    :param queue: instance of :class:`craigslist.queue.RedisQueue`, node id
+                  is the worker id of the queue
+    :param engine: instance of :class:`craigslist.engine.CraigsListPomp`
+    :param interval: seconds between heartbeats
+    :param lease_timeout: leader lease timeout in seconds, by default three
+                          intervals
+    """
+    leader_key = 'cluster:leader'
+    heartbeat_key_prefix = 'cluster:node:'
+
+    def __init__(
+            self, redis, queue, engine=None, interval=5.0,
+            lease_timeout=None):
+        self.redis = redis
+        self.queue = queue
+        self.engine = engine
+        self.node_id = queue.worker_id
+        self.interval = interval
+        self.lease_timeout = lease_timeout or interval * 3
+        self.heartbeat_key = self.heartbeat_key_prefix + self.node_id
+        self.statsd = get_statsd_client()
+        self.is_leader = False
+        # the last heartbeat (dequeued, ts) of nodes seen by the leader
+        self.heartbeats = {}
+
+    @asyncio.coroutine
+    def run(self):
+        while True:
+            try:
+                yield from self.beat()
+            except Exception:
+                log.exception("[ClusterNode] Heartbeat failed")
+            yield from asyncio.sleep(self.interval)
+
+    @asyncio.coroutine
+    def beat(self):
+        """Write heartbeat, take or prolong leadership, publish cluster
+        metrics and reclaim expired leases when the node is the leader"""
+        yield from self.redis.hmset(
+            self.heartbeat_key,
+            'host', HOSTNAME,
+            'pid', os.getpid(),
+            'dequeued', self.engine.dequeued if self.engine else 0,
+            'ts', time.time(),
+        )
+        yield from self.redis.pexpire(
+            self.heartbeat_key, int(self.lease_timeout * 1000),
+        )
+
+        is_leader = bool((yield from self.redis.eval(
+            elect_lua,
+            keys=[self.leader_key],
+            args=[self.node_id, int(self.lease_timeout * 1000)],
+        )))
+        if is_leader != self.is_leader:
+            log.info(
+                "[ClusterNode] %s %s leader", self.node_id,
+                'is' if is_leader else 'is not',
+            )
+            self.is_leader = is_leader
+            self.heartbeats = {}
+
+        if is_leader:
+            yield from self.publish_metrics()
+            yield from self.queue.reclaim_expired()
+
+    @asyncio.coroutine
+    def leave(self):
+        """Drop heartbeat and leadership of the stopped node"""
+        yield from self.redis.eval(
+            resign_lua, keys=[self.leader_key], args=[self.node_id],
+        )
+        yield from self.redis.delete(self.heartbeat_key)
+        self.is_leader = False
+
+    @asyncio.coroutine
+    def get_nodes_stats(self):
+        """List of (node id, in-flight requests, lease is alive,
+        dequeued requests or None, heartbeat time or None)"""
+        rows = yield from self.redis.eval(
+            nodes_stats_lua,
+            keys=[self.queue.workers_key],
+            args=[
+                self.queue.processing_key_prefix,
+                self.queue.lease_key_prefix,
+                self.heartbeat_key_prefix,
+            ],
+        )
+        return [
+            (
+                node_id.decode(), int(in_flight), bool(alive),
+                int(dequeued) if dequeued else None,
+                float(ts) if ts else None,
+            ) for node_id, in_flight, alive, dequeued, ts in rows
+        ]
+
+    @asyncio.coroutine
+    def publish_metrics(self):
+        flow_sizes = yield from self.queue.flow_sizes()
+        self.statsd.gauge(METRIC_QUEUE_SIZE_KEY, sum(flow_sizes.values()))
+        for flow, size in flow_sizes.items():
+            session_id, _, city_code = flow.partition(':')
+            self.statsd.gauge(METRIC_QUEUE_FLOW_SIZE_KEY.format(
+                session_id=get_metric_name(session_id),
+                city_code=get_metric_name(city_code),
+            ), size)
+
+        self.statsd.gauge(
+            METRIC_DEDUP_SIZE_KEY,
+            (yield from self.queue.dedup.size(self.redis)),
+        )
+
+        nodes = yield from self.get_nodes_stats()
+        total_in_flight = 0
+        total_throughput = 0.0
+        expired = 0
+        alive = 0
+        for node_id, in_flight, lease_alive, dequeued, ts in nodes:
+            node = get_metric_name(node_id)
+            total_in_flight += in_flight
+            self.statsd.gauge(
+                METRIC_NODE_IN_FLIGHT_KEY.format(node=node), in_flight,
+            )
+            if not lease_alive:
+                expired += 1
+            if ts is None:
+                continue
+            alive += 1
+
+            previous = self.heartbeats.get(node_id)
+            self.heartbeats[node_id] = (dequeued, ts)
+            if previous is None or ts <= previous[1]:
+                continue
+            throughput = max(0, dequeued - previous[0]) / (ts - previous[1])
+            total_throughput += throughput
+            self.statsd.gauge(
+                METRIC_NODE_THROUGHPUT_KEY.format(node=node),
+                round(throughput, 2),
+            )
+
+        # forget stopped nodes
+        seen = set(node[0] for node in nodes if node[4] is not None)
+        for node_id in set(self.heartbeats) - seen:
+            del self.heartbeats[node_id]
+
+        self.statsd.gauge(METRIC_QUEUE_IN_FLIGHT_KEY, total_in_flight)
+        self.statsd.gauge(METRIC_CLUSTER_NODES_KEY, alive)
+        self.statsd.gauge(METRIC_CLUSTER_EXPIRED_KEY, expired)
+        self.statsd.gauge(
+            METRIC_CLUSTER_THROUGHPUT_KEY, round(total_throughput, 2),
+        )
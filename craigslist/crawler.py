@@ -1,21 +1,37 @@
+import os
 import re
+import sys
 import json
+import time
+import pickle
+import asyncio
 import hashlib
 import logging
+import threading
+from functools import partial
 from urllib.parse import urljoin
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import msgpack
 from lxml import html
 
-from pomp.core.base import BaseCrawler
+from pomp.core.base import BaseCrawler, BaseCrawlException
+from pomp.core.utils import Planned
+from pomp.contrib.asynciotools import AioConcurrentCrawler
 
-from craigslist.item import CraigsListItem
-from craigslist.downloader import AiohttpRequest
+from craigslist.item import CraigsListItem, UnchangedItem
+from craigslist.downloader import AiohttpRequest, AiohttpResponse
+from craigslist.rules import Rule, RowRule, RuleSet
+from craigslist.utils import get_statsd_client, get_stage_key
 
 
 log = logging.getLogger(__name__)
 
 
 class CraigsListRequestBase(AiohttpRequest):
+    # order of requests of the same session and city in the queue,
+    # lower is first
+    priority = 1
 
     def __init__(self, *args, **kwargs):
         self.session_id = kwargs.pop('session_id')
@@ -42,6 +58,8 @@ class CraigsListRequestBase(AiohttpRequest):
 
 
 class ListRequest(CraigsListRequestBase):
+    # discover new items before parse found ones
+    priority = 0
 
     def __init__(self, *args, **kwargs):
         self.page_number = kwargs.pop('page_number', 0)
@@ -49,7 +67,48 @@ class ListRequest(CraigsListRequestBase):
 
 
 class ItemRequest(CraigsListRequestBase):
-    pass
+    # item pages are downloaded again only if changed,
+    # list pages are always downloaded to discover new items
+    conditional = True
+
+    # all item data is above the end of posting body
+    read_until = re.compile(b'id="postingbody".*?</section>', re.S)
+
+
+# request type tags of the compact request representation
+REQUEST_TYPES = (ListRequest, ItemRequest)
+
+
+def pack_request(request):
+    """Represent request as plain tuple
+    (type tag, session_id, city_code, url, page_number)"""
+    return (
+        REQUEST_TYPES.index(type(request)),
+        request.session_id,
+        request.city_code,
+        request.url,
+        getattr(request, 'page_number', None),
+    )
+
+
+def unpack_request(data):
+    tag, session_id, city_code, url, page_number = data
+    kwargs = {
+        'session_id': session_id,
+        'city_code': city_code,
+        'url': url,
+    }
+    if page_number is not None:
+        kwargs['page_number'] = page_number
+    return REQUEST_TYPES[tag](**kwargs)
+
+
+def get_unchanged_item(request):
+    return UnchangedItem(
+        url=request.url,
+        city_code=request.city_code,
+        session_id=request.session_id,
+    )
 
 
 class CraigsListCrawler(BaseCrawler):
@@ -58,25 +117,52 @@ class CraigsListCrawler(BaseCrawler):
 
     URL_TEMPLATE = 'https://{city_code}.craigslist.org/'
 
-    # list parse xpaths
-    NEXT_PAGE_XPATH = "(//a[@title='next page']/@href)[1]"
-    ITEMS_XPATH = '//li[@data-pid]'
-
-    # item parse xpaths
-    ITEM_TITLE = "(//title/text())[1]"
-    ITEM_PRICE = "//span[@class='postingtitletext']" \
-        "/span[@class='price']/text()"
-    ITEM_DESCRIPTION = "//section[@id='postingbody']"
-
     ITEM_PHOTOS_RE = re.compile('var imgList\ =\ (.*)\;')
 
+    def __init__(self, *args, **kwargs):
+        super(CraigsListCrawler, self).__init__(*args, **kwargs)
+        # rules are compiled per crawler, parse threads do not share them
+        self.list_rules = self.get_list_rules()
+        self.item_rules = self.get_item_rules()
+
+    @staticmethod
+    def get_list_rules():
+        return RuleSet((
+            ('items', RowRule('//li[@data-pid]', (
+                ('link', Rule('a/@href', join=True)),
+            ))),
+            ('next_page', Rule(
+                "(//a[@title='next page']/@href)[1]", first=True,
+            )),
+        ))
+
+    @staticmethod
+    def get_item_rules():
+        # rules of full DOM of the item page
+        return RuleSet((
+            ('title', Rule("(//title/text())[1]", first=True)),
+            ('price', Rule(
+                "//span[@class='postingtitletext']"
+                "/span[@class='price']/text()",
+                first=True,
+            )),
+            ('description', Rule("//section[@id='postingbody']", first=True)),
+        ))
+
     def extract_items(self, response):
-        tree = html.fromstring(response.body)
+        if getattr(response, 'unchanged', False):
+            yield get_unchanged_item(response.request)
+            return
 
         if isinstance(response.request, ListRequest):
-            yield from self._parse_list(response, tree)
+            yield from self._parse_list(
+                response, html.fromstring(response.body),
+            )
         elif isinstance(response.request, ItemRequest):
-            yield from self._parse_item(response, tree)
+            # body is downloaded only until the end of posting body
+            yield from self._parse_item(
+                response, html.fromstring(response.body),
+            )
         else:
             raise RuntimeError(
                 "Unknown request type: %s %s" % (
@@ -85,10 +171,13 @@ class CraigsListCrawler(BaseCrawler):
             )
 
     def _parse_list(self, response, tree):
+        names = ['items']
+        if response.request.page_number < self.MAX_PAGE_NUMBER:
+            names.append('next_page')
+        values = self.list_rules.extract(tree, names)
 
         # yield next request for item parsing
-        for item in tree.xpath(self.ITEMS_XPATH):
-            link = ''.join(item.xpath('a/@href'))
+        for item in values['items']:
             yield ItemRequest(
                 session_id=response.request.session_id,
 
@@ -100,14 +189,14 @@ class CraigsListCrawler(BaseCrawler):
                     self.URL_TEMPLATE.format(
                         city_code=response.request.city_code
                     ),
-                    link,
+                    item['link'],
                 )
             )
 
         # yield next request to parse next page
         if response.request.page_number < self.MAX_PAGE_NUMBER:
 
-            next_page_link = tree.xpath(self.NEXT_PAGE_XPATH)
+            next_page_link = values['next_page']
             log.debug("Next page link: %s", next_page_link)
 
             if next_page_link:
@@ -121,29 +210,168 @@ class CraigsListCrawler(BaseCrawler):
                         self.URL_TEMPLATE.format(
                             city_code=response.request.city_code
                         ),
-                        next_page_link[0],
+                        next_page_link,
                     )
                 )
 
     def _parse_item(self, response, tree):
+        values = self.item_rules.extract(tree)
+        values['description'] = values['description'].text_content()
+        values['photos'] = self.ITEM_PHOTOS_RE.search(
+            response.body
+        ).groups()[0]
+        yield self._build_item(response, values)
+
+    def _build_item(self, response, values):
         item = CraigsListItem()
 
         item.url = response.request.url
         item.session_id = response.request.session_id
         item.city_code = response.request.city_code
 
-        item.title = tree.xpath(self.ITEM_TITLE)[0]
+        item.title = values['title']
 
         # convert dollars to cents
-        item.price = int(
-            tree.xpath(self.ITEM_PRICE)[0].replace('$', '')
-        ) * 100
-
-        item.photos = [
-            i['url'] for i in json.loads(
-                self.ITEM_PHOTOS_RE.search(response.body).groups()[0]
+        item.price = int(values['price'].replace('$', '')) * 100
+
+        item.photos = [i['url'] for i in json.loads(values['photos'])]
+        item.description = values['description']
+
+        return item
+
+
+class RequestSerializer(object):
+    """Compact msgpack serializer of craigslist requests
+
+    Request is packed as msgpack array of :func:`pack_request` fields,
+    common `https://{city_code}.craigslist.org/` url prefix is not stored.
+    Pickled requests are still readable.
+    """
+
+    # flag of type tag, url is stored without city url prefix
+    RELATIVE_URL = 0x40
+
+    def __init__(self, url_template=None, allow_pickle=True):
+        self.url_template = url_template or CraigsListCrawler.URL_TEMPLATE
+        self.allow_pickle = allow_pickle
+
+    def dumps(self, request):
+        tag, session_id, city_code, url, page_number = pack_request(request)
+        prefix = self.url_template.format(city_code=city_code)
+        if url.startswith(prefix):
+            tag |= self.RELATIVE_URL
+            url = url[len(prefix):]
+        return msgpack.packb(
+            (tag, session_id, city_code, url, page_number),
+            use_bin_type=True,
+        )
+
+    def loads(self, data):
+        if data[:1] == b'\x80':
+            # pickle protocol 2+ header, request from previous versions
+            if not self.allow_pickle:
+                raise ValueError('Pickled request is not allowed')
+            return pickle.loads(data)
+
+        tag, session_id, city_code, url, page_number = msgpack.unpackb(
+            data, raw=False,
+        )
+        if tag & self.RELATIVE_URL:
+            tag ^= self.RELATIVE_URL
+            url = self.url_template.format(city_code=city_code) + url
+        return unpack_request((tag, session_id, city_code, url, page_number))
+
+
+# crawler instances of the parse worker process (or thread)
+_parse_workers = threading.local()
+
+
+def _run_parse_worker(worker_class, body, request):
+    """Parse page and return only compact result - parse time in seconds
+    and list of (True, packed request) or (False, item as dict) pairs"""
+    crawlers = getattr(_parse_workers, 'crawlers', None)
+    if crawlers is None:
+        crawlers = _parse_workers.crawlers = {}
+    crawler = crawlers.get(worker_class)
+    if crawler is None:
+        crawler = crawlers[worker_class] = worker_class()
+
+    start = time.monotonic()
+    response = AiohttpResponse(unpack_request(request), body)
+    result = [
+        (True, pack_request(item))
+        if isinstance(item, CraigsListRequestBase) else (False, dict(item))
+        for item in crawler.extract_items(response)
+    ]
+    return time.monotonic() - start, result
+
+
+class CraigsListConcurrentCrawler(AioConcurrentCrawler):
+    """Parse pages by executor out of the event loop thread
+
+    :param worker_class: crawler class to parse pages
+    :param pool_size: number of workers, by default number of cpu cores
+    :param executor: `process` for ProcessPoolExecutor or `thread` for
+                     ThreadPoolExecutor (lxml releases GIL while parsing)
+
+    Parse time of workers is reported as `parse` stage histogram.
+    """
+
+    EXECUTORS = {
+        'process': ProcessPoolExecutor,
+        'thread': ThreadPoolExecutor,
+    }
+
+    def __init__(
+            self, worker_class=CraigsListCrawler, pool_size=None,
+            executor='process'):
+        self.worker_class = worker_class
+        self.pool_size = pool_size or os.cpu_count() or 1
+        self.executor = self.EXECUTORS[executor](max_workers=self.pool_size)
+        self.ENTRY_REQUESTS = getattr(worker_class, 'ENTRY_REQUESTS', None)
+        self.statsd = get_statsd_client()
+
+    def process(self, response):
+        if response.unchanged:
+            # nothing to parse
+            return [get_unchanged_item(response.request)]
+
+        # build Planned object
+        done_future = Planned()
+
+        # send only body and packed request to the worker
+        asyncio.ensure_future(
+            asyncio.get_event_loop().run_in_executor(
+                self.executor,
+                _run_parse_worker,
+                self.worker_class,
+                response.body,
+                pack_request(response.request),
             )
-        ]
-        item.description = tree.xpath(self.ITEM_DESCRIPTION)[0].text_content()
+        ).add_done_callback(
+            partial(self._parsed, response, done_future)
+        )
+
+        return done_future
 
-        yield item
+    def _parsed(self, response, done_future, future):
+        try:
+            seconds, result = future.result()
+            self.statsd.histogram(
+                get_stage_key('parse', response.request), seconds * 1000,
+            )
+            result = [
+                unpack_request(data) if is_request
+                else CraigsListItem(**data)
+                for is_request, data in result
+            ]
+        except Exception as e:
+            log.exception('Exception on %s', response)
+            done_future.set_result(BaseCrawlException(
+                response.request,
+                response=response,
+                exception=e,
+                exc_info=sys.exc_info(),
+            ))
+        else:
+            done_future.set_result(result)
@@ -0,0 +1,223 @@
+import os
+import logging
+import asyncio
+
+
+log = logging.getLogger(__name__)
+
+
+class BaseDedup(object):
+    """Dedup backend of :class:`craigslist.queue.RedisQueue`
+
+    Backend provides Lua code of `is_new(identity, session_id)` function
+    which is called by the queue script for every new request and must
+    remember the identity.
+    """
+
+    def get_lua(self):
+        raise NotImplementedError()
+
+    @asyncio.coroutine
+    def get_keys(self, redis):
+        raise NotImplementedError()
+
+    @asyncio.coroutine
+    def size(self, redis):
+        """Number of remembered identities"""
+        raise NotImplementedError()
+
+
+class SetDedup(BaseDedup):
+    """Exact dedup by one set of all identities ever seen"""
+
+    def __init__(self, key='all'):
+        self.key = key
+
+    def get_lua(self):
+        return """
+local function is_new(identity, session_id)
+    return redis.call('sadd', '%s', identity) == 1
+end
+""" % self.key
+
+    @asyncio.coroutine
+    def get_keys(self, redis):
+        return [self.key]
+
+    @asyncio.coroutine
+    def size(self, redis):
+        return (yield from redis.scard(self.key))
+
+
+class SessionSetDedup(BaseDedup):
+    """Exact dedup by set of identities per session
+
+    Set of the session expires after `ttl` seconds without new requests, so
+    finished sessions free their memory. Size of every session set is
+    counted in `sizes_key` hash to not scan the keyspace for sizes.
+    """
+
+    def __init__(
+            self, key_prefix='all:', ttl=7 * 24 * 3600,
+            sizes_key='dedup_sizes'):
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.sizes_key = sizes_key
+
+    def get_lua(self):
+        return """
+local function is_new(identity, session_id)
+    local key = '%s' .. session_id
+    local added = redis.call('sadd', key, identity) == 1
+    redis.call('expire', key, %d)
+    if added then
+        -- count of expired set is reset by its first identity
+        if redis.call('scard', key) == 1 then
+            redis.call('hset', '%s', session_id, 1)
+        else
+            redis.call('hincrby', '%s', session_id, 1)
+        end
+    end
+    return added
+end
+""" % (self.key_prefix, self.ttl, self.sizes_key, self.sizes_key)
+
+    @asyncio.coroutine
+    def get_keys(self, redis):
+        keys, cursor = [], 0
+        while True:
+            cursor, result = yield from redis.scan(
+                cursor, match=self.key_prefix + '*',
+            )
+            keys.extend(result)
+            if not int(cursor):
+                return keys + [self.sizes_key]
+
+    @asyncio.coroutine
+    def size(self, redis):
+        sizes = yield from redis.hgetall(self.sizes_key)
+        result = 0
+        for session_id, size in sizes.items():
+            key = self.key_prefix + session_id.decode()
+            if (yield from redis.exists(key)):
+                result += int(size)
+            else:
+                # set of the session is expired
+                yield from redis.hdel(self.sizes_key, session_id)
+        return result
+
+
+class BloomDedup(BaseDedup):
+    """Scalable Bloom filter over redis bitmaps
+
+    Filter consists of layers, layer `n` holds up to
+    `capacity * growth ** n` identities with false positive rate
+    `error_rate * tightening ** (n + 1)`, so total false positive rate stays
+    below `error_rate` with default tightening. Bit positions are taken from
+    md5 hex identity of request by double hashing.
+    """
+
+    def __init__(
+            self, key_prefix='bloom:', capacity=1000000, error_rate=0.001,
+            growth=2, tightening=0.5):
+        self.key_prefix = key_prefix
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+
+    def get_lua(self):
+        return """
+local bloom_prefix = '%(key_prefix)s'
+local bloom_meta = bloom_prefix .. 'meta'
+
+local function bloom_layer(n)
+    local capacity = %(capacity)d * %(growth)d ^ n
+    local error_rate = %(error_rate)r * %(tightening)r ^ (n + 1)
+    local bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ^ 2)
+    local hashes = math.ceil(-math.log(error_rate) / math.log(2))
+    return capacity, math.min(bits, 4294967295), hashes
+end
+
+local function is_new(identity, session_id)
+    local h1 = tonumber(string.sub(identity, 1, 8), 16)
+    local h2 = tonumber(string.sub(identity, 9, 16), 16)
+    local layers = tonumber(redis.call('hget', bloom_meta, 'layers') or 0)
+
+    -- identity was seen if all bits are set in any layer
+    for n = 0, layers - 1 do
+        local _, bits, hashes = bloom_layer(n)
+        local found = true
+        for i = 0, hashes - 1 do
+            local bit = (h1 + i * h2) %% bits
+            if redis.call('getbit', bloom_prefix .. n, bit) == 0 then
+                found = false
+                break
+            end
+        end
+        if found then
+            return false
+        end
+    end
+
+    -- add identity to the last layer, start new layer if it is full
+    local n = layers - 1
+    if n < 0 or tonumber(redis.call('hget', bloom_meta, 'count:' .. n)) >=
+            bloom_layer(n) then
+        n = layers
+        redis.call('hset', bloom_meta, 'layers', layers + 1)
+    end
+
+    local _, bits, hashes = bloom_layer(n)
+    for i = 0, hashes - 1 do
+        redis.call('setbit', bloom_prefix .. n, (h1 + i * h2) %% bits, 1)
+    end
+    redis.call('hincrby', bloom_meta, 'count:' .. n, 1)
+    return true
+end
+""" % {
+            'key_prefix': self.key_prefix,
+            'capacity': self.capacity,
+            'growth': self.growth,
+            'error_rate': self.error_rate,
+            'tightening': self.tightening,
+        }
+
+    @asyncio.coroutine
+    def get_keys(self, redis):
+        meta_key = self.key_prefix + 'meta'
+        layers = int((yield from redis.hget(meta_key, 'layers')) or 0)
+        return [meta_key] + [self.key_prefix + str(n) for n in range(layers)]
+
+    @asyncio.coroutine
+    def size(self, redis):
+        meta = yield from redis.hgetall(self.key_prefix + 'meta')
+        return sum(
+            int(value) for key, value in meta.items()
+            if key.startswith(b'count:')
+        )
+
+
+DEDUP_BACKENDS = {
+    'set': SetDedup,
+    'session': SessionSetDedup,
+    'bloom': BloomDedup,
+}
+
+
+def get_dedup_backend():
+    """Dedup backend configured by environment, all crawlers and sessions
+    must use the same backend"""
+    name = os.environ.get('DEDUP_BACKEND', 'set')
+    kwargs = {}
+    if name == 'session' and 'DEDUP_SESSION_TTL' in os.environ:
+        kwargs['ttl'] = int(os.environ['DEDUP_SESSION_TTL'])
+    elif name == 'bloom':
+        if 'DEDUP_BLOOM_CAPACITY' in os.environ:
+            kwargs['capacity'] = int(os.environ['DEDUP_BLOOM_CAPACITY'])
+        if 'DEDUP_BLOOM_ERROR_RATE' in os.environ:
+            kwargs['error_rate'] = float(
+                os.environ['DEDUP_BLOOM_ERROR_RATE']
+            )
+    log.debug("Dedup backend: %s %s", name, kwargs)
+    return DEDUP_BACKENDS[name](**kwargs)
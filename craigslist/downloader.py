@@ -1,18 +1,32 @@
+import re
+import sys
+import time
 import logging
 import asyncio
+from functools import partial
 
 import aiohttp
 
 from pomp.core.base import (
-    BaseHttpRequest, BaseHttpResponse, BaseDownloader,
+    BaseHttpRequest, BaseHttpResponse, BaseDownloader, BaseCrawlException,
 )
 from pomp.core.utils import Planned
 
+from craigslist.throttle import HostScheduler
+from craigslist.validators import get_body_hash
+from craigslist.utils import get_statsd_client, get_stage_key
+
 
 log = logging.getLogger(__name__)
 
 
 class AiohttpRequest(BaseHttpRequest):
+    # make conditional request by stored validators of the url
+    conditional = False
+
+    # compiled bytes regex, page is downloaded only until the first match
+    read_until = None
+
     def __init__(self, url):
         self.url = url
 
@@ -21,16 +35,49 @@ class AiohttpRequest(BaseHttpRequest):
 
 
 class AiohttpResponse(BaseHttpResponse):
-    def __init__(self, request, body):
+    """Response of the page
+
+    Response of not modified page (304 or the same body hash) has
+    `unchanged` flag, its body may be empty.
+    """
+
+    def __init__(self, request, body, unchanged=False):
         self.req = request
         self.body = body
+        self.unchanged = unchanged
 
     @property
     def request(self):
         return self.req
 
 
+class TimedTCPConnector(aiohttp.TCPConnector):
+    """TCPConnector which reports time of new connections by
+    `on_connect(host, seconds)`"""
+
+    def __init__(self, *args, **kwargs):
+        self.on_connect = kwargs.pop('on_connect')
+        super(TimedTCPConnector, self).__init__(*args, **kwargs)
+
+    @asyncio.coroutine
+    def _create_connection(self, req, *args, **kwargs):
+        start = time.monotonic()
+        result = yield from super(TimedTCPConnector, self)._create_connection(
+            req, *args, **kwargs
+        )
+        self.on_connect(req.host, time.monotonic() - start)
+        return result
+
+
 class AiohttpDownloader(BaseDownloader):
+    """Downloader with pooled session, per host windows and conditional
+    requests
+
+    Latency of the host window wait (`throttle`), new connections
+    (`connect`), response headers including connect (`ttfb`), response
+    body (`body`) and the page rest after `read_until` match (`drain`) is
+    reported as stage histograms.
+    """
 
     def __init__(self, *args, **kwargs):
         if 'max_concurent_request_count' in kwargs:
@@ -39,20 +86,204 @@ class AiohttpDownloader(BaseDownloader):
             )
         else:
             self.max_concurent_request_count = 3
+
+        # connection pool, limit is applied per host (endpoint)
+        self.max_connections_per_host = kwargs.pop(
+            'max_connections_per_host', 10,
+        )
+        self.keepalive_timeout = kwargs.pop('keepalive_timeout', 30)
+        self.conn_timeout = kwargs.pop('conn_timeout', 10)
+        self.request_timeout = kwargs.pop('request_timeout', 30)
+
+        # size of chunks of pages read by `read_until` of the request
+        self.read_chunk_size = kwargs.pop('read_chunk_size', 16 * 1024)
+        # max size of the page rest read after `read_until` match to return
+        # the connection to the pool, connection with bigger rest is closed
+        self.max_drain_size = kwargs.pop('max_drain_size', 64 * 1024)
+
+        # per host concurrency window and rate,
+        # max_concurent_request_count is the limit for all hosts together
+        self.scheduler = HostScheduler(**kwargs.pop('host_window', {}))
+
+        # store of page validators for conditional requests,
+        # instance of craigslist.validators.BaseValidatorStore
+        self.validator_store = kwargs.pop('validator_store', None)
+
+        self.statsd = get_statsd_client()
+        self.session = None
         super(AiohttpDownloader, self).__init__(*args, **kwargs)
 
     def get_workers_count(self):
         return self.max_concurent_request_count
 
+    def get_session(self):
+        if self.session is None:
+            log.debug(
+                "[AiohttpDownloader] Open session: limit per host %s"
+                " keepalive %ss", self.max_connections_per_host,
+                self.keepalive_timeout,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=TimedTCPConnector(
+                    on_connect=self._on_connect,
+                    limit=self.max_connections_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                    conn_timeout=self.conn_timeout,
+                    # cache resolved hosts
+                    use_dns_cache=True,
+                ),
+            )
+        return self.session
+
+    def prepare(self):
+        self.get_session()
+
+    def stop(self):
+        if self.session is not None:
+            log.debug("[AiohttpDownloader] Close session")
+            self.session.close()
+            self.session = None
+
+    def _on_connect(self, host, seconds):
+        # host of craigslist city is `<city_code>.craigslist.org`
+        self.statsd.histogram(
+            get_stage_key('connect', city_code=host.split('.')[0]),
+            seconds * 1000,
+        )
+
+    def _timing(self, stage, request, start):
+        self.statsd.histogram(
+            get_stage_key(stage, request), (time.monotonic() - start) * 1000,
+        )
+
+    CHARSET_RE = re.compile(r'charset=([\w-]+)', re.I)
+
+    @asyncio.coroutine
+    def _get(self, request, headers=None):
+        start = time.monotonic()
+        r = yield from self.get_session().get(request.url, headers=headers)
+        self._timing('ttfb', request, start)
+
+        start = time.monotonic()
+        try:
+            if request.read_until is not None:
+                body, release = yield from self._read_until(request, r)
+            else:
+                body, release = (yield from r.text()), True
+        except (Exception, asyncio.CancelledError):
+            # failed, timed out or cancelled response has unread data,
+            # release would wait for the rest of it
+            r.close()
+            raise
+        self._timing('body', request, start)
+
+        if release:
+            # return connection to the pool, the response is read to the end
+            yield from r.release()
+        else:
+            r.close()
+        return r.status, body, r.headers
+
+    @asyncio.coroutine
+    def _read_until(self, request, r):
+        """Read response by chunks until `read_until` pattern of the request
+        matches, the rest of the page is read and dropped to keep the
+        connection alive, return body and whether the connection can be
+        released to the pool"""
+        data = bytearray()
+        release = True
+        while True:
+            chunk = yield from r.content.read(self.read_chunk_size)
+            if not chunk:
+                break
+            data.extend(chunk)
+            match = request.read_until.search(data)
+            if match:
+                del data[match.end():]
+                start = time.monotonic()
+                release = yield from self._drain(r)
+                self._timing('drain', request, start)
+                break
+
+        charset = self.CHARSET_RE.search(
+            r.headers.get('CONTENT-TYPE', ''),
+        )
+        return bytes(data).decode(
+            charset.group(1) if charset else 'utf-8', 'replace',
+        ), release
+
+    @asyncio.coroutine
+    def _drain(self, r):
+        """Read and drop the rest of the response up to `max_drain_size`,
+        True if the response is read to the end"""
+        drained = 0
+        while drained <= self.max_drain_size:
+            chunk = yield from r.content.read(self.read_chunk_size)
+            if not chunk:
+                return True
+            drained += len(chunk)
+        # connection with unread data can not be reused
+        return False
+
+    @asyncio.coroutine
+    def _get_validators(self, request):
+        if self.validator_store is None or not request.conditional:
+            return None
+        return (yield from self.validator_store.get(request.url))
+
     @asyncio.coroutine
     def _fetch(self, request, future):
+        validators = yield from self._get_validators(request)
+        headers = {}
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        window = self.scheduler.get_window(request.url)
+        start = time.monotonic()
+        yield from window.acquire()
+        self._timing('throttle', request, start)
+
         log.debug("[AiohttpDownloader] Start fetch: %s", request.url)
-        r = yield from aiohttp.get(request.url)
-        body = yield from r.text()
+        start = time.monotonic()
+        try:
+            status, body, response_headers = yield from asyncio.wait_for(
+                self._get(request, headers), self.request_timeout,
+            )
+        except Exception as e:
+            window.release(failed=True)
+            log.debug("[AiohttpDownloader] Failed %s: %s", request.url, e)
+            future.set_result(BaseCrawlException(
+                request, exception=e, exc_info=sys.exc_info(),
+            ))
+            return
+
+        window.release(
+            latency=time.monotonic() - start,
+            failed=status == 429 or status >= 500,
+        )
+        unchanged = False
+        if status == 304 and validators:
+            unchanged = True
+            # keep validators alive
+            yield from self.validator_store.set(request.url, **validators)
+        elif status == 200 and validators is not None:
+            body_hash = get_body_hash(body)
+            unchanged = body_hash == validators.get('hash')
+            yield from self.validator_store.set(
+                request.url,
+                etag=response_headers.get('ETAG'),
+                last_modified=response_headers.get('LAST-MODIFIED'),
+                hash=body_hash,
+            )
+
         log.debug(
-            "[AiohttpDownloader] Done %s: size: %s", request.url, len(body),
+            "[AiohttpDownloader] Done %s: status: %s size: %s unchanged: %s",
+            request.url, status, len(body), unchanged,
         )
-        future.set_result(AiohttpResponse(request, body))
+        future.set_result(AiohttpResponse(request, body, unchanged=unchanged))
 
     def get(self, requests):
         for request in requests:
@@ -62,8 +293,8 @@ class AiohttpDownloader(BaseDownloader):
 
             planned = Planned()
 
-            def build_response(f):
+            def build_response(planned, f):
                 planned.set_result(f.result())
-            future.add_done_callback(build_response)
+            future.add_done_callback(partial(build_response, planned))
 
             yield planned
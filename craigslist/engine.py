@@ -0,0 +1,265 @@
+import time
+import logging
+import asyncio
+from functools import partial
+
+from pomp.core.base import BaseHttpRequest, BaseCrawlException
+from pomp.core.utils import iterator, isstring, Planned
+from pomp.core.engine import StopCommand
+from pomp.contrib.asynciotools import AioPomp
+
+from craigslist.utils import get_statsd_client, get_stage_key
+from craigslist.throttle import TokenBucket
+
+
+log = logging.getLogger(__name__)
+
+
+class CraigsListPomp(AioPomp):
+    """AioPomp which does not wait for response processing before taking
+    next request from the queue
+
+    Number of in-flight requests is limited by the queue semaphore, i.e. by
+    `get_workers_count` of the downloader. All requests produced by one
+    response are put to the queue by one `put_requests` call.
+
+    Pipelines may provide `drain` coroutine to apply backpressure, it is
+    awaited before taking next request from the queue, and `flush`
+    coroutine awaited before pipelines are stopped.
+
+    Latency of dequeue, enqueue of child requests and of every pipeline is
+    reported as stage histograms.
+
+    Number of in-flight requests and dequeue rate may be lowered at runtime
+    by :meth:`set_concurrency` and :meth:`set_dequeue_rate`.
+
+    Processed requests are acknowledged by `ack_requests` of the queue.
+    Requests failed by the downloader, middlewares or the crawler are
+    returned by `retry_requests` of the queue if it has one. Responses
+    rejected by middlewares (None) are filtered on purpose and acknowledged.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CraigsListPomp, self).__init__(*args, **kwargs)
+        self.statsd = get_statsd_client()
+        # number of taken from the queue requests
+        self.dequeued = 0
+        self.dequeue_bucket = None
+        # acquires of queue semaphore permits taken out of use
+        self.held_permits = []
+        # requests passed to exception middlewares, retried instead of ack
+        self.failed_requests = set()
+
+    def get_concurrency(self):
+        return self.downloader.get_workers_count() - len(self.held_permits)
+
+    def set_concurrency(self, limit):
+        """Limit number of in-flight requests by `limit`, not more than
+        `get_workers_count` of the downloader, permits over the limit are
+        held by the engine"""
+        if not self.queue_semaphore:
+            return
+        workers_count = self.downloader.get_workers_count()
+        hold = workers_count - max(1, min(limit, workers_count))
+        while len(self.held_permits) < hold:
+            self.held_permits.append(
+                asyncio.ensure_future(self.queue_semaphore.acquire())
+            )
+        while len(self.held_permits) > hold:
+            acquire = self.held_permits.pop()
+            if acquire.done():
+                self.queue_semaphore.release()
+            else:
+                acquire.cancel()
+
+    def set_dequeue_rate(self, rate):
+        """Take from the queue not more than `rate` requests per second,
+        None - without limit"""
+        self.dequeue_bucket = TokenBucket(rate, capacity=1) if rate else None
+
+    @asyncio.coroutine
+    def pump(self, crawler):
+        self.prepare(crawler)
+
+        # add ENTRY_REQUESTS to the queue
+        next_requests = getattr(crawler, 'ENTRY_REQUESTS', None)
+        if next_requests:
+            yield from self._put_requests(
+                iterator(next_requests), request_done=False,
+            )
+
+        while True:
+
+            # do not fetch from queue request more than downloader can process
+            if self.queue_semaphore:
+                yield from self.queue_semaphore.acquire()
+
+            # do not fetch from queue request more than pipelines can process
+            yield from self._drain_pipelines('drain')
+
+            if self.dequeue_bucket is not None:
+                yield from self.dequeue_bucket.consume()
+
+            start = time.monotonic()
+            next_requests = yield from self.queue.get_requests()
+            self.dequeued += 1
+            self.statsd.histogram(
+                get_stage_key('dequeue'), (time.monotonic() - start) * 1000,
+            )
+
+            if isinstance(next_requests, StopCommand):
+                break
+
+            yield from self.process_requests(
+                iterator(next_requests), crawler,
+            )
+
+        yield from self._drain_pipelines('flush')
+        self.finish(crawler)
+
+    @asyncio.coroutine
+    def _drain_pipelines(self, method):
+        for pipe in self.pipelines:
+            if hasattr(pipe, method):
+                yield from getattr(pipe, method)()
+
+    def _on_response(self, crawler, response):
+        asyncio.ensure_future(
+            self._process_response(crawler, response.result())
+        ).add_done_callback(self._log_exception)
+
+    @asyncio.coroutine
+    def _process_response(self, crawler, response):
+        request = response.request
+        failed = isinstance(response, BaseCrawlException)
+        try:
+            # put new requests to queue
+            yield from self._put_requests(
+                # process response by crawler
+                self.response_callback(
+                    crawler,
+                    # pass response to middlewares
+                    self._resp_middlewares(response, crawler),
+                ),
+                parent=request,
+            )
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if request in self.failed_requests:
+                self.failed_requests.discard(request)
+                failed = True
+            yield from self._done_requests(request, failed)
+
+    @asyncio.coroutine
+    def _done_requests(self, request, failed):
+        if failed and hasattr(self.queue, 'retry_requests'):
+            yield from self.queue.retry_requests(request)
+        elif hasattr(self.queue, 'ack_requests'):
+            # request is done, remove it from in-flight requests of the queue
+            yield from self.queue.ack_requests(request)
+
+    def _exception_middlewares(self, exception, crawler):
+        if exception.request is not None:
+            self.failed_requests.add(exception.request)
+        return super(CraigsListPomp, self)._exception_middlewares(
+            exception, crawler,
+        )
+
+    def _log_exception(self, future):
+        if future.exception():
+            log.error(
+                "Exception on response processing",
+                exc_info=future.exception(),
+            )
+
+    @asyncio.coroutine
+    def process_requests(self, requests, crawler):
+
+        # execute requests by downloader
+        for response in self.downloader.process(
+                # process requests by middlewares
+                self._req_middlewares(requests, crawler), crawler):
+
+            if response is None:
+                # response was rejected by middlewares
+                pass
+
+            elif isinstance(response, Planned):
+                response.add_done_callback(
+                    partial(self._on_response, crawler)
+                )
+            else:
+                yield from self._process_response(crawler, response)
+
+    @asyncio.coroutine
+    def _put_requests(self, requests, request_done=True, parent=None):
+
+        @asyncio.coroutine
+        def _put(items):
+
+            # put all child requests of the response to the queue at once
+            try:
+                items = list(items or ())
+                if items:
+                    self.in_progress += len(items)
+                    start = time.monotonic()
+                    yield from self.queue.put_requests(items)
+                    self.statsd.histogram(
+                        get_stage_key('enqueue', parent),
+                        (time.monotonic() - start) * 1000,
+                    )
+            finally:
+                if request_done:
+                    yield from self._request_done()
+
+        if isinstance(requests, Planned):
+            future = asyncio.Future()
+
+            def _(r):
+                asyncio.ensure_future(
+                    _put(r.result())
+                ).add_done_callback(
+                    future.set_result
+                )
+
+            requests.add_done_callback(_)
+
+            # raise exception of `_put`
+            (yield from future).result()
+        else:
+            yield from _put(requests)
+
+    def _process_items(self, crawler, items):
+        # the same as pomp engine `_process_items` with pipelines timing
+        for item in items:
+
+            if not item:
+                continue
+
+            # yield item as request
+            if isinstance(item, BaseHttpRequest) or isstring(item):
+                yield item
+                continue
+
+            for pipe in self.pipelines:
+                start = time.monotonic()
+                result = pipe.process(crawler, item)
+                self.statsd.histogram(
+                    get_stage_key(
+                        'pipeline_%s' % type(pipe).__name__.lower(),
+                        city_code=getattr(item, 'city_code', None),
+                        request_type='item',
+                    ),
+                    (time.monotonic() - start) * 1000,
+                )
+
+                # item filtered - stop pipe processing
+                if not result:
+                    log.debug(
+                        "Stop item processing. Pipeline %s on %s",
+                        pipe, item,
+                    )
+                    break
+                item = result
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timezone
 from pomp.contrib.item import Item, Field
 
 
@@ -19,7 +19,7 @@ class CraigsListItem(Item):
         super(CraigsListItem, self).__init__(*args, **kwargs)
 
         if not self.ts_created:
-            self.ts_created = datetime.now()
+            self.ts_created = datetime.now(timezone.utc)
 
     def __str__(self):
         return 'city_code: {s.city_code} url: {s.url}' \
@@ -29,3 +29,15 @@ class CraigsListItem(Item):
                 s=self,
                 photos_count=len(self.photos) if self.photos else 'n/a',
             )
+
+
+class UnchangedItem(Item):
+    """Item page not modified since the last crawl"""
+
+    url = Field()
+    city_code = Field()
+    session_id = Field()
+
+    def __str__(self):
+        return 'city_code: {s.city_code} url: {s.url} unchanged' \
+            .format(s=self)
@@ -1,3 +1,4 @@
+import os
 import sys
 import signal
 import functools
@@ -7,22 +8,27 @@ from collections import defaultdict
 import asyncio
 import argparse
 import aioredis
-import aiohttp
 
-from pomp.contrib.asynciotools import AioPomp, AioConcurrentCrawler
+from pomp.core.base import BaseCrawlException
 
 from craigslist.log import LOGGING
-from craigslist.utils import (
-    get_redis_endpoint, get_statsd_client, METRIC_QUEUE_SIZE_KEY,
-)
+from craigslist.utils import get_redis_endpoint
 from craigslist.queue import RedisQueue
+from craigslist.engine import CraigsListPomp
 from craigslist.pipeline import (
-    ItemLogPipeline, KafkaPipeline, MetricsPipeline,
+    ItemLogPipeline, AioKafkaPipeline, MetricsPipeline,
+)
+from craigslist.crawler import (
+    CraigsListCrawler, CraigsListConcurrentCrawler, ListRequest, ItemRequest,
 )
-from craigslist.crawler import CraigsListCrawler, ListRequest, ItemRequest
-from craigslist.downloader import AiohttpDownloader, AiohttpResponse
+from craigslist.downloader import AiohttpDownloader
+from craigslist.cache import ResponseCache, CachingDownloader
 from craigslist.middleware import LogExceptionMiddleware, MetricsMiddleware
 from craigslist.item import CraigsListItem
+from craigslist.validators import MemoryValidatorStore, RedisValidatorStore
+from craigslist.profiler import profile_on_signal
+from craigslist.watchdog import LoopWatchdog
+from craigslist.cluster import ClusterNode
 
 
 @asyncio.coroutine
@@ -34,29 +40,75 @@ def get_redis(loop=None):
     )
 
 
+def get_downloader(cache=None, cache_ttl=None, cache_size=1024,
+                   replay=False, **kwargs):
+    """Downloader with response cache in `cache` directory if defined
+
+    :param cache_size: max size of the cache in megabytes
+    """
+    if cache is None:
+        return AiohttpDownloader(**kwargs)
+    return CachingDownloader(
+        cache=ResponseCache(
+            cache, ttl=cache_ttl, max_size=cache_size * 1024 * 1024,
+        ),
+        replay=replay,
+        **kwargs
+    )
+
+
 @asyncio.coroutine
-def start_crawler(loop):
+def fetch(downloader, request):
+    planned = next(downloader.get((request, )))
+    future = asyncio.Future()
+    planned.add_done_callback(lambda r: future.set_result(r.result()))
+    response = yield from future
+    if isinstance(response, BaseCrawlException):
+        raise response.exception
+    return response
+
+
+@asyncio.coroutine
+def start_crawler(
+        loop, concurrency=30, host_concurrency=8, host_rate=2.0,
+        parse_executor='process', parse_workers=None, kafka_buffer=10000,
+        validators='redis', cache=None, cache_ttl=None, cache_size=1024,
+        replay=False, profile_seconds=30, max_loop_lag=0.2):
+    # sampling profiler of the process, started by `manage profile <pid>`
+    profile_on_signal(loop, profile_seconds)
+
     redis = yield from get_redis(loop)
-    queue = RedisQueue(redis)
+    queue = RedisQueue(redis, prefetch_count=concurrency)
 
-    # TODO only one instance of the crawler must gather queue size
-    # start gather queue size metrics
-    statsd = get_statsd_client()
+    # validators of downloaded item pages to skip unchanged pages
+    validator_store = None
+    if validators == 'redis':
+        validator_store = RedisValidatorStore(redis)
+    elif validators == 'memory':
+        validator_store = MemoryValidatorStore()
 
+    # keep lease of taken requests, requests of crashed or killed crawlers
+    # are returned to the queue by the cluster leader
     @asyncio.coroutine
-    def _publish_queue_size_metric():
-        yield from asyncio.sleep(5.0)
-        statsd.gauge(
-            METRIC_QUEUE_SIZE_KEY,
-            (yield from queue.qsize())
-        )
-        asyncio.Task(_publish_queue_size_metric(), loop=loop)
-    asyncio.Task(_publish_queue_size_metric(), loop=loop)
+    def _keep_lease():
+        yield from queue.renew_lease()
+        yield from asyncio.sleep(queue.lease_timeout / 3.0)
+        asyncio.Task(_keep_lease(), loop=loop)
+    asyncio.Task(_keep_lease(), loop=loop)
 
     # configure engine
-    pomp = AioPomp(
-        downloader=AiohttpDownloader(
-            max_concurent_request_count=3,
+    pomp = CraigsListPomp(
+        downloader=get_downloader(
+            cache=cache,
+            cache_ttl=cache_ttl,
+            cache_size=cache_size,
+            replay=replay,
+            max_concurent_request_count=concurrency,
+            host_window={
+                'maximum': host_concurrency,
+                'rate': host_rate,
+            },
+            validator_store=validator_store,
         ),
         queue=queue,
         middlewares=(
@@ -65,23 +117,37 @@ def start_crawler(loop):
         ),
         pipelines=(
             ItemLogPipeline(),
-            KafkaPipeline(),
+            AioKafkaPipeline(max_buffer_size=kafka_buffer),
             MetricsPipeline(),
         ),
     )
 
+    # measure event loop lag, throttle the engine while the loop is slow
+    asyncio.Task(
+        LoopWatchdog(loop, engine=pomp, threshold=max_loop_lag).run(),
+        loop=loop,
+    )
+
+    # heartbeat of the crawler, elected leader publishes cluster metrics
+    # and reclaims requests of expired leases
+    node = ClusterNode(redis, queue, engine=pomp)
+    asyncio.Task(node.run(), loop=loop)
+
     # start
-    yield from pomp.pump(AioConcurrentCrawler(
+    yield from pomp.pump(CraigsListConcurrentCrawler(
         worker_class=CraigsListCrawler,
-        pool_size=2,
+        pool_size=parse_workers,
+        executor=parse_executor,
     ))
+    yield from node.leave()
     redis.close()
 
 
 @asyncio.coroutine
-def start_session(loop, session_id, path):
+def start_session(loop, session_id, path, weight=1):
     redis = yield from get_redis(loop)
     queue = RedisQueue(redis)
+    yield from queue.set_weight(session_id, weight)
     url_tmpl = "https://{city_code}.craigslist.org/"
     yield from queue.put_requests([
         ListRequest(
@@ -109,20 +175,24 @@ def clear_queue(loop):
 
 
 @asyncio.coroutine
-def check_xpath(loop, url):
+def check_xpath(loop, url, cache=None, replay=False):
     crawler = CraigsListCrawler()
+    downloader = get_downloader(cache=cache, replay=replay)
+    downloader.prepare()
+    try:
+        yield from _check_xpath(crawler, downloader, url)
+    finally:
+        downloader.stop()
+
 
+@asyncio.coroutine
+def _check_xpath(crawler, downloader, url):
     print('fetch and parse list request: %s...' % url)
-    r = yield from aiohttp.get(url)
-    body = yield from r.text()
-    response = AiohttpResponse(
-        request=ListRequest(
-            url=url,
-            session_id='xpath-check',
-            city_code=urllib.parse.urlparse(url).netloc.split('.')[0],
-        ),
-        body=body,
-    )
+    response = yield from fetch(downloader, ListRequest(
+        url=url,
+        session_id='xpath-check',
+        city_code=urllib.parse.urlparse(url).netloc.split('.')[0],
+    ))
     result_by_type = defaultdict(list)
     for item in crawler.extract_items(response):
         result_by_type[type(item)].append(item)
@@ -138,12 +208,7 @@ def check_xpath(loop, url):
     request = item_requests[0]
 
     print('\nfetch and parse item request %s...' % request.url)
-    r = yield from aiohttp.get(request.url)
-    body = yield from r.text()
-    response = AiohttpResponse(
-        request=request,
-        body=body,
-    )
+    response = yield from fetch(downloader, request)
     result_by_type = defaultdict(list)
     for item in crawler.extract_items(response):
         result_by_type[type(item)].append(item)
@@ -165,6 +230,17 @@ def check_xpath(loop, url):
     print('\nxpath: ACTUAL')
 
 
+def add_cache_arguments(parser):
+    parser.add_argument(
+        '--cache', metavar='PATH', default=None,
+        help='directory of on-disk response cache',
+    )
+    parser.add_argument(
+        '--replay', action='store_true',
+        help='serve all pages from the response cache without network',
+    )
+
+
 def main():
 
     import logging.config
@@ -172,16 +248,74 @@ def main():
 
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest="command")
-    subparsers.add_parser('crawl')
+    crawl_parser = subparsers.add_parser('crawl')
+    crawl_parser.add_argument(
+        '--concurrency', type=int, default=30,
+        help='max number of in-flight requests for all hosts',
+    )
+    crawl_parser.add_argument(
+        '--host-concurrency', type=int, default=8,
+        help='max concurrency window of one host',
+    )
+    crawl_parser.add_argument(
+        '--host-rate', type=float, default=2.0,
+        help='max requests per second to one host',
+    )
+    crawl_parser.add_argument(
+        '--parse-executor', choices=('process', 'thread'), default='process',
+        help='parse pages in process or thread pool',
+    )
+    crawl_parser.add_argument(
+        '--parse-workers', type=int, default=None,
+        help='parse pool size, by default number of cpu cores',
+    )
+    crawl_parser.add_argument(
+        '--kafka-buffer', type=int, default=10000,
+        help='number of items buffered for kafka before crawling slows down',
+    )
+    crawl_parser.add_argument(
+        '--validators', choices=('redis', 'memory', 'none'), default='redis',
+        help='where to keep etag, last-modified and body hash of item pages'
+             ' to skip unchanged items, `none` to download and parse all',
+    )
+    add_cache_arguments(crawl_parser)
+    crawl_parser.add_argument(
+        '--cache-ttl', type=int, default=None,
+        help='seconds while cached page is used, by default forever',
+    )
+    crawl_parser.add_argument(
+        '--cache-size', type=int, default=1024,
+        help='max size of the response cache in megabytes',
+    )
+    crawl_parser.add_argument(
+        '--profile-seconds', type=int, default=30,
+        help='duration of profiling started by SIGUSR1 (`manage profile`)',
+    )
+    crawl_parser.add_argument(
+        '--max-loop-lag', type=float, default=0.2,
+        help='seconds of event loop lag to log the blocking stack, when'
+             ' the lag lasts concurrency and dequeue rate are lowered',
+    )
 
     session_parser = subparsers.add_parser('session')
     session_parser.add_argument('session_id')
     session_parser.add_argument('path')
+    session_parser.add_argument(
+        '--weight', type=int, default=1,
+        help='share of the session in queue round-robin between sessions',
+    )
 
     subparsers.add_parser('clearqueue')
 
+    profile_parser = subparsers.add_parser(
+        'profile',
+        help='profile running crawler, reports are written to logs/',
+    )
+    profile_parser.add_argument('pid', type=int)
+
     check_xpath_parser = subparsers.add_parser('check-xpath')
     check_xpath_parser.add_argument('url')
+    add_cache_arguments(check_xpath_parser)
 
     dataview_parser = subparsers.add_parser('dataview')
     dataview_parser.add_argument(
@@ -189,11 +323,15 @@ def main():
     )
 
     args = parser.parse_args()
+    if getattr(args, 'replay', False) and not args.cache:
+        parser.error('--replay requires --cache')
 
     if args.command == 'dataview':
         # dive in django management system
         from django.core.management import execute_from_command_line
         execute_from_command_line(sys.argv[1:])
+    elif args.command == 'profile':
+        os.kill(args.pid, signal.SIGUSR1)
     else:
         # asyncio other project stuff
         loop = asyncio.get_event_loop()
@@ -210,13 +348,32 @@ def main():
 
         task = None
         if args.command == 'crawl':
-            task = start_crawler(loop)
+            task = start_crawler(
+                loop,
+                concurrency=args.concurrency,
+                host_concurrency=args.host_concurrency,
+                host_rate=args.host_rate,
+                parse_executor=args.parse_executor,
+                parse_workers=args.parse_workers,
+                kafka_buffer=args.kafka_buffer,
+                validators=args.validators,
+                cache=args.cache,
+                cache_ttl=args.cache_ttl,
+                cache_size=args.cache_size,
+                replay=args.replay,
+                profile_seconds=args.profile_seconds,
+                max_loop_lag=args.max_loop_lag,
+            )
         elif args.command == 'session':
-            task = start_session(loop, args.session_id, args.path)
+            task = start_session(
+                loop, args.session_id, args.path, weight=args.weight,
+            )
         elif args.command == 'clearqueue':
             task = clear_queue(loop)
         elif args.command == 'check-xpath':
-            task = check_xpath(loop, args.url)
+            task = check_xpath(
+                loop, args.url, cache=args.cache, replay=args.replay,
+            )
 
         if task:
             try:
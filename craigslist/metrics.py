@@ -0,0 +1,247 @@
+import time
+import random
+import socket
+import logging
+import urllib.parse
+
+
+log = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """HDR-style histogram with log-linear buckets
+
+    Values are counted in `unit` steps, above `2 ** precision` units the
+    bucket width grows with the value, relative error of percentiles is
+    within `2 ** (1 - precision)` (~1.6% by default).
+
+    :param precision: number of significant bits of bucket values
+    :param unit: resolution of values
+    """
+
+    def __init__(self, precision=7, unit=0.001):
+        self.precision = precision
+        self.unit = unit
+        # (shift, mantissa) -> count
+        self.buckets = {}
+        self.count = 0
+        self.max = 0
+
+    def _bucket(self, value):
+        units = int(value / self.unit)
+        shift = max(0, units.bit_length() - self.precision)
+        return shift, units >> shift
+
+    def record(self, value):
+        bucket = self._bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Highest value of the bucket holding `percent` of values"""
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for shift, mantissa in sorted(self.buckets):
+            seen += self.buckets[(shift, mantissa)]
+            if seen >= rank:
+                break
+        return min(((mantissa + 1) << shift) * self.unit, self.max)
+
+
+class StatsD(object):
+    """Aggregating statsd client
+
+    Metrics are accumulated in the process - counters are summed, gauges
+    keep the last value, timings keep up to `max_samples` random samples
+    per key - and are sent every `interval` seconds as multi-metric UDP
+    packets not larger than `max_packet_size`.
+
+    Histograms count values by :class:`Histogram` over
+    `histogram_interval` seconds and are sent as `<key>.p50`, `<key>.p95`,
+    `<key>.p99` gauges (timers would be aggregated by statsd once more)
+    and `<key>.count` counter. Statsd keeps the last gauge of its flush
+    window, so the interval must not be shorter than the statsd one,
+    otherwise percentiles describe only the last part of the window.
+
+    With event loop metrics are flushed by the loop timers, without it
+    (`sync` clients of management commands) by the first metric or
+    :meth:`tick` after the interval. Remaining metrics are sent by
+    :meth:`close`, the client can be used after it.
+
+    :param addr: statsd address as `udp://host:port`
+    :param interval: flush interval in seconds
+    :param histogram_interval: flush interval of histograms in seconds,
+                               flush interval of statsd by default
+    :param max_packet_size: max UDP payload, by default fits ethernet MTU
+    :param max_samples: max timing samples of one key per interval
+    :param loop: event loop to schedule flushes, None for sync client
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(
+            self, addr, interval=1.0, max_packet_size=1432, max_samples=1000,
+            loop=None, histogram_interval=10.0):
+        parsed = urllib.parse.urlparse(addr)
+        try:
+            self.addr = (parsed.hostname, parsed.port)
+        except ValueError:
+            # not configured endpoint, metrics are dropped
+            self.addr = (parsed.hostname, None)
+        self.interval = interval
+        self.histogram_interval = histogram_interval
+        self.max_packet_size = max_packet_size
+        self.max_samples = max_samples
+        self.loop = loop
+
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+        # number of all timing samples by key, sample rate is sent to
+        # statsd when only part of them is kept
+        self.timing_counts = {}
+        self.histograms = {}
+
+        self.sock = None
+        self.handle = None
+        self.histogram_handle = None
+        self.last_flush = self.last_histogram_flush = time.monotonic()
+
+    def incr(self, key, value=1):
+        self.counters[key] = self.counters.get(key, 0) + value
+        self._schedule()
+
+    def decr(self, key, value=1):
+        self.incr(key, -value)
+
+    def gauge(self, key, value):
+        self.gauges[key] = value
+        self._schedule()
+
+    def timing(self, key, value):
+        """Add timing sample in milliseconds"""
+        count = self.timing_counts.get(key, 0) + 1
+        self.timing_counts[key] = count
+        samples = self.timings.setdefault(key, [])
+        if len(samples) < self.max_samples:
+            samples.append(value)
+        else:
+            # reservoir sampling
+            i = random.randrange(count)
+            if i < self.max_samples:
+                samples[i] = value
+        self._schedule()
+
+    def histogram(self, key, value):
+        """Add value in milliseconds to the histogram of the key"""
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.record(value)
+        if self.loop is None:
+            self.tick()
+        elif self.histogram_handle is None:
+            self.histogram_handle = self.loop.call_later(
+                self.histogram_interval, self.flush_histograms,
+            )
+
+    def tick(self):
+        """Flush sync client when the interval is over, must be called by
+        idle loops of management commands"""
+        now = time.monotonic()
+        if now - self.last_flush >= self.interval:
+            self.flush()
+        if now - self.last_histogram_flush >= self.histogram_interval:
+            self.flush_histograms()
+
+    def _schedule(self):
+        if self.loop is None:
+            self.tick()
+        elif self.handle is None:
+            self.handle = self.loop.call_later(self.interval, self.flush)
+
+    def get_lines(self):
+        lines = []
+        for key, value in self.counters.items():
+            lines.append('%s:%s|c' % (key, value))
+        for key, value in self.gauges.items():
+            lines.append('%s:%s|g' % (key, value))
+        for key, samples in self.timings.items():
+            rate = len(samples) / self.timing_counts[key]
+            suffix = '|ms' if rate == 1 else '|ms|@%.6f' % rate
+            for value in samples:
+                lines.append('%s:%s%s' % (key, value, suffix))
+        return lines
+
+    def get_histogram_lines(self):
+        lines = []
+        for key, histogram in self.histograms.items():
+            for percent in self.PERCENTILES:
+                lines.append('%s.p%s:%.3f|g' % (
+                    key, percent, histogram.percentile(percent),
+                ))
+            lines.append('%s.count:%s|c' % (key, histogram.count))
+        return lines
+
+    def get_packets(self, lines):
+        packets = []
+        packet = b''
+        for line in lines:
+            line = line.encode()
+            if packet and len(packet) + 1 + len(line) > self.max_packet_size:
+                packets.append(packet)
+                packet = b''
+            packet = packet + b'\n' + line if packet else line
+        if packet:
+            packets.append(packet)
+        return packets
+
+    def flush(self):
+        """Send accumulated counters, gauges and timings"""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.last_flush = time.monotonic()
+
+        lines = self.get_lines()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+        self.timing_counts = {}
+        self._send(lines)
+
+    def flush_histograms(self):
+        """Send percentiles of accumulated histograms"""
+        if self.histogram_handle is not None:
+            self.histogram_handle.cancel()
+            self.histogram_handle = None
+        self.last_histogram_flush = time.monotonic()
+
+        lines = self.get_histogram_lines()
+        self.histograms = {}
+        self._send(lines)
+
+    def _send(self, lines):
+        if not lines:
+            return
+
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+        for packet in self.get_packets(lines):
+            try:
+                self.sock.sendto(packet, self.addr)
+            except (OSError, TypeError) as e:
+                # metrics must not break the crawler
+                log.debug("[StatsD] Failed to send metrics: %s", e)
+
+    def close(self):
+        self.flush()
+        self.flush_histograms()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -1,21 +1,137 @@
 import time
+import asyncio
 import logging
+from functools import partial
+from collections import deque
 
-from kafka import KafkaConsumer, KafkaProducer
+from kafka import KafkaConsumer, KafkaProducer, TopicPartition
+from kafka.errors import KafkaError
+from aiokafka import AIOKafkaProducer
 
 from pomp.core.base import BasePipeline
 from pomp.contrib.pipelines import CsvPipeline
 
-from craigslist.item import CraigsListItem
+from craigslist.item import CraigsListItem, UnchangedItem
 from craigslist.utils import (
     get_kafka_endpoints, get_statsd_client, MsgPackSerializer,
-    METRIC_ITEMS_PARSED_KEY,
+    METRIC_ITEMS_PARSED_KEY, METRIC_ITEMS_UNCHANGED_KEY,
+    METRIC_ITEMS_SENT_KEY, METRIC_ITEMS_SEND_FAILED_KEY,
 )
 
 
 log = logging.getLogger(__name__)
 
 
+# errors of clients connected to not ready brokers
+KAFKA_NOT_READY_ERRORS = (KafkaError, ConnectionError)
+
+
+def iter_backoff(ready_timeout, delay=0.1, max_delay=2.0):
+    """Exponential backoff delays which fit in `ready_timeout` seconds"""
+    deadline = time.time() + ready_timeout
+    while time.time() + delay <= deadline:
+        yield delay
+        delay = min(delay * 2, max_delay)
+
+
+def connect_kafka(client_class, *args, ready_timeout=30, **kwargs):
+    """Create kafka client as soon as brokers are ready, probe them with
+    exponential backoff until `ready_timeout` in seconds
+
+    Blocking, for sync tools (dbimport, dump_data), the event loop uses
+    :func:`probe_kafka`.
+    """
+    for delay in iter_backoff(ready_timeout):
+        try:
+            return client_class(*args, **kwargs)
+        except KAFKA_NOT_READY_ERRORS as e:
+            log.debug("Kafka is not ready (%s), retry in %ss", e, delay)
+            time.sleep(delay)
+    return client_class(*args, **kwargs)
+
+
+@asyncio.coroutine
+def probe_kafka(connect, ready_timeout=30):
+    """Return result of `connect` coroutine as soon as brokers are ready,
+    probe them with exponential backoff until `ready_timeout` in seconds
+    without blocking the event loop"""
+    for delay in iter_backoff(ready_timeout):
+        try:
+            return (yield from connect())
+        except KAFKA_NOT_READY_ERRORS as e:
+            log.debug("Kafka is not ready (%s), retry in %ss", e, delay)
+            yield from asyncio.sleep(delay)
+    return (yield from connect())
+
+
+def iter_batches(
+        consumer, max_records=1000, max_bytes=1024 * 1024,
+        max_wait_ms=500, clock=time.time):
+    """Poll kafka consumer and yield lists of records
+
+    Batch is yielded as soon as it holds `max_records` records or
+    `max_bytes` bytes of serialized values (exceeded by one poll at most)
+    or `max_wait_ms` passed since the batch start, so empty list is
+    yielded after `max_wait_ms` without new records.
+
+    :param consumer: kafka consumer or any object with the same `poll`
+    :param clock: time function in seconds
+    """
+    while True:
+        batch, size = [], 0
+        deadline = clock() + max_wait_ms / 1000.0
+        while len(batch) < max_records and size < max_bytes:
+            timeout_ms = int((deadline - clock()) * 1000)
+            if timeout_ms <= 0:
+                break
+            polled = consumer.poll(
+                timeout_ms=timeout_ms, max_records=max_records - len(batch),
+            )
+            for records in polled.values():
+                for record in records:
+                    batch.append(record)
+                    size += record.serialized_value_size
+        yield batch
+
+
+def assign_partitions(consumer, topic, worker, offsets=None):
+    """Assign to the consumer partitions of the topic which belong to the
+    worker and are not assigned yet, return their ids
+
+    Partition belongs to worker `(index, count)` when its id modulo `count`
+    is `index`, so partitions added to the topic later are shared by the
+    workers without coordination. Positions of already assigned partitions
+    are kept, new ones are consumed from `offsets` or from the earliest
+    item.
+
+    :param worker: tuple of worker index and number of workers
+    :param offsets: dict of partition id to offset of the next item
+    """
+    index, count = worker
+    # fetch metadata of all topics
+    consumer.topics()
+    partitions = set(
+        p for p in consumer.partitions_for_topic(topic) or ()
+        if p % count == index
+    )
+    assigned = consumer.assignment()
+    new = sorted(partitions - set(tp.partition for tp in assigned))
+    if not new:
+        return new
+
+    positions = [(tp, consumer.position(tp)) for tp in assigned]
+    consumer.assign([
+        TopicPartition(topic, p)
+        for p in sorted(partitions | set(tp.partition for tp in assigned))
+    ])
+    for tp, offset in positions:
+        consumer.seek(tp, offset)
+    for partition in new:
+        if partition in (offsets or {}):
+            consumer.seek(TopicPartition(topic, partition), offsets[partition])
+    return new
+
+
 class ItemLogPipeline(BasePipeline):
 
     def process(self, crawler, item):
@@ -29,7 +145,10 @@ class MetricsPipeline(BasePipeline):
         self.statsd = get_statsd_client()
 
     def process(self, crawler, item):
-        self.statsd.incr(METRIC_ITEMS_PARSED_KEY)
+        if isinstance(item, UnchangedItem):
+            self.statsd.incr(METRIC_ITEMS_UNCHANGED_KEY)
+        else:
+            self.statsd.incr(METRIC_ITEMS_PARSED_KEY)
         return item
 
     def close(self, crawler):
@@ -37,66 +156,215 @@ class MetricsPipeline(BasePipeline):
 
 
 class KafkaPipeline(BasePipeline):
+    """Send items to kafka
+
+    Producer is created by the background task as soon as kafka is ready,
+    items processed before are buffered. :meth:`flush` waits for the
+    producer, :meth:`stop` connects to kafka in place if it is not ready
+    yet to send buffered items.
+
+    :param linger_ms: time to wait for more items to fill a batch
+    :param batch_size: max size of the batch in bytes per partition
+    :param compression_type: `gzip`, `snappy`, `lz4`, `zstd` or None
+    :param acks: number of broker acknowledgments, 0, 1 or `all`
+    :param ready_timeout: time in seconds to wait for kafka to be ready
+    :param producer_class: kafka producer class
+    """
     TOPIC = 'craigslist'
     SERIALIZER = MsgPackSerializer()
 
-    def start(self, crawler):
+    def __init__(
+            self, linger_ms=50, batch_size=256 * 1024,
+            compression_type='lz4', acks=1, ready_timeout=30,
+            producer_class=KafkaProducer):
+        self.producer_config = {
+            'linger_ms': linger_ms,
+            'batch_size': batch_size,
+            'compression_type': compression_type,
+            'acks': acks,
+        }
+        self.ready_timeout = ready_timeout
+        self.producer_class = producer_class
 
-        # TODO: remove this hack
-        # HACK
-        log.debug("Wait 5s to allow kafka node to be ready")
-        time.sleep(5)
+    def start(self, crawler):
+        self.statsd = get_statsd_client()
+        self.loop = asyncio.get_event_loop()
+        self.producer = None
+        self.buffer = deque()
 
         endpoints = list(get_kafka_endpoints())
-        log.debug("Connect to kafka as producer - %s", endpoints)
+        log.debug(
+            "Connect to kafka as producer - %s %s",
+            endpoints, self.producer_config,
+        )
         if not endpoints:
             raise RuntimeError("Kafka endpoints not defined")
-        self.producer = KafkaProducer(bootstrap_servers=endpoints)
+        self.create_producer = partial(
+            self.producer_class,
+            bootstrap_servers=endpoints,
+            **self.producer_config
+        )
+        self.connecting = asyncio.ensure_future(self._connect())
 
-    def process(self, crawler, item):
+    @asyncio.coroutine
+    def _connect(self):
+        @asyncio.coroutine
+        def connect():
+            # kafka-python client connects to brokers in constructor
+            return (yield from self.loop.run_in_executor(
+                None, self.create_producer,
+            ))
+        self._set_producer((yield from probe_kafka(
+            connect, ready_timeout=self.ready_timeout,
+        )))
+
+    def _set_producer(self, producer):
+        self.producer = producer
+        while self.buffer:
+            self._send(self.buffer.popleft())
+
+    # delivery callbacks are called by the producer thread
+    def _on_send_success(self, metadata):
+        self.loop.call_soon_threadsafe(
+            self.statsd.incr, METRIC_ITEMS_SENT_KEY,
+        )
+
+    def _on_send_error(self, exception):
+        log.error("Failed to send item to kafka: %s", exception)
+        self.loop.call_soon_threadsafe(
+            self.statsd.incr, METRIC_ITEMS_SEND_FAILED_KEY,
+        )
+
+    def _send(self, item):
         self.producer.send(
             self.TOPIC,
             self.SERIALIZER.dumps(item),
+        ).add_callback(
+            self._on_send_success,
+        ).add_errback(
+            self._on_send_error,
         )
+
+    def process(self, crawler, item):
+        if isinstance(item, UnchangedItem):
+            # stored row of the item is still actual
+            return item
+        if self.producer is None:
+            self.buffer.append(item)
+        else:
+            self._send(item)
         return item
 
+    @asyncio.coroutine
+    def flush(self):
+        """Wait for the producer and send buffered items"""
+        yield from asyncio.shield(self.connecting)
+
     def stop(self, crawler):
+        if self.producer is None:
+            self.connecting.cancel()
+            self._set_producer(connect_kafka(
+                self.create_producer, ready_timeout=self.ready_timeout,
+            ))
         self.producer.flush()
         self.producer.close()
 
+    @classmethod
+    def get_partitions(cls, topic=None):
+        """Sorted partition ids of the topic"""
+        topic = topic or cls.TOPIC
+        endpoints = list(get_kafka_endpoints())
+        if not endpoints:
+            raise RuntimeError("Kafka endpoints not defined")
+
+        consumer = connect_kafka(KafkaConsumer, bootstrap_servers=endpoints)
+        # fetch metadata of all topics
+        consumer.topics()
+        partitions = sorted(consumer.partitions_for_topic(topic) or ())
+        consumer.close()
+        return partitions
+
     @classmethod
     def dump_data(
             cls, topic=None, timeout=None, poll_timeout=None,
-            enable_auto_commit=False):
+            enable_auto_commit=False, partitions=None, offsets=None,
+            records=False, rows=False, max_records=1000,
+            max_bytes=1024 * 1024, worker=None, partitions_refresh=60):
+        """Consume items of the topic
 
-        # TODO: remove this hack
-        # HACK
-        log.debug("Wait 5s to allow kafka node to be ready")
-        time.sleep(5)
+        Items are yielded one by one until no new items for `timeout` ms or
+        by batches (see :func:`iter_batches`) if `poll_timeout` is set.
+
+        :param partitions: consume only these partition ids of the topic,
+                           all partitions by default
+        :param offsets: dict of partition id to offset of the next item to
+                        consume, other partitions are consumed from the
+                        earliest item
+        :param records: yield kafka records with partition and offset
+                        instead of items
+        :param rows: decode items to tuples of values ordered as
+                     `SERIALIZER.FIELDS` instead of dicts
+        :param max_records: max number of items in the batch
+        :param max_bytes: max size of the batch
+        :param worker: consume partitions of the worker `(index, count)`
+                       (see :func:`assign_partitions`) instead of
+                       `partitions`, with `poll_timeout` partitions added
+                       to the topic are assigned every `partitions_refresh`
+                       seconds
+        """
 
         topic = topic or cls.TOPIC
         endpoints = list(get_kafka_endpoints())
-        log.debug("Connect to kafka as consumer - %s", endpoints)
+        log.debug(
+            "Connect to kafka as consumer - %s partitions: %s offsets: %s",
+            endpoints, partitions, offsets,
+        )
         if not endpoints:
             raise RuntimeError("Kafka endpoints not defined")
 
-        consumer = KafkaConsumer(
-            topic,
+        if offsets and partitions is None and worker is None:
+            # only assigned partitions can be seeked
+            partitions = cls.get_partitions(topic)
+        subscribe = partitions is None and worker is None
+
+        consumer = connect_kafka(
+            KafkaConsumer,
+            *([topic] if subscribe else []),
             auto_offset_reset='earliest',
             enable_auto_commit=enable_auto_commit,
-            value_deserializer=cls.SERIALIZER.loads,
+            value_deserializer=(
+                cls.SERIALIZER.loads_row if rows else cls.SERIALIZER.loads
+            ),
             bootstrap_servers=endpoints,
-            consumer_timeout_ms=timeout or -1,
+            consumer_timeout_ms=timeout or -1
         )
+        if worker is not None:
+            assign_partitions(consumer, topic, worker, offsets)
+        elif partitions is not None:
+            consumer.assign([TopicPartition(topic, p) for p in partitions])
+            for partition, offset in (offsets or {}).items():
+                if partition in partitions:
+                    consumer.seek(TopicPartition(topic, partition), offset)
+
+        get_data = (lambda data: data) if records \
+            else (lambda data: data.value)
 
-        # TODO use native kafka-python poll
         if poll_timeout:
-            while True:
-                yield list(data.value for data in consumer)
-                time.sleep(poll_timeout / 1000.0)
+            refreshed = time.time()
+            for batch in iter_batches(
+                    consumer, max_records=max_records, max_bytes=max_bytes,
+                    max_wait_ms=poll_timeout):
+                yield list(get_data(data) for data in batch)
+
+                if worker is not None and \
+                        time.time() - refreshed >= partitions_refresh:
+                    refreshed = time.time()
+                    new = assign_partitions(consumer, topic, worker, offsets)
+                    if new:
+                        log.info("Assigned new partitions %s", new)
         else:
             for data in consumer:
-                yield data.value
+                yield get_data(data)
 
         consumer.close()
 
@@ -109,13 +377,162 @@ class KafkaPipeline(BasePipeline):
 
         for item in cls.dump_data(topic, timeout):
             # we must reinitialize item to restore fields and values ordering
-            csv_pipeline.process(
-                None,
-                CraigsListItem(**dict(
-                    # convert dict byte keys to string keys and use it as
-                    # keywords
-                    (k.decode(), v) for k, v in item.items()
-                ))
-            )
+            csv_pipeline.process(None, CraigsListItem(**item))
 
         csv_pipeline.stop(None)
+
+
+class AioKafkaPipeline(BasePipeline):
+    """Send items to kafka by asyncio producer without blocking the loop
+
+    :meth:`process` only puts the item to the local buffer, items are sent
+    by the background task. When the buffer holds `max_buffer_size` items
+    :meth:`drain` waits until the producer catches up, the engine calls it
+    before taking next request from the queue, so stalled kafka slows down
+    the crawling instead of freezing the event loop or eating memory.
+    :meth:`flush`, awaited by the engine before pipelines are stopped,
+    delivers the rest of items and stops the producer.
+
+    :param max_buffer_size: number of buffered items to apply backpressure
+    :param linger_ms: time to wait for more items to fill a batch
+    :param max_batch_size: max size of the batch in bytes per partition
+    :param compression_type: `gzip`, `snappy`, `lz4` or None
+    :param acks: number of broker acknowledgments, 0, 1 or `all`
+    :param ready_timeout: time in seconds to wait for kafka to be ready
+    :param producer_class: asyncio kafka producer class
+    """
+    TOPIC = 'craigslist'
+    SERIALIZER = MsgPackSerializer()
+
+    def __init__(
+            self, max_buffer_size=10000, linger_ms=50,
+            max_batch_size=256 * 1024, compression_type='lz4', acks=1,
+            ready_timeout=30, producer_class=AIOKafkaProducer):
+        self.max_buffer_size = max_buffer_size
+        self.producer_config = {
+            'linger_ms': linger_ms,
+            'max_batch_size': max_batch_size,
+            'compression_type': compression_type,
+            'acks': acks,
+        }
+        self.ready_timeout = ready_timeout
+        self.producer_class = producer_class
+
+    def start(self, crawler):
+        self.statsd = get_statsd_client()
+        self.loop = asyncio.get_event_loop()
+        self.producer = None
+        self.buffer = deque()
+        self.pending = set()
+        self.closing = False
+        self.has_items = asyncio.Event()
+        self.has_space = asyncio.Event()
+        self.has_space.set()
+        self.sender = asyncio.ensure_future(self._send_items())
+        self.sender.add_done_callback(self._on_sender_done)
+
+    @asyncio.coroutine
+    def _start_producer(self):
+        endpoints = list(get_kafka_endpoints())
+        log.debug(
+            "Connect to kafka as asyncio producer - %s %s",
+            endpoints, self.producer_config,
+        )
+        if not endpoints:
+            raise RuntimeError("Kafka endpoints not defined")
+
+        @asyncio.coroutine
+        def connect():
+            producer = self.producer_class(
+                loop=self.loop,
+                bootstrap_servers=endpoints,
+                **self.producer_config
+            )
+            try:
+                yield from producer.start()
+            except KAFKA_NOT_READY_ERRORS:
+                yield from producer.stop()
+                raise
+            return producer
+
+        return (yield from probe_kafka(
+            connect, ready_timeout=self.ready_timeout,
+        ))
+
+    @asyncio.coroutine
+    def _send_items(self):
+        self.producer = yield from self._start_producer()
+        while True:
+            if not self.buffer:
+                if self.closing:
+                    return
+                self.has_items.clear()
+                yield from self.has_items.wait()
+                continue
+
+            item = self.buffer.popleft()
+            # waits only when batches of the producer are full
+            future = yield from self.producer.send(
+                self.TOPIC, self.SERIALIZER.dumps(item),
+            )
+            self.pending.add(future)
+            future.add_done_callback(self._on_send_done)
+
+            if len(self.buffer) < self.max_buffer_size:
+                self.has_space.set()
+
+    def _on_sender_done(self, future):
+        if not future.cancelled() and future.exception():
+            log.error(
+                "Kafka sender is stopped", exc_info=future.exception(),
+            )
+        # do not block waiters of the dead sender
+        self.has_space.set()
+
+    def _on_send_done(self, future):
+        self.pending.discard(future)
+        if future.cancelled() or future.exception():
+            log.error(
+                "Failed to send item to kafka: %s",
+                None if future.cancelled() else future.exception(),
+            )
+            self.statsd.incr(METRIC_ITEMS_SEND_FAILED_KEY)
+        else:
+            self.statsd.incr(METRIC_ITEMS_SENT_KEY)
+
+    def process(self, crawler, item):
+        if isinstance(item, UnchangedItem):
+            return item
+        self.buffer.append(item)
+        self.has_items.set()
+        if len(self.buffer) >= self.max_buffer_size:
+            self.has_space.clear()
+        return item
+
+    @asyncio.coroutine
+    def drain(self):
+        """Wait while the buffer is full"""
+        yield from self.has_space.wait()
+        if self.sender.done() and not self.sender.cancelled():
+            # raise exception of the stopped sender
+            self.sender.result()
+
+    @asyncio.coroutine
+    def flush(self):
+        """Wait until all buffered items are delivered and stop the
+        producer"""
+        # sender exits when the buffer is empty
+        self.closing = True
+        self.has_items.set()
+        yield from asyncio.wait([self.sender])
+        if self.pending:
+            yield from asyncio.wait(list(self.pending))
+        if self.producer is not None:
+            # sends batches of the producer and closes its connections
+            yield from self.producer.stop()
+            self.producer = None
+
+    def stop(self, crawler):
+        self.sender.cancel()
+        if self.producer is not None:
+            log.warning("Kafka producer is not flushed, buffered items lost")
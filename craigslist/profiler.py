@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import signal
+import logging
+import asyncio
+import threading
+from collections import Counter
+
+from craigslist.log import BASE_DIR
+from craigslist.utils import HOSTNAME
+from craigslist.metrics import Histogram
+
+
+log = logging.getLogger(__name__)
+
+
+class SamplingProfiler(object):
+    """Sampling profiler of all threads of the process
+
+    Stacks of all threads are taken by the background thread every
+    `interval` seconds and counted as collapsed stacks -
+    `thread;outer frame;...;inner frame`.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run, name='profiler', daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[
+                        self.format_stack(names.get(ident, ident), frame)
+                    ] += 1
+            self.samples += 1
+
+    @staticmethod
+    def format_stack(thread_name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%s)' % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno,
+            ))
+            frame = frame.f_back
+        stack.append(str(thread_name))
+        return ';'.join(reversed(stack))
+
+
+class LoopMonitor(object):
+    """Event loop lag, duration of callbacks and tasks by coroutine
+
+    Lag is the delay of the timer scheduled every `interval` seconds.
+    While monitor is started every handle run of the process is timed.
+    """
+
+    def __init__(self, loop, interval=0.1):
+        self.loop = loop
+        self.interval = interval
+        self.lag = Histogram()
+        # name -> [calls, total seconds, max seconds]
+        self.callbacks = {}
+        # peak number of tasks by coroutine name
+        self.tasks = Counter()
+        self.handle = None
+        self.original_run = None
+
+    def start(self):
+        self.original_run = asyncio.Handle._run
+        original_run = self.original_run
+        monitor = self
+
+        def _run(handle):
+            start = time.perf_counter()
+            try:
+                original_run(handle)
+            finally:
+                monitor.record_callback(handle, time.perf_counter() - start)
+
+        asyncio.Handle._run = _run
+        self._schedule()
+
+    def stop(self):
+        asyncio.Handle._run = self.original_run
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _schedule(self):
+        self.expected = self.loop.time() + self.interval
+        self.handle = self.loop.call_later(self.interval, self._check)
+
+    def _check(self):
+        self.lag.record(max(0, self.loop.time() - self.expected) * 1000)
+
+        tasks = Counter(
+            get_callback_name(task) for task in all_tasks(self.loop)
+        )
+        for name, count in tasks.items():
+            self.tasks[name] = max(self.tasks[name], count)
+
+        self._schedule()
+
+    def record_callback(self, handle, seconds):
+        name = get_callback_name(handle._callback)
+        stats = self.callbacks.get(name)
+        if stats is None:
+            stats = self.callbacks[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+
+def all_tasks(loop):
+    if hasattr(asyncio.Task, 'all_tasks'):
+        return asyncio.Task.all_tasks(loop)
+    return asyncio.all_tasks(loop)
+
+
+def get_callback_name(callback):
+    """Coroutine name of the task step or the callback name"""
+    task = callback if isinstance(callback, asyncio.Task) \
+        else getattr(callback, '__self__', None)
+    if isinstance(task, asyncio.Task):
+        coro = getattr(task, '_coro', None)
+        return getattr(coro, '__qualname__', None) or repr(coro)
+    return getattr(callback, '__qualname__', None) or repr(callback)
+
+
+def write_report(profiler, monitor, seconds, prefix, top=20):
+    """Write collapsed stacks to `<prefix>.collapsed` (input of
+    flamegraph.pl or speedscope) and text summary to `<prefix>.txt`"""
+    with open(prefix + '.collapsed', 'w') as f:
+        for stack, count in profiler.stacks.most_common():
+            f.write('%s %s\n' % (stack, count))
+
+    own = Counter()
+    inclusive = Counter()
+    for stack, count in profiler.stacks.items():
+        frames = stack.split(';')[1:]
+        if frames:
+            own[frames[-1]] += count
+        for frame in set(frames):
+            inclusive[frame] += count
+    total = sum(profiler.stacks.values()) or 1
+
+    lines = [
+        'profile of %s pid %s for %.1fs, %s samples every %sms' % (
+            HOSTNAME, os.getpid(), seconds, profiler.samples,
+            profiler.interval * 1000,
+        ),
+        '',
+        'top functions by own samples:',
+    ]
+    for frame, count in own.most_common(top):
+        lines.append('  %6.2f%%  %s' % (count * 100.0 / total, frame))
+
+    lines.extend(('', 'top functions by inclusive samples:'))
+    for frame, count in inclusive.most_common(top):
+        lines.append('  %6.2f%%  %s' % (count * 100.0 / total, frame))
+
+    lines.extend((
+        '',
+        'event loop lag: p50 %.1fms p95 %.1fms p99 %.1fms max %.1fms'
+        ' (%s checks)' % (
+            monitor.lag.percentile(50), monitor.lag.percentile(95),
+            monitor.lag.percentile(99), monitor.lag.max, monitor.lag.count,
+        ),
+        '',
+        'longest callbacks:',
+        '  %10s %10s %8s  %s' % ('max ms', 'total ms', 'calls', 'name'),
+    ))
+    longest = sorted(
+        monitor.callbacks.items(), key=lambda i: i[1][2], reverse=True,
+    )
+    for name, (calls, spent, longest_call) in longest[:top]:
+        lines.append('  %10.2f %10.1f %8s  %s' % (
+            longest_call * 1000, spent * 1000, calls, name,
+        ))
+
+    lines.extend(('', 'peak tasks by coroutine:'))
+    for name, count in monitor.tasks.most_common(top):
+        lines.append('  %8s  %s' % (count, name))
+
+    with open(prefix + '.txt', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return prefix + '.collapsed', prefix + '.txt'
+
+
+def get_report_prefix():
+    return os.path.join(BASE_DIR, 'logs', 'profile-%s-%s' % (
+        HOSTNAME, time.strftime('%Y%m%d-%H%M%S'),
+    ))
+
+
+@asyncio.coroutine
+def profile(loop, seconds, prefix=None, interval=0.01):
+    """Profile the process for `seconds`, return paths of the reports"""
+    profiler = SamplingProfiler(interval=interval)
+    monitor = LoopMonitor(loop)
+    log.info("Start profiling for %ss", seconds)
+    profiler.start()
+    monitor.start()
+    try:
+        yield from asyncio.sleep(seconds)
+    finally:
+        monitor.stop()
+        profiler.stop()
+    paths = write_report(
+        profiler, monitor, seconds, prefix or get_report_prefix(),
+    )
+    log.info("Profile reports: %s", ', '.join(paths))
+    return paths
+
+
+def profile_on_signal(loop, seconds, signum=signal.SIGUSR1):
+    """Profile the process for `seconds` on `signum`, signals received
+    while profiling are ignored"""
+    running = []
+
+    def _start():
+        if running:
+            log.info("Profiling is already running")
+            return
+        running.append(asyncio.ensure_future(profile(loop, seconds)))
+        running[0].add_done_callback(lambda f: running.clear())
+
+    loop.add_signal_handler(signum, _start)
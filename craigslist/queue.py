@@ -1,63 +1,451 @@
+import os
+import time
+import uuid
 import logging
-import pickle
 import asyncio
+from collections import deque
 
 from pomp.core.base import BaseQueue
 from pomp.core.utils import iterator
 
+from craigslist.utils import HOSTNAME
+from craigslist.dedup import get_dedup_backend
+from craigslist.crawler import RequestSerializer
+
 
 log = logging.getLogger(__name__)
 
 
-# add to queue only unique requests
-add_new_request_lua_template = """
-if redis.call('sadd', '{set_key}', ARGV[1]) == 1 then
-    return redis.call('rpush', '{queue_key}', ARGV[2]);
-else
-    return nil;
+# shared helpers of the queue scripts
+#
+# requests of each flow (session_id:city_code) are stored in sub-queue per
+# priority `<queue_key>:<flow>:<priority>`, requests are pushed to the left
+# and taken from the right; active flows (with requests) are in the
+# round-robin ring `<queue_key>:flows` and their sizes in `<queue_key>:sizes`,
+# retries of failed requests are counted in `<queue_key>:retries`
+queue_lua_prelude_template = """
+local queue_prefix = '{queue_key}:'
+local flows_key = queue_prefix .. 'flows'
+local sizes_key = queue_prefix .. 'sizes'
+local sessions_key = queue_prefix .. 'sessions'
+local weights_key = queue_prefix .. 'weights'
+local turn_key = queue_prefix .. 'turn'
+local wakeup_key = queue_prefix .. 'wakeup'
+local retries_key = queue_prefix .. 'retries'
+
+local function push(flow, priority, data, to_head)
+    if redis.call('hincrby', sizes_key, flow, 1) == 1 then
+        redis.call('rpush', flows_key, flow)
+    end
+    local key = queue_prefix .. flow .. ':' .. priority
+    if to_head then
+        redis.call('rpush', key, data)
+    else
+        redis.call('lpush', key, data)
+    end
+end
+
+-- processing list entry is `<priority><flow>\\0<data>`
+local function push_entry(entry, to_head)
+    local sep = string.find(entry, '\\0', 2, true)
+    push(
+        string.sub(entry, 2, sep - 1),
+        string.sub(entry, 1, 1),
+        string.sub(entry, sep + 1),
+        to_head
+    )
+end
+
+-- wake up one of the workers blocked on empty queue
+local function wakeup()
+    redis.call('lpush', wakeup_key, 1)
+    redis.call('ltrim', wakeup_key, 0, 0)
 end
 """
 
+# add to queue only unique requests, `is_new` function is defined by
+# dedup backend, ARGV is a flat list of
+# (identity, session_id, flow, priority, data)
+add_new_requests_lua = """
+local added = 0
+for i = 1, #ARGV, 5 do
+    if is_new(ARGV[i], ARGV[i + 1]) then
+        redis.call('hset', sessions_key, ARGV[i + 2], ARGV[i + 1])
+        push(ARGV[i + 2], ARGV[i + 3], ARGV[i + 4], false)
+        added = added + 1
+    end
+end
+if added > 0 then
+    wakeup()
+end
+return added
+"""
+
+# take up to ARGV[1] requests to the processing list of the worker (KEYS[1])
+# by deficit round-robin over active flows, flow quantum is the weight of its
+# session; inside of the flow request with lower priority (of ARGV[2]
+# priorities) goes first
+take_requests_lua = """
+local taken = {}
+local turn_flow = redis.call('hget', turn_key, 'flow')
+local left = tonumber(redis.call('hget', turn_key, 'left') or 0)
+
+while #taken < tonumber(ARGV[1]) do
+    local flow = redis.call('lindex', flows_key, 0)
+    if not flow then
+        break
+    end
+
+    if flow ~= turn_flow then
+        turn_flow = flow
+        left = tonumber(redis.call(
+            'hget', weights_key,
+            redis.call('hget', sessions_key, flow) or ''
+        ) or 1)
+    end
+
+    local data, priority
+    for p = 0, tonumber(ARGV[2]) - 1 do
+        data = redis.call('rpop', queue_prefix .. flow .. ':' .. p)
+        if data then
+            priority = p
+            break
+        end
+    end
+
+    local size = 0
+    if data then
+        local entry = priority .. flow .. '\\0' .. data
+        redis.call('lpush', KEYS[1], entry)
+        table.insert(taken, entry)
+        left = left - 1
+        size = redis.call('hincrby', sizes_key, flow, -1)
+    end
+
+    if size <= 0 then
+        -- flow is empty, remove it from the ring
+        redis.call('lpop', flows_key)
+        redis.call('hdel', sizes_key, flow)
+        turn_flow = false
+    elseif left <= 0 then
+        -- quantum is spent, move flow to the end of the ring
+        redis.call('rpush', flows_key, redis.call('lpop', flows_key))
+        turn_flow = false
+    end
+end
+
+redis.call('hset', turn_key, 'flow', turn_flow or '')
+redis.call('hset', turn_key, 'left', left)
+if #taken > 0 and redis.call('llen', flows_key) > 0 then
+    wakeup()
+end
+return taken
+"""
+
+# return all requests from the processing list (KEYS[1])
+# to the head of their sub-queues
+requeue_requests_lua = """
+local count = 0
+local entry = redis.call('rpop', KEYS[1])
+while entry do
+    push_entry(entry, true)
+    count = count + 1
+    entry = redis.call('rpop', KEYS[1])
+end
+if count > 0 then
+    wakeup()
+end
+return count
+"""
+
+# return requests of workers with expired lease (not in ARGV[1] keys) from
+# their processing lists (ARGV[2] keys) to the head of their sub-queues
+# and unregister workers from KEYS[1] set
+reclaim_requests_lua = """
+local count = 0
+for _, worker in ipairs(redis.call('smembers', KEYS[1])) do
+    if redis.call('exists', ARGV[1] .. worker) == 0 then
+        local processing = ARGV[2] .. worker
+        local entry = redis.call('rpop', processing)
+        while entry do
+            push_entry(entry, true)
+            count = count + 1
+            entry = redis.call('rpop', processing)
+        end
+        redis.call('srem', KEYS[1], worker)
+    end
+end
+if count > 0 then
+    wakeup()
+end
+return count
+"""
+
+
+# remove acknowledged requests from the processing list (KEYS[1]) and their
+# retry counters, ARGV is a flat list of (identity, entry)
+ack_requests_lua = """
+for i = 1, #ARGV, 2 do
+    redis.call('lrem', KEYS[1], 1, ARGV[i + 1])
+    redis.call('hdel', retries_key, ARGV[i])
+end
+"""
+
+# move failed request ARGV[2] from the processing list (KEYS[1]) to the tail
+# of its sub-queue while number of its retries (by identity ARGV[1]) is not
+# more than ARGV[3]; return number of the retry, 0 if the request is dropped
+# and -1 if it is not in the processing list (already reclaimed)
+retry_request_lua = """
+if redis.call('lrem', KEYS[1], 1, ARGV[2]) == 0 then
+    return -1
+end
+local retries = redis.call('hincrby', retries_key, ARGV[1], 1)
+if retries > tonumber(ARGV[3]) then
+    redis.call('hdel', retries_key, ARGV[1])
+    return 0
+end
+push_entry(ARGV[2], false)
+wakeup()
+return retries
+"""
+
 
 class RedisQueue(BaseQueue):
-    set_key = 'all'
+    """Redis queue of unique requests with fair scheduling
+
+    Requests are stored in sub-queues per session and city (flow) and
+    taken by deficit round-robin over flows weighted by session weight
+    (:meth:`set_weight`), so a big session does not starve others. Inside
+    of the flow requests with lower `priority` attribute are taken first,
+    list pages before item pages.
+
+    Taken requests stay in the processing list of the worker until
+    acknowledged by :meth:`ack_requests`. Failed requests are returned to
+    the tail of their sub-queues by :meth:`retry_requests` and dropped
+    after `max_retries` retries. Worker holds a lease renewed by
+    :meth:`renew_lease`, requests of workers with expired lease (crashed or
+    killed) are returned to the queue by :meth:`reclaim_expired`.
+
+    :param redis: aioredis connection
+    :param prefetch_count: max number of requests taken from redis by one
+                           round trip and buffered locally
+    :param worker_id: id of the worker processing list, unique by default
+    :param lease_timeout: worker lease timeout in seconds
+    :param max_retries: max number of retries of failed request
+    :param dedup: dedup backend, instance of
+                  :class:`craigslist.dedup.BaseDedup`, by default configured
+                  by environment
+    """
     queue_key = 'queue'
-    serializer = pickle
+    workers_key = 'workers'
+    processing_key_prefix = 'processing:'
+    lease_key_prefix = 'lease:'
+    serializer = RequestSerializer()
+
+    # number of request priorities, lower is first
+    priorities = 2
+    default_priority = 1
+
+    # max time to wait for new requests before check the queue again
+    wakeup_timeout = 1
 
-    def __init__(self, redis):
+    # max number of requests in one script call
+    put_batch_size = 500
+
+    def __init__(
+            self, redis, prefetch_count=1, worker_id=None, lease_timeout=60,
+            dedup=None, max_retries=3):
         self.redis = redis
-        self.script_sha = None
+        self.dedup = dedup or get_dedup_backend()
+        self.prefetch_count = prefetch_count
+        self.worker_id = worker_id or '%s:%s:%s' % (
+            HOSTNAME, os.getpid(), uuid.uuid4().hex[:8],
+        )
+        self.processing_key = self.processing_key_prefix + self.worker_id
+        self.lease_key = self.lease_key_prefix + self.worker_id
+        self.lease_timeout = lease_timeout
+        self.lease_renewed = None
+        self.max_retries = max_retries
+        self.sizes_key = self.queue_key + ':sizes'
+        self.weights_key = self.queue_key + ':weights'
+        self.wakeup_key = self.queue_key + ':wakeup'
+        self.scripts = {}
+
+        # locally buffered processing list entries
+        self.buffer = deque()
+
+        # processing list entries of taken requests by identity,
+        # required to ack
+        self.in_flight = {}
 
     @asyncio.coroutine
     def register_script(self):
-        self.script_sha = yield from self.redis.script_load(
-            add_new_request_lua_template.format(
-                set_key=self.set_key,
-                queue_key=self.queue_key,
+        prelude = queue_lua_prelude_template.format(queue_key=self.queue_key)
+        for name, script in (
+                ('put', self.dedup.get_lua() + add_new_requests_lua),
+                ('take', take_requests_lua),
+                ('ack', ack_requests_lua),
+                ('retry', retry_request_lua),
+                ('requeue', requeue_requests_lua),
+                ('reclaim', reclaim_requests_lua)):
+            self.scripts[name] = yield from self.redis.script_load(
+                prelude + script
+            )
+
+    @asyncio.coroutine
+    def _evalsha(self, name, keys=(), args=()):
+        if not self.scripts:
+            yield from self.register_script()
+        return (
+            yield from self.redis.evalsha(
+                self.scripts[name], keys=list(keys), args=list(args),
             )
         )
 
+    @asyncio.coroutine
+    def _fill_buffer(self):
+        while not self.buffer:
+            entries = yield from self._evalsha(
+                'take',
+                keys=[self.processing_key],
+                args=[self.prefetch_count, self.priorities],
+            )
+            self.buffer.extend(entries)
+
+            if not self.buffer:
+                # wait for new requests
+                yield from self.redis.blpop(
+                    self.wakeup_key, timeout=self.wakeup_timeout,
+                )
+
+    @asyncio.coroutine
+    def renew_lease(self):
+        yield from self.redis.set(
+            self.lease_key, 1, pexpire=int(self.lease_timeout * 1000),
+        )
+        yield from self.redis.sadd(self.workers_key, self.worker_id)
+        self.lease_renewed = time.monotonic()
+
+    @asyncio.coroutine
+    def release_lease(self):
+        """Return not acknowledged requests to the queue and drop the lease"""
+        yield from self.requeue()
+        yield from self.redis.srem(self.workers_key, self.worker_id)
+        yield from self.redis.delete(self.lease_key)
+        self.lease_renewed = None
+
+    @asyncio.coroutine
+    def reclaim_expired(self):
+        """Return requests of workers with expired lease to the queue"""
+        count = yield from self._evalsha(
+            'reclaim',
+            keys=[self.workers_key],
+            args=[self.lease_key_prefix, self.processing_key_prefix],
+        )
+        if count:
+            log.info("Reclaimed %s requests of expired workers", count)
+        return count
+
     @asyncio.coroutine
     def get_requests(self):
-        _, result = yield from self.redis.blpop(self.queue_key)
-        requests = self.serializer.loads(result)
+        if not self.buffer:
+            # lease must be alive before requests are taken
+            if self.lease_renewed is None or \
+                    time.monotonic() - self.lease_renewed > \
+                    self.lease_timeout / 2:
+                yield from self.renew_lease()
+
+            yield from self._fill_buffer()
+
+        entry = self.buffer.popleft()
+        requests = self.serializer.loads(entry.split(b'\0', 1)[1])
+        self.in_flight[requests.get_identity()] = entry
         log.debug("From queue: %s", requests)
         return requests
 
+    @asyncio.coroutine
+    def ack_requests(self, requests):
+        args = []
+        for item in iterator(requests):
+            identity = item.get_identity()
+            entry = self.in_flight.pop(identity, None)
+            if entry is not None:
+                args.extend((identity, entry))
+        if args:
+            yield from self._evalsha(
+                'ack', keys=[self.processing_key], args=args,
+            )
+
+    @asyncio.coroutine
+    def retry_requests(self, requests):
+        """Return failed requests to the queue instead of ack"""
+        for item in iterator(requests):
+            identity = item.get_identity()
+            entry = self.in_flight.pop(identity, None)
+            if entry is None:
+                continue
+            retries = yield from self._evalsha(
+                'retry',
+                keys=[self.processing_key],
+                args=[identity, entry, self.max_retries],
+            )
+            if retries > 0:
+                log.info("Retry %s, attempt %s", item, retries)
+            elif retries == 0:
+                log.warning(
+                    "Drop %s failed %s times", item, self.max_retries + 1,
+                )
+
+    @asyncio.coroutine
+    def requeue(self, worker_id=None):
+        """Return requests from processing list of the worker to the queue"""
+        processing_key = self.processing_key_prefix + (
+            worker_id or self.worker_id
+        )
+        count = yield from self._evalsha('requeue', keys=[processing_key])
+        if processing_key == self.processing_key:
+            self.buffer.clear()
+            self.in_flight.clear()
+        log.debug("Requeue %s requests of %s", count, processing_key)
+        return count
+
     @asyncio.coroutine
     def put_requests(self, requests):
-        if not self.script_sha:
-            yield from self.register_script()
 
+        # put all requests by one round trip per batch
+        args = []
         for item in iterator(requests):
             log.debug("Put to queue: %s", item)
-            data = self.serializer.dumps(item)
-            yield from self.redis.evalsha(
-                self.script_sha, keys=[], args=[item.get_identity(), data, ],
-            )
+            args.extend((
+                item.get_identity(),
+                item.session_id or '',
+                '%s:%s' % (item.session_id or '', item.city_code or ''),
+                getattr(item, 'priority', self.default_priority),
+                self.serializer.dumps(item),
+            ))
+
+            if len(args) >= self.put_batch_size * 5:
+                yield from self._evalsha('put', args=args)
+                args = []
+
+        if args:
+            yield from self._evalsha('put', args=args)
+
+    @asyncio.coroutine
+    def set_weight(self, session_id, weight):
+        """Number of requests of the session flows taken in one round"""
+        yield from self.redis.hset(self.weights_key, session_id, int(weight))
+
+    @asyncio.coroutine
+    def flow_sizes(self):
+        """Queue size of each session:city flow"""
+        sizes = yield from self.redis.hgetall(self.sizes_key)
+        return dict(
+            (flow.decode(), int(size)) for flow, size in sizes.items()
+        )
 
     @asyncio.coroutine
     def qsize(self):
-        size = yield from self.redis.llen(self.queue_key)
+        size = sum((yield from self.flow_sizes()).values())
         log.debug("queue size: %s", size)
         return size
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+from lxml import etree
+
+
+class Rule(object):
+    """XPath extraction rule compiled once
+
+    :param xpath: xpath expression
+    :param first: take the first result or None instead of list
+    :param join: join all results to one string
+    """
+
+    def __init__(self, xpath, first=False, join=False):
+        self.xpath = xpath
+        self.first = first
+        self.join = join
+        # plain strings do not keep reference to the whole tree
+        self.compiled = etree.XPath(xpath, smart_strings=False)
+
+    def __call__(self, tree):
+        result = self.compiled(tree)
+        if self.join:
+            return ''.join(result)
+        if self.first:
+            return result[0] if result else None
+        return result
+
+    def __repr__(self):
+        return '<{s.__class__.__name__} {s.xpath}>'.format(s=self)
+
+
+class RowRule(Rule):
+    """Rows found by `xpath` with values of `fields` rules evaluated
+    relative to each row, all fields of the row are taken in one pass
+
+    :param fields: pairs of field name and :class:`Rule`
+    """
+
+    def __init__(self, xpath, fields):
+        super(RowRule, self).__init__(xpath)
+        self.fields = tuple(fields)
+
+    def __call__(self, tree):
+        return [
+            dict((name, rule(row)) for name, rule in self.fields)
+            for row in self.compiled(tree)
+        ]
+
+
+class RuleSet(object):
+    """Named rules extracted together
+
+    Compiled xpath evaluates under its own lock, so rule set must not be
+    shared by threads parsing pages in parallel.
+
+    :param rules: pairs of rule name and :class:`Rule`
+    """
+
+    def __init__(self, rules):
+        self.rules = OrderedDict(rules)
+
+    def extract(self, tree, names=None):
+        """Dict of values by rule name, all rules or only `names`"""
+        return dict(
+            (name, self.rules[name](tree)) for name in names or self.rules
+        )
@@ -0,0 +1,130 @@
+import time
+import logging
+import asyncio
+from collections import deque
+from urllib.parse import urlparse
+
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter
+
+    :param rate: tokens per second
+    :param capacity: max burst size, by default equal to rate
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.ts = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.ts) * self.rate,
+        )
+        self.ts = now
+
+    @asyncio.coroutine
+    def consume(self):
+        self._refill()
+        while self.tokens < 1:
+            yield from asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+
+class HostWindow(object):
+    """AIMD concurrency window of one host
+
+    Window grows additively (+1 per window of successful requests) while
+    latency stays close to the best seen latency and shrinks
+    multiplicatively on 429/5xx responses and timeouts.
+    """
+
+    def __init__(
+            self, host, initial=2, minimum=1, maximum=32, rate=5.0,
+            decrease_factor=0.5, latency_tolerance=2.0):
+        self.host = host
+        self.window = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.bucket = TokenBucket(rate)
+
+        self.in_flight = 0
+        self.base_latency = None
+        self.waiters = deque()
+
+    @property
+    def limit(self):
+        return max(self.minimum, int(self.window))
+
+    def _wakeup(self):
+        while self.waiters and self.in_flight < self.limit:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    @asyncio.coroutine
+    def acquire(self):
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+        else:
+            waiter = asyncio.Future()
+            self.waiters.append(waiter)
+            try:
+                yield from waiter
+            except asyncio.CancelledError:
+                # slot was granted right before cancellation
+                if waiter.done() and not waiter.cancelled():
+                    self.release()
+                raise
+        yield from self.bucket.consume()
+
+    def release(self, latency=None, failed=False):
+        self.in_flight -= 1
+
+        if failed:
+            self.window = max(
+                self.minimum, self.window * self.decrease_factor,
+            )
+            log.debug(
+                "[HostWindow] %s shrink window to %.2f",
+                self.host, self.window,
+            )
+        elif latency is not None:
+            if self.base_latency is None or latency < self.base_latency:
+                self.base_latency = latency
+
+            if latency <= self.base_latency * self.latency_tolerance:
+                self.window = min(
+                    self.maximum, self.window + 1.0 / self.window,
+                )
+
+        self._wakeup()
+
+
+class HostScheduler(object):
+    """Keep separate concurrency window and rate for each host
+
+    :param window_kwargs: keywords for :class:`HostWindow`
+    """
+
+    def __init__(self, **window_kwargs):
+        self.window_kwargs = window_kwargs
+        self.windows = {}
+
+    def get_window(self, url):
+        host = urlparse(url).netloc
+        window = self.windows.get(host)
+        if window is None:
+            window = self.windows[host] = HostWindow(
+                host, **self.window_kwargs
+            )
+        return window
@@ -1,20 +1,46 @@
 import os
+import atexit
 import socket
 import datetime
 
+import asyncio
+
 import msgpack
-from aiomeasures import StatsD
+
+from craigslist.metrics import StatsD
 
 
 HOSTNAME = socket.gethostname()
 METRIC_ITEMS_PARSED_KEY = 'crawler.%s.items.parsed' % HOSTNAME
+METRIC_ITEMS_UNCHANGED_KEY = 'crawler.%s.items.unchanged' % HOSTNAME
 METRIC_ITEMS_IMPORTED_KEY = 'crawler.%s.items.imported' % HOSTNAME
+METRIC_ITEMS_SENT_KEY = 'crawler.%s.items.sent' % HOSTNAME
+METRIC_ITEMS_SEND_FAILED_KEY = 'crawler.%s.items.send_failed' % HOSTNAME
 
 METRIC_REQUESTS_STARTED_KEY = 'crawler.%s.requests.started' % HOSTNAME
 METRIC_REQUESTS_FINISHED_KEY = 'crawler.%s.requests.finished' % HOSTNAME
 METRIC_EXCEPTIONS_KEY = 'crawler.%s.exceptions' % HOSTNAME
 
+METRIC_LOOP_LAG_KEY = 'crawler.%s.loop.lag' % HOSTNAME
+METRIC_LOOP_BLOCKED_KEY = 'crawler.%s.loop.blocked' % HOSTNAME
+METRIC_CONCURRENCY_KEY = 'crawler.%s.concurrency' % HOSTNAME
+METRIC_DEQUEUE_RATE_KEY = 'crawler.%s.dequeue_rate' % HOSTNAME
+
+# cluster metrics published by the leader node
 METRIC_QUEUE_SIZE_KEY = 'crawler.queue.size'
+METRIC_QUEUE_FLOW_SIZE_KEY = 'crawler.queue.flow.{session_id}.{city_code}'
+METRIC_QUEUE_IN_FLIGHT_KEY = 'crawler.queue.in_flight'
+METRIC_DEDUP_SIZE_KEY = 'crawler.dedup.size'
+METRIC_CLUSTER_NODES_KEY = 'crawler.cluster.nodes'
+METRIC_CLUSTER_EXPIRED_KEY = 'crawler.cluster.expired_leases'
+METRIC_CLUSTER_THROUGHPUT_KEY = 'crawler.cluster.throughput'
+METRIC_NODE_IN_FLIGHT_KEY = 'crawler.cluster.node.{node}.in_flight'
+METRIC_NODE_THROUGHPUT_KEY = 'crawler.cluster.node.{node}.throughput'
+
+# latency histogram of crawl stage by city and request type
+METRIC_STAGE_KEY = 'crawler.%s.stage.{stage}.{city_code}.{request_type}' % (
+    HOSTNAME,
+)
 
 
 def get_redis_endpoint():
@@ -34,42 +60,96 @@ def get_kafka_endpoints():
     ]
 
 
+def get_stage_key(stage, request=None, city_code=None, request_type=None):
+    """Metric key of the stage latency, tags are taken from the request
+    (`list` for ListRequest, `item` for ItemRequest) or given explicitly,
+    `all` when unknown"""
+    if request is not None:
+        city_code = city_code or getattr(request, 'city_code', None)
+        request_type = request_type or \
+            type(request).__name__.lower().replace('request', '')
+    return METRIC_STAGE_KEY.format(
+        stage=stage,
+        city_code=city_code or 'all',
+        request_type=request_type or 'all',
+    )
+
+
+# shared statsd clients by event loop, None - sync client
+_statsd_clients = {}
+
+
 def get_statsd_client(sync=False):
-    return (StatsD if not sync else SyncStatsD)(
-        'udp://%s:%s' % (
-            os.environ.get('GRAFANA_PORT_8125_UDP_ADDR'),
-            os.environ.get('GRAFANA_PORT_8125_UDP_PORT'),
+    """Aggregating statsd client, flushed by the event loop timer or, for
+    `sync` client, by metric calls
+
+    One client is shared by the process (`sync`) or by the event loop, so
+    metrics of all components are aggregated and sent together. Remaining
+    metrics are sent on exit.
+    """
+    loop = None if sync else asyncio.get_event_loop()
+    client = _statsd_clients.get(loop)
+    if client is None:
+        # forget clients of closed loops
+        for key in list(_statsd_clients):
+            if key is not None and key.is_closed():
+                atexit.unregister(_statsd_clients.pop(key).close)
+        client = _statsd_clients[loop] = StatsD(
+            'udp://%s:%s' % (
+                os.environ.get('GRAFANA_PORT_8125_UDP_ADDR'),
+                os.environ.get('GRAFANA_PORT_8125_UDP_PORT'),
+            ),
+            loop=loop,
         )
-    )
+        atexit.register(client.close)
+    return client
 
 
 class MsgPackSerializer(object):
+    """Msgpack serializer of items
+
+    Item is packed as msgpack array of the format version and values of
+    `FIELDS` in fixed order, datetimes are packed as msgpack timestamps,
+    so they must be timezone aware. Items of the first version (maps with
+    datetimes as strings in UTC) are still readable.
+    """
+    VERSION = 2
+    FIELDS = (
+        'url', 'city_code', 'session_id', 'title', 'price', 'photos',
+        'description', 'ts_created',
+    )
 
     def _decode(self, obj):
-        if b'__datetime__' in obj:
+        # datetime of the first version
+        if '__datetime__' in obj:
             obj = datetime.datetime.strptime(
-                obj[b'as_str'].decode(), "%Y%m%dT%H:%M:%S.%f"
-            )
+                obj['as_str'], "%Y%m%dT%H:%M:%S.%f"
+            ).replace(tzinfo=datetime.timezone.utc)
         return obj
 
     def _encode(self, obj):
         if isinstance(obj, datetime.datetime):
-            return {
-                '__datetime__': True,
-                'as_str': obj.strftime("%Y%m%dT%H:%M:%S.%f")
-            }
+            if obj.tzinfo is None:
+                raise ValueError('Naive datetime %s' % obj)
+            return msgpack.Timestamp.from_datetime(obj)
         return obj
 
     def dumps(self, data):
-        return msgpack.packb(data, default=self._encode)
-
-    def loads(self, data):
-        return msgpack.unpackb(data, object_hook=self._decode)
-
+        return msgpack.packb(
+            [self.VERSION] + [data.get(field) for field in self.FIELDS],
+            default=self._encode,
+        )
 
-class SyncStatsD(StatsD):
+    def loads_row(self, data):
+        """Tuple of item values ordered as `FIELDS`"""
+        data = msgpack.unpackb(
+            data, raw=False, timestamp=3, object_hook=self._decode,
+        )
+        if isinstance(data, dict):
+            return tuple(data.get(field) for field in self.FIELDS)
+        if data[0] != self.VERSION:
+            raise ValueError('Unknown item format version %s' % data[0])
+        return tuple(data[1:])
 
-    def register(self, metric):
-        self.collector.append(metric)
-        self.loop.run_until_complete(self.send())
-        return metric
+    def loads(self, data):
+        return dict(zip(self.FIELDS, self.loads_row(data)))
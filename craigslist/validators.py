@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import asyncio
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+FIELDS = ('etag', 'last_modified', 'hash')
+
+# replace validators hash KEYS[1] by field-value pairs ARGV[2..] and set
+# its ttl ARGV[1] in seconds atomically, no pairs - drop the hash
+set_validators_lua = """
+redis.call('del', KEYS[1])
+if #ARGV > 1 then
+    redis.call('hmset', KEYS[1], unpack(ARGV, 2))
+    redis.call('expire', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+
+def get_body_hash(body):
+    return hashlib.md5(
+        body if isinstance(body, bytes) else body.encode()
+    ).hexdigest()
+
+
+class BaseValidatorStore(object):
+    """Store of page validators - ETag, Last-Modified and body hash of the
+    last downloaded page by url, used to make conditional requests and
+    detect unchanged pages"""
+
+    @asyncio.coroutine
+    def get(self, url):
+        """Dict of stored validators of the url, empty if nothing stored"""
+        raise NotImplementedError()
+
+    @asyncio.coroutine
+    def set(self, url, **validators):
+        raise NotImplementedError()
+
+
+class MemoryValidatorStore(BaseValidatorStore):
+    """Validators of last `max_size` urls in the crawler process"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.data = OrderedDict()
+
+    @asyncio.coroutine
+    def get(self, url):
+        validators = self.data.get(url)
+        if validators is None:
+            return {}
+        self.data.move_to_end(url)
+        return dict(validators)
+
+    @asyncio.coroutine
+    def set(self, url, **validators):
+        self.data[url] = dict(
+            (k, v) for k, v in validators.items() if v is not None
+        )
+        self.data.move_to_end(url)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+
+class RedisValidatorStore(BaseValidatorStore):
+    """Validators shared by all crawlers, hash per url expires after `ttl`
+    seconds without updates"""
+
+    def __init__(self, redis, key_prefix='validators:', ttl=30 * 24 * 3600):
+        self.redis = redis
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        # sha of the loaded set script
+        self.set_sha = None
+
+    def get_key(self, url):
+        return self.key_prefix + get_body_hash(url)
+
+    @asyncio.coroutine
+    def get(self, url):
+        data = yield from self.redis.hgetall(self.get_key(url))
+        return dict(
+            (k.decode(), v.decode()) for k, v in data.items()
+            if k.decode() in FIELDS
+        )
+
+    @asyncio.coroutine
+    def set(self, url, **validators):
+        args = [self.ttl]
+        for k, v in validators.items():
+            if v is not None:
+                args.extend((k, v))
+        if self.set_sha is None:
+            self.set_sha = yield from self.redis.script_load(
+                set_validators_lua,
+            )
+        yield from self.redis.evalsha(
+            self.set_sha, keys=[self.get_key(url)], args=args,
+        )
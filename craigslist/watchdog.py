@@ -0,0 +1,174 @@
+import sys
+import time
+import logging
+import asyncio
+import threading
+import traceback
+
+from craigslist.utils import (
+    get_statsd_client, METRIC_LOOP_LAG_KEY, METRIC_LOOP_BLOCKED_KEY,
+    METRIC_CONCURRENCY_KEY, METRIC_DEQUEUE_RATE_KEY,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+class LoopWatchdog(object):
+    """Event loop lag watchdog
+
+    Lag is the delay of the loop timer scheduled every `interval` seconds,
+    it is published as gauge in milliseconds. Background thread logs the
+    stack of the loop thread when the loop does not run timers longer than
+    `threshold` seconds, i.e. the stack of the blocking callback.
+
+    When lag is over `threshold` for `slow_checks` checks in a row the
+    engine concurrency and dequeue rate are halved, after `recover_checks`
+    checks without lag they are doubled up to initial values.
+
+    :param loop: event loop
+    :param engine: instance of :class:`craigslist.engine.CraigsListPomp`,
+                   None to only measure lag
+    :param interval: seconds between lag checks
+    :param threshold: max lag in seconds
+    :param slow_checks: number of slow checks to throttle the engine
+    :param recover_checks: number of normal checks to restore the engine
+    :param min_dequeue_rate: lowest requests per second taken from queue
+    """
+
+    def __init__(
+            self, loop, engine=None, interval=0.5, threshold=0.2,
+            slow_checks=3, recover_checks=10, min_dequeue_rate=1.0):
+        self.loop = loop
+        self.engine = engine
+        self.interval = interval
+        self.threshold = threshold
+        self.slow_checks = slow_checks
+        self.recover_checks = recover_checks
+        self.min_dequeue_rate = min_dequeue_rate
+        self.statsd = get_statsd_client()
+
+        self.slow = 0
+        self.normal = 0
+        # concurrency and dequeue rate applied to the engine,
+        # None - not throttled
+        self.concurrency = None
+        self.dequeue_rate = None
+        # dequeued requests count and time since the last adjustment
+        self.mark = (0, time.monotonic())
+
+        self.loop_thread_id = None
+        self.last_tick = None
+        self.blocked_tick = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """Start watching, must be called in the loop thread"""
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._watch, name='watchdog', daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    @asyncio.coroutine
+    def run(self):
+        self.start()
+        try:
+            while True:
+                expected = self.loop.time() + self.interval
+                yield from asyncio.sleep(self.interval)
+                self.last_tick = time.monotonic()
+                self.check(max(0, self.loop.time() - expected))
+        finally:
+            self.stop()
+
+    def _watch(self):
+        while not self.stopped.wait(self.threshold / 2.0):
+            tick = self.last_tick
+            blocked = time.monotonic() - tick - self.interval
+            if blocked > self.threshold and tick != self.blocked_tick:
+                # one stack per stall
+                self.blocked_tick = tick
+                self._dump_stack(blocked)
+
+    def _dump_stack(self, blocked):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+        log.warning(
+            "[LoopWatchdog] Event loop is blocked for %.3fs:\n%s",
+            blocked, ''.join(traceback.format_stack(frame)),
+        )
+        # statsd client is not thread safe, count the stall in the loop
+        self.loop.call_soon_threadsafe(
+            self.statsd.incr, METRIC_LOOP_BLOCKED_KEY,
+        )
+
+    def check(self, lag):
+        """Publish lag in seconds and adjust the engine"""
+        self.statsd.gauge(METRIC_LOOP_LAG_KEY, int(lag * 1000))
+        if lag > self.threshold:
+            self.slow += 1
+            self.normal = 0
+        else:
+            self.normal += 1
+            self.slow = 0
+
+        if self.engine is None:
+            return
+        if self.slow >= self.slow_checks:
+            self.slow = 0
+            self.throttle()
+        elif self.normal >= self.recover_checks \
+                and self.concurrency is not None:
+            self.normal = 0
+            self.recover()
+
+    def _get_dequeue_rate(self):
+        count, ts = self.mark
+        now = time.monotonic()
+        self.mark = (self.engine.dequeued, now)
+        return (self.engine.dequeued - count) / max(now - ts, 0.001)
+
+    def throttle(self):
+        concurrency = self.engine.get_concurrency()
+        dequeue_rate = self.dequeue_rate or self._get_dequeue_rate()
+        self._apply(
+            max(1, concurrency // 2),
+            max(self.min_dequeue_rate, dequeue_rate / 2.0),
+        )
+
+    def recover(self):
+        workers_count = self.engine.downloader.get_workers_count()
+        concurrency = min(workers_count, self.concurrency * 2)
+        if concurrency == workers_count:
+            self._apply(None, None)
+        else:
+            self._apply(concurrency, self.dequeue_rate * 2.0)
+
+    def _apply(self, concurrency, dequeue_rate):
+        log.warning(
+            "[LoopWatchdog] Set concurrency %s dequeue rate %s",
+            concurrency or 'max',
+            '%.1f/s' % dequeue_rate if dequeue_rate else 'max',
+        )
+        self.concurrency = concurrency
+        self.dequeue_rate = dequeue_rate
+        self.engine.set_concurrency(
+            concurrency or self.engine.downloader.get_workers_count()
+        )
+        self.engine.set_dequeue_rate(dequeue_rate)
+        self._get_dequeue_rate()
+        self.statsd.gauge(
+            METRIC_CONCURRENCY_KEY, self.engine.get_concurrency(),
+        )
+        self.statsd.gauge(METRIC_DEQUEUE_RATE_KEY, dequeue_rate or 0)
@@ -0,0 +1,258 @@
+import io
+import datetime
+
+from django.db import connection, models
+from django.utils import timezone
+from django.core.validators import URLValidator
+from django.contrib.postgres.fields import ArrayField
+
+from dataview.items.models import (
+    NATURAL_KEY, NATURAL_KEY_SQL, CONTENT_FIELDS, get_content_hash,
+)
+
+
+def _copy_escape(value):
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _array_escape(value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _format(value):
+    """Value in COPY text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return _copy_escape(value)
+    if isinstance(value, list):
+        return _copy_escape('{%s}' % ','.join(
+            'NULL' if v is None else _array_escape(str(v))
+            for v in value
+        ))
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def compile_check(field):
+    """Build function which converts the raw value of the field to python
+    value or raises ValueError
+
+    Lightweight replacement of `full_clean` for the field types of items,
+    URLs are checked by the regex of URLValidator only.
+    """
+    null, blank, max_length = field.null, field.blank, field.max_length
+
+    if isinstance(field, ArrayField):
+        check_base = compile_check(field.base_field)
+
+        def check(value):
+            if not isinstance(value, (list, tuple)):
+                raise ValueError('%s: not a list' % field.name)
+            return [check_base(v) for v in value]
+
+    elif isinstance(field, models.IntegerField):
+        minimum = 0 if isinstance(field, (
+            models.PositiveIntegerField, models.PositiveSmallIntegerField,
+        )) else -2147483648
+
+        def check(value):
+            value = int(value)
+            if not minimum <= value <= 2147483647:
+                raise ValueError('%s: out of range' % field.name)
+            return value
+
+    elif isinstance(field, models.DateTimeField):
+
+        def check(value):
+            if not isinstance(value, datetime.datetime):
+                raise ValueError('%s: not a datetime' % field.name)
+            if timezone.is_naive(value):
+                value = timezone.make_aware(value, timezone.utc)
+            return value
+
+    elif isinstance(field, (models.CharField, models.TextField)):
+        regex = URLValidator.regex \
+            if isinstance(field, models.URLField) else None
+
+        def check(value):
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            elif not isinstance(value, str):
+                raise ValueError('%s: not a string' % field.name)
+            if max_length and len(value) > max_length:
+                raise ValueError('%s: too long' % field.name)
+            if value and regex and not regex.search(value):
+                raise ValueError('%s: invalid url' % field.name)
+            return value
+
+    else:
+        raise TypeError('Unsupported field %s' % field)
+
+    def check_empty(value):
+        if value is None:
+            if not null:
+                raise ValueError('%s: null' % field.name)
+            return None
+        if not value and value != 0:
+            if not blank:
+                raise ValueError('%s: blank' % field.name)
+        return check(value)
+
+    return check_empty
+
+
+def _insert_fields(model):
+    return [
+        field for field in model._meta.concrete_fields
+        if not isinstance(field, models.AutoField)
+    ]
+
+
+def get_upsert_sql(table, columns, source):
+    """Insert rows of `source` (VALUES or SELECT) or update existing items
+    by natural key if their content hash is changed"""
+    quote_name = connection.ops.quote_name
+    return """
+INSERT INTO {table} ({columns}) {source}
+ON CONFLICT ({key}) DO UPDATE SET {updates}
+WHERE {table}.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+""".format(
+        table=quote_name(table),
+        columns=', '.join(quote_name(column) for column in columns),
+        source=source,
+        key=NATURAL_KEY_SQL,
+        updates=', '.join(
+            '{0} = EXCLUDED.{0}'.format(quote_name(column))
+            for column in columns if column not in NATURAL_KEY
+        ),
+    )
+
+
+def upsert(model, instances, batch_size=500):
+    """Insert or update changed model instances by batches, instances must
+    be validated and unique by natural key"""
+    table = model._meta.db_table
+    fields = _insert_fields(model)
+    placeholder = '(%s)' % ', '.join(['%s'] * len(fields))
+
+    with connection.cursor() as cursor:
+        for i in range(0, len(instances), batch_size):
+            batch = instances[i:i + batch_size]
+            params = []
+            for instance in batch:
+                instance.content_hash = instance.get_content_hash()
+                params.extend(
+                    field.get_db_prep_save(
+                        field.pre_save(instance, True), connection,
+                    ) for field in fields
+                )
+            cursor.execute(
+                get_upsert_sql(
+                    table,
+                    [field.column for field in fields],
+                    'VALUES ' + ', '.join([placeholder] * len(batch)),
+                ),
+                params,
+            )
+
+
+class CopyLoader(object):
+    """Load items to the model table by COPY FROM STDIN
+
+    Items are validated by precompiled checks of model fields, auto primary
+    key is assigned by the database, `auto_now_add` fields are set to the
+    load time and content hash is calculated from `CONTENT_FIELDS`.
+
+    With `upsert` rows are copied to the temporary staging table and then
+    inserted or updated by natural key if their content hash is changed,
+    rows must be unique by natural key.
+
+    :param model: django model
+    :param row_fields: names of fields in order of item values
+    :param upsert: update existing items
+    """
+    staging_table = 'craigslist_staging'
+
+    def __init__(self, model, row_fields, upsert=True):
+        self.table = model._meta.db_table
+        self.upsert = upsert
+        self.fields = [
+            field for field in _insert_fields(model)
+            if field.name != 'content_hash'
+        ] + [model._meta.get_field('content_hash')]
+        self.columns = [field.column for field in self.fields]
+        self.checks = [
+            (
+                field.name,
+                row_fields.index(field.name)
+                if field.name in row_fields else None,
+                None if getattr(field, 'auto_now_add', False)
+                else compile_check(field),
+            ) for field in self.fields[:-1]
+        ]
+
+    def clean(self, row, now=None):
+        """Item in COPY text format, raises ValueError on invalid data
+
+        :param row: tuple of item values ordered as `row_fields`
+        :param now: value of `auto_now_add` fields, current time by default
+        """
+        if now is None:
+            now = timezone.now()
+        values = {}
+        for name, index, check in self.checks:
+            if check is None:
+                values[name] = now
+            else:
+                values[name] = check(None if index is None else row[index])
+        values['content_hash'] = get_content_hash([
+            values[name] for name in CONTENT_FIELDS
+        ])
+        return '\t'.join(
+            _format(values[field.name]) for field in self.fields
+        )
+
+    def load(self, rows):
+        """Copy rows to the table, return the number of rows"""
+        data = io.StringIO()
+        count = 0
+        for row in rows:
+            data.write(row)
+            data.write('\n')
+            count += 1
+        if not count:
+            return count
+
+        data.seek(0)
+        quote_name = connection.ops.quote_name
+        columns = ', '.join(quote_name(column) for column in self.columns)
+        with connection.cursor() as cursor:
+            if not self.upsert:
+                cursor.copy_expert(
+                    'COPY %s (%s) FROM STDIN' % (
+                        quote_name(self.table), columns,
+                    ),
+                    data,
+                )
+                return count
+
+            cursor.execute(
+                'CREATE TEMPORARY TABLE IF NOT EXISTS %s AS '
+                'SELECT %s FROM %s WITH NO DATA' % (
+                    self.staging_table, columns, quote_name(self.table),
+                )
+            )
+            cursor.execute('TRUNCATE %s' % self.staging_table)
+            cursor.copy_expert(
+                'COPY %s (%s) FROM STDIN' % (self.staging_table, columns),
+                data,
+            )
+            cursor.execute(get_upsert_sql(
+                self.table,
+                self.columns,
+                'SELECT %s FROM %s' % (columns, self.staging_table),
+            ))
+        return count
@@ -1,65 +1,181 @@
 import logging
+from multiprocessing import Process
 
+from django import db
 from django.db import transaction
+from django.utils import timezone
 from django.core.management.base import BaseCommand
 from django.core.exceptions import ValidationError
 
-from dataview.items.models import CraigsListItem
+from dataview.items.bulk import CopyLoader, upsert
+from dataview.items.models import CraigsListItem, KafkaOffset
 from craigslist.pipeline import KafkaPipeline
 from craigslist.utils import get_statsd_client, METRIC_ITEMS_IMPORTED_KEY
 
 
+# order of item values decoded from kafka
+FIELDS = KafkaPipeline.SERIALIZER.FIELDS
+
+
 log = logging.getLogger('dataview.dbimport')
 
 
 class Command(BaseCommand):
     help = 'import data from kafka to db'
 
+    # import batch is closed when it is full or after max wait
+    batch_max_records = 1000
+    batch_max_bytes = 4 * 1024 * 1024
+    batch_max_wait_ms = 500
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fast', action='store_true', default=False,
+            help='validate items by precompiled checks and load them by COPY',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='number of import processes, each one consumes its share '
+                 'of the topic partitions, partitions added to the topic '
+                 'are picked up within a minute',
+        )
+
     def handle(self, *args, **options):
+        workers = options.get('workers') or 1
+        fast = options.get('fast', False)
+        if workers > 1:
+            self._start_workers(workers, fast)
+        else:
+            self._safe_handle(worker=(0, 1), fast=fast)
+
+    def _safe_handle(self, **kwargs):
         try:
-            self._handle(*args, **options)
+            self._handle(**kwargs)
         except Exception:
             log.exception("Exception")
 
-    def _handle(self, *args, **options):
+    def _start_workers(self, workers, fast):
+        partitions = KafkaPipeline.get_partitions()
+        workers = min(workers, len(partitions)) or 1
+        log.debug(
+            'Start %s import workers for partitions %s', workers, partitions,
+        )
 
-        statsd = get_statsd_client(sync=True)
+        # workers must not share connection of the parent process
+        db.connections.close_all()
+
+        processes = [
+            Process(
+                target=self._safe_handle,
+                kwargs={'worker': (i, workers), 'fast': fast},
+            ) for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    def unique_items(self, items):
+        """Last item of every natural key, the same item can not be
+        upserted twice by one statement"""
+        url = FIELDS.index('url')
+        session_id = FIELDS.index('session_id')
+        return list(dict(
+            ((item[url], item[session_id] or ''), item) for item in items
+        ).values())
+
+    def bulk_insert(self, items):
+        """Validate items by model `full_clean` and upsert them by batches,
+        return the number of imported items"""
 
         def _items_factory(items):
             for item in items:
-                instance = CraigsListItem(**dict(
-                    # convert dict byte keys to string keys and use it as
-                    # keywords
-                    (k.decode(), v) for k, v in item.items()
-                ))
+                instance = CraigsListItem(**dict(zip(FIELDS, item)))
 
                 # validate data before insert
                 try:
                     instance.full_clean()
                 except ValidationError as e:
-                    log.debug('Invalid data(%s): %s', e, dict(item))
+                    log.debug('Invalid data(%s): %s', e, item)
                 else:
                     yield instance
 
-        @transaction.atomic()
-        def do_bulk_insert(items):
-            cleaned_items = list(_items_factory(items))
-            if cleaned_items:
-                CraigsListItem.objects.bulk_create(cleaned_items)
-            return cleaned_items
+        cleaned_items = list(_items_factory(self.unique_items(items)))
+        if cleaned_items:
+            upsert(CraigsListItem, cleaned_items)
+        return len(cleaned_items)
 
-        log.debug(
-            'Start import data from kafka',
+    def copy_insert(self, items):
+        """Validate items by precompiled checks and upsert them through
+        COPY to staging table, return the number of imported items"""
+        if not hasattr(self, 'loader'):
+            self.loader = CopyLoader(CraigsListItem, FIELDS)
+
+        now = timezone.now()
+
+        def _rows_factory(items):
+            for item in items:
+                try:
+                    yield self.loader.clean(item, now=now)
+                except (ValueError, UnicodeDecodeError) as e:
+                    log.debug('Invalid data(%s): %s', e, item)
+
+        return self.loader.load(_rows_factory(self.unique_items(items)))
+
+    def _handle(self, worker=(0, 1), fast=False):
+
+        statsd = get_statsd_client(sync=True)
+        insert = self.copy_insert if fast else self.bulk_insert
+        topic = KafkaPipeline.TOPIC
+
+        # continue from offsets of the last imported items
+        offsets = dict(
+            KafkaOffset.objects.filter(topic=topic)
+            .values_list('partition', 'offset')
+        )
+        index, count = worker
+        offsets = dict(
+            (p, o) for p, o in offsets.items() if p % count == index
         )
 
-        for items in KafkaPipeline.dump_data(
-                timeout=500, poll_timeout=5000, enable_auto_commit=True):
+        log.debug(
+            'Start import data from kafka, worker: %s of %s, offsets: %s, '
+            'fast: %s',
+            index + 1, count, offsets, fast,
+        )
 
-            if items:
-                imported = do_bulk_insert(items)
+        for records in KafkaPipeline.dump_data(
+                topic=topic, poll_timeout=self.batch_max_wait_ms,
+                max_records=self.batch_max_records,
+                max_bytes=self.batch_max_bytes,
+                worker=worker, offsets=offsets, records=True,
+                rows=True):
+
+            if records:
+                # items and offsets are committed together, so every item
+                # is imported exactly once
+                with transaction.atomic():
+                    imported = insert([record.value for record in records])
+                    self.save_offsets(topic, records)
                 log.debug(
                     'Successfully imported %s from %s',
-                    len(imported), len(items),
+                    imported, len(records),
                 )
 
-                statsd.incr(METRIC_ITEMS_IMPORTED_KEY, value=len(imported))
+                statsd.incr(METRIC_ITEMS_IMPORTED_KEY, value=imported)
+            else:
+                # send the last interval while kafka is idle
+                statsd.tick()
+
+    def save_offsets(self, topic, records):
+        """Store offset of the next item of every partition"""
+        offsets = {}
+        for record in records:
+            offsets[record.partition] = max(
+                offsets.get(record.partition, 0), record.offset + 1,
+            )
+        for partition, offset in offsets.items():
+            KafkaOffset.objects.update_or_create(
+                topic=topic, partition=partition,
+                defaults={'offset': offset},
+            )
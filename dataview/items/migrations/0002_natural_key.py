@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='craigslistitem',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True),
+        ),
+        # keep the last imported row of every item
+        migrations.RunSQL(
+            """
+            DELETE FROM items_craigslistitem a
+            USING items_craigslistitem b
+            WHERE a.url = b.url
+                AND coalesce(a.session_id, '') = coalesce(b.session_id, '')
+                AND a.id < b.id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            """
+            CREATE UNIQUE INDEX items_craigslistitem_natural_key
+            ON items_craigslistitem (url, (coalesce(session_id, '')))
+            """,
+            "DROP INDEX items_craigslistitem_natural_key",
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0002_natural_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KafkaOffset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic', models.CharField(max_length=255)),
+                ('partition', models.PositiveIntegerField()),
+                ('offset', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='kafkaoffset',
+            unique_together=set([('topic', 'partition')]),
+        ),
+    ]
@@ -1,7 +1,28 @@
+import json
+import hashlib
+
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
 
 
+# unique natural key of items, no session is the same as empty session,
+# unique index is created by migration
+NATURAL_KEY = ('url', 'session_id')
+NATURAL_KEY_SQL = "url, (coalesce(session_id, ''))"
+
+# fields compared by content hash to update changed items only
+CONTENT_FIELDS = ('city_code', 'title', 'price', 'photos', 'description')
+
+
+def get_content_hash(values):
+    """Hash of content values ordered as `CONTENT_FIELDS`"""
+    return hashlib.md5(json.dumps(
+        values, ensure_ascii=False,
+        # raw strings of not cleaned values
+        default=lambda value: value.decode(),
+    ).encode()).hexdigest()
+
+
 class CraigsListItem(models.Model):
 
     ts_created = models.DateTimeField(null=True, blank=True)
@@ -27,3 +48,24 @@ class CraigsListItem(models.Model):
     photos = ArrayField(models.URLField(), null=True, blank=True)
 
     description = models.TextField(null=True, blank=True)
+
+    content_hash = models.CharField(
+        max_length=32, null=True, blank=True, editable=False,
+    )
+
+    def get_content_hash(self):
+        return get_content_hash([
+            getattr(self, name) for name in CONTENT_FIELDS
+        ])
+
+
+class KafkaOffset(models.Model):
+    """Offset of the next item to import from kafka topic partition, it is
+    updated in the transaction of imported items"""
+
+    topic = models.CharField(max_length=255)
+    partition = models.PositiveIntegerField()
+    offset = models.BigIntegerField()
+
+    class Meta:
+        unique_together = ('topic', 'partition')
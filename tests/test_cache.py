@@ -0,0 +1,142 @@
+import os
+import time
+import sqlite3
+import asyncio
+import tempfile
+
+from pomp.core.base import BaseCrawlException
+
+from craigslist.cache import ResponseCache, CachingDownloader, CacheMissError
+from craigslist.downloader import AiohttpRequest, AiohttpResponse
+
+from utils import asyncio_test
+
+
+def test_response_cache():
+    cache = ResponseCache(tempfile.mkdtemp(), ttl=60)
+    first = AiohttpRequest('http://test.com/1')
+    second = AiohttpRequest('http://test.com/2')
+
+    assert cache.get(first) is None
+    cache.put(first, '<html>1</html>')
+    cache.put(second, '<html>1</html>')
+    assert cache.get(first) == '<html>1</html>'
+    assert cache.get(second) == '<html>1</html>'
+
+    # same bodies share one blob
+    assert cache.evict() == 0
+    assert cache.db.execute(
+        'SELECT count(DISTINCT digest) FROM responses'
+    ).fetchone()[0] == 1
+
+    # expired response is not used, but available for replay
+    cache.db.execute('UPDATE responses SET ts = ?', (time.time() - 120, ))
+    assert cache.get(first) is None
+    assert cache.get(first, ignore_ttl=True) == '<html>1</html>'
+
+    assert cache.evict() == 1
+    assert cache.get(first, ignore_ttl=True) is None
+
+
+def test_response_cache_max_size():
+    cache = ResponseCache(tempfile.mkdtemp())
+    for i in range(10):
+        cache.put(AiohttpRequest('http://test.com/%s' % i), str(i) * 1000)
+        cache.db.execute(
+            'UPDATE responses SET ts = ? WHERE url = ?',
+            (i, 'http://test.com/%s' % i),
+        )
+    size = cache.db.execute('SELECT size FROM responses').fetchone()[0]
+
+    # only the newest responses are kept
+    cache.max_size = size * 3
+    assert cache.evict() == 7
+    assert [
+        url for url, in
+        cache.db.execute('SELECT url FROM responses ORDER BY ts')
+    ] == ['http://test.com/%s' % i for i in (7, 8, 9)]
+
+
+def test_response_cache_batch_commit():
+    path = tempfile.mkdtemp()
+    cache = ResponseCache(path, commit_every=2)
+    reader = sqlite3.connect(os.path.join(path, 'index.sqlite'))
+
+    def count():
+        return reader.execute('SELECT count(*) FROM responses').fetchone()[0]
+
+    cache.put(AiohttpRequest('http://test.com/1'), '<html>1</html>')
+    assert cache.get(AiohttpRequest('http://test.com/1')) == '<html>1</html>'
+    assert count() == 0
+    cache.put(AiohttpRequest('http://test.com/2'), '<html>2</html>')
+    assert count() == 2
+
+    # the rest is committed on close
+    cache.put(AiohttpRequest('http://test.com/3'), '<html>3</html>')
+    cache.close()
+    assert count() == 3
+    # blob sizes are indexed to not walk the blobs directory
+    assert reader.execute('SELECT count(*) FROM blobs').fetchone()[0] == 3
+
+
+@asyncio_test
+def test_caching_downloader_replay(loop=None):
+    cache = ResponseCache(tempfile.mkdtemp())
+    cache.put(AiohttpRequest('http://test.com/cached'), '<html></html>')
+
+    downloader = CachingDownloader(cache=cache, replay=True)
+    downloader.prepare()
+    assert downloader.session is None
+
+    responses = []
+    for planned in downloader.get((
+            AiohttpRequest('http://test.com/cached'),
+            AiohttpRequest('http://test.com/missed'), )):
+        future = asyncio.Future()
+        planned.add_done_callback(
+            lambda r, future=future: future.set_result(r.result())
+        )
+        responses.append((yield from future))
+
+    assert isinstance(responses[0], AiohttpResponse)
+    assert responses[0].body == '<html></html>'
+    assert isinstance(responses[1], BaseCrawlException)
+    assert isinstance(responses[1].exception, CacheMissError)
+
+    downloader.stop()
+
+
+@asyncio_test
+def test_caching_downloader_store(loop=None):
+    from aiohttp import web
+
+    served = []
+
+    @asyncio.coroutine
+    def handler(request):
+        served.append(request.path)
+        return web.Response(body=b'<html>page</html>')
+
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/{name}', handler)
+    server = yield from loop.create_server(
+        app.make_handler(), '127.0.0.1', 0,
+    )
+    url = 'http://127.0.0.1:%s/page' % server.sockets[0].getsockname()[1]
+
+    downloader = CachingDownloader(
+        cache=ResponseCache(tempfile.mkdtemp()),
+        host_window={'rate': 10 ** 6},
+    )
+    downloader.prepare()
+
+    for _ in range(2):
+        future = asyncio.Future()
+        yield from downloader._fetch(AiohttpRequest(url), future)
+        assert future.result().body == '<html>page</html>'
+
+    # second request is served from the cache
+    assert served == ['/page']
+
+    downloader.stop()
+    server.close()
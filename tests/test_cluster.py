@@ -0,0 +1,135 @@
+import aioredis
+
+from craigslist.utils import (
+    get_redis_endpoint, METRIC_QUEUE_SIZE_KEY, METRIC_QUEUE_FLOW_SIZE_KEY,
+    METRIC_QUEUE_IN_FLIGHT_KEY, METRIC_DEDUP_SIZE_KEY,
+    METRIC_CLUSTER_NODES_KEY, METRIC_CLUSTER_EXPIRED_KEY,
+    METRIC_NODE_THROUGHPUT_KEY,
+)
+from craigslist.queue import RedisQueue
+from craigslist.dedup import SetDedup
+from craigslist.cluster import ClusterNode, get_metric_name
+from craigslist.crawler import ListRequest
+
+from utils import asyncio_test
+
+
+class FakeEngine(object):
+
+    def __init__(self):
+        self.dequeued = 0
+
+
+@asyncio_test
+def test_cluster_leader_election(loop=None):
+    endpoint = get_redis_endpoint()
+    redis = yield from aioredis.create_redis(endpoint, loop=loop)
+    yield from redis.flushall()
+
+    first = ClusterNode(redis, RedisQueue(redis, worker_id='first'))
+    second = ClusterNode(redis, RedisQueue(redis, worker_id='second'))
+
+    yield from first.beat()
+    yield from second.beat()
+    assert first.is_leader
+    assert not second.is_leader
+
+    # leadership is prolonged by the leader only
+    yield from second.beat()
+    yield from first.beat()
+    assert first.is_leader
+    assert not second.is_leader
+
+    # stopped leader hands over leadership
+    yield from first.leave()
+    assert not (yield from redis.exists(first.heartbeat_key))
+    yield from second.beat()
+    assert second.is_leader
+
+    # not leader can not drop leadership of other node
+    yield from first.leave()
+    yield from second.beat()
+    assert second.is_leader
+
+    first.statsd.close()
+    second.statsd.close()
+
+
+@asyncio_test
+def test_cluster_metrics(loop=None):
+    endpoint = get_redis_endpoint()
+    redis = yield from aioredis.create_redis(endpoint, loop=loop)
+    yield from redis.flushall()
+
+    queues = [
+        RedisQueue(redis, worker_id='host:1:%s' % i, dedup=SetDedup())
+        for i in range(3)
+    ]
+    engines = [FakeEngine() for _ in queues]
+    nodes = [
+        ClusterNode(redis, queue, engine=engine)
+        for queue, engine in zip(queues, engines)
+    ]
+
+    yield from queues[0].put_requests([
+        ListRequest(
+            session_id='bike', city_code=city_code,
+            url='http://%s.test.com/%s' % (city_code, i),
+        ) for city_code in ('sfbay', 'chicago') for i in range(3)
+    ])
+    # two requests are in-flight of the first node
+    yield from queues[0].get_requests()
+    yield from queues[0].get_requests()
+    yield from queues[1].renew_lease()
+
+    for node in nodes[:2]:
+        yield from node.beat()
+    leader = nodes[0]
+    assert leader.is_leader
+    assert not nodes[1].is_leader
+    # nodes of the process share statsd client
+    statsd = leader.statsd
+    assert all(node.statsd is statsd for node in nodes)
+    statsd.flush()
+
+    # the last node is crashed with taken request, its lease is expired
+    yield from queues[2].get_requests()
+    yield from redis.delete(queues[2].lease_key)
+    # follower does not reclaim expired leases and publish cluster metrics
+    yield from nodes[1].beat()
+    assert (yield from queues[0].qsize()) == 3
+    assert statsd.gauges == {}
+
+    # metrics by heartbeats of both nodes
+    yield from leader.beat()
+
+    gauges = statsd.gauges
+    assert gauges[METRIC_QUEUE_SIZE_KEY] == 3
+    assert sum(
+        gauges[METRIC_QUEUE_FLOW_SIZE_KEY.format(
+            session_id='bike', city_code=city_code,
+        )] for city_code in ('sfbay', 'chicago')
+    ) == 3
+    assert gauges[METRIC_DEDUP_SIZE_KEY] == 6
+    assert gauges[METRIC_QUEUE_IN_FLIGHT_KEY] == 3
+    assert gauges[METRIC_CLUSTER_NODES_KEY] == 2
+    assert gauges[METRIC_CLUSTER_EXPIRED_KEY] == 1
+    # request of the expired lease is returned to the queue by the leader
+    assert (yield from queues[0].qsize()) == 4
+    assert not (yield from redis.sismember(
+        queues[2].workers_key, queues[2].worker_id,
+    ))
+
+    # throughput is counted by the next heartbeats
+    engines[0].dequeued = 100
+    yield from nodes[1].beat()
+    yield from leader.beat()
+    throughput = gauges[METRIC_NODE_THROUGHPUT_KEY.format(
+        node=get_metric_name(nodes[0].node_id),
+    )]
+    assert throughput > 0
+    assert gauges[METRIC_NODE_THROUGHPUT_KEY.format(
+        node=get_metric_name(nodes[1].node_id),
+    )] == 0
+
+    statsd.close()
@@ -1,10 +1,19 @@
-from craigslist.item import CraigsListItem
+import os
+import pickle
+import asyncio
+import threading
+
+from craigslist.item import CraigsListItem, UnchangedItem
 from craigslist.crawler import (
-    ListRequest, ItemRequest, CraigsListCrawler
+    ListRequest, ItemRequest, CraigsListCrawler, CraigsListConcurrentCrawler,
+    RequestSerializer, pack_request, unpack_request, _run_parse_worker,
+    _parse_workers,
 )
+from craigslist.utils import get_stage_key
 
-from utils import mock_response
+from utils import asyncio_test, mock_response
 
+here = os.path.dirname(os.path.abspath(__file__))
 crawler = CraigsListCrawler()
 
 
@@ -38,6 +47,22 @@ def test_crawler_list_parse():
     assert next_list_requests[0].page_number == 1
 
 
+def test_crawler_list_rows_parse():
+    request = ListRequest(
+        session_id='somesession',
+        url='mocked',
+        city_code='sfbay',
+    )
+    # list rules target current markup, rows are `li` with `data-pid`
+    response = mock_response('data/list_rows.html', request_instance=request)
+
+    items = list(crawler.extract_items(response))
+    item_requests = [i for i in items if isinstance(i, ItemRequest)]
+    assert len(item_requests) == 100
+    assert item_requests[0].url == \
+        'https://sfbay.craigslist.org/mnh/bik/5408450292.html'
+
+
 def test_crawler_item_parse():
 
     request = ItemRequest(
@@ -59,3 +84,155 @@ def test_crawler_item_parse():
         assert item.url == request.url
         assert item.city_code == request.city_code
         assert item.title == 'kid bike'
+
+
+def test_pack_request():
+    request = ListRequest(
+        session_id='somesession',
+        url='https://sfbay.craigslist.org/search/bia',
+        city_code='sfbay',
+        page_number=2,
+    )
+    result = unpack_request(pack_request(request))
+    assert isinstance(result, ListRequest)
+    assert result.get_identity() == request.get_identity()
+    assert result.page_number == 2
+
+    request = ItemRequest(
+        session_id='somesession',
+        url='https://sfbay.craigslist.org/item.html',
+        city_code='sfbay',
+    )
+    result = unpack_request(pack_request(request))
+    assert isinstance(result, ItemRequest)
+    assert result.get_identity() == request.get_identity()
+
+
+def test_crawler_item_truncated_parse():
+    request = ItemRequest(
+        session_id='somesession',
+        url='mocked',
+        city_code='sfbay',
+    )
+    response = mock_response('data/item.html', request_instance=request)
+
+    def parse():
+        return [
+            dict(item, ts_created=None)
+            for item in crawler.extract_items(response)
+        ]
+
+    expected = parse()
+    assert expected[0]['title'] == 'kid bike'
+
+    # page downloaded until the end of posting body has all item data
+    body = response.body.encode()
+    response.body = body[:ItemRequest.read_until.search(body).end()].decode()
+    assert len(response.body) < len(body)
+    assert parse() == expected
+
+
+@asyncio_test
+def test_concurrent_crawler_item_parse(loop=None):
+    concurrent_crawler = CraigsListConcurrentCrawler(
+        pool_size=1, executor='thread',
+    )
+    request = ItemRequest(
+        session_id='somesession',
+        url='mocked',
+        city_code='sfbay',
+    )
+
+    future = asyncio.Future()
+    concurrent_crawler.process(
+        mock_response('data/item.html', request_instance=request),
+    ).add_done_callback(lambda r: future.set_result(r.result()))
+    items = yield from future
+
+    assert len(items) == 1
+    assert isinstance(items[0], CraigsListItem)
+    assert items[0].url == request.url
+    assert items[0].title == 'kid bike'
+
+    # parse time of the worker is reported
+    histograms = concurrent_crawler.statsd.histograms
+    assert histograms[get_stage_key('parse', request)].count == 1
+
+
+def test_parse_workers_per_thread():
+    request = pack_request(ItemRequest(
+        session_id='somesession',
+        url='mocked',
+        city_code='sfbay',
+    ))
+    with open(os.path.join(here, 'data/item.html')) as f:
+        body = f.read()
+
+    # every parse thread has own crawler with own compiled rules
+    rules = []
+
+    def parse():
+        _run_parse_worker(CraigsListCrawler, body, request)
+        rules.append(_parse_workers.crawlers[CraigsListCrawler].item_rules)
+
+    threads = [threading.Thread(target=parse) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(rules) == 2
+    assert rules[0] is not rules[1]
+    assert rules[0].rules['title'].compiled is not \
+        rules[1].rules['title'].compiled
+
+
+@asyncio_test
+def test_crawler_unchanged_item(loop=None):
+    request = ItemRequest(
+        session_id='somesession',
+        url='mocked',
+        city_code='sfbay',
+    )
+    response = mock_response('data/item.html', request_instance=request)
+    response.unchanged = True
+
+    items = list(crawler.extract_items(response))
+    assert len(items) == 1
+    assert isinstance(items[0], UnchangedItem)
+    assert items[0].url == request.url
+
+    # unchanged page is not sent to parse workers
+    concurrent_crawler = CraigsListConcurrentCrawler(
+        pool_size=1, executor='thread',
+    )
+    items = concurrent_crawler.process(response)
+    assert len(items) == 1
+    assert isinstance(items[0], UnchangedItem)
+    assert items[0].session_id == request.session_id
+
+
+def test_request_serializer():
+    serializer = RequestSerializer()
+
+    for request in (
+            ListRequest(
+                session_id='somesession',
+                url='https://sfbay.craigslist.org/search/bia?query=kid+bike',
+                city_code='sfbay',
+                page_number=1,
+            ),
+            ItemRequest(
+                session_id='somesession',
+                url='http://other.host/item.html',
+                city_code='sfbay',
+            )):
+        data = serializer.dumps(request)
+        result = serializer.loads(data)
+        assert type(result) == type(request)
+        assert result.url == request.url
+        assert result.get_identity() == request.get_identity()
+        assert len(data) < len(pickle.dumps(request))
+
+        # requests pickled by previous versions are readable
+        result = serializer.loads(pickle.dumps(request))
+        assert result.get_identity() == request.get_identity()
@@ -4,6 +4,7 @@ from pomp.core.utils import Planned
 from craigslist.downloader import (
     AiohttpRequest, AiohttpResponse, AiohttpDownloader,
 )
+from craigslist.validators import MemoryValidatorStore
 
 from utils import asyncio_test
 
@@ -27,3 +28,193 @@ def test_downloader(loop=None):
     result.add_done_callback(check)
 
     return future
+
+
+@asyncio_test
+def test_downloader_session(loop=None):
+    downloader = AiohttpDownloader(max_connections_per_host=2)
+    downloader.prepare()
+
+    # all requests share one pooled session
+    session = downloader.session
+    assert session is not None
+    assert downloader.get_session() is session
+
+    responses = []
+    for planned in downloader.get((
+            AiohttpRequest('https://python.org'),
+            AiohttpRequest('https://python.org/about/'), )):
+        future = asyncio.Future()
+        planned.add_done_callback(
+            lambda r, future=future: future.set_result(r.result())
+        )
+        responses.append((yield from future))
+
+    assert all(isinstance(r, AiohttpResponse) for r in responses)
+    assert responses[0].request.url != responses[1].request.url
+
+    downloader.stop()
+    assert downloader.session is None
+    assert session.closed
+
+
+@asyncio_test
+def test_downloader_conditional_request(loop=None):
+    from aiohttp import web
+
+    bodies = ['<html>first</html>', '<html>first</html>', '<html>next</html>']
+    conditional = []
+
+    @asyncio.coroutine
+    def handler(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            conditional.append(request.path)
+            return web.Response(status=304)
+        if request.path == '/etag':
+            return web.Response(
+                body=b'<html></html>', headers={'ETag': '"v1"'},
+            )
+        return web.Response(body=bodies.pop(0).encode())
+
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/{name}', handler)
+    server = yield from loop.create_server(
+        app.make_handler(), '127.0.0.1', 0,
+    )
+    url = 'http://127.0.0.1:%s/' % server.sockets[0].getsockname()[1]
+
+    store = MemoryValidatorStore()
+    downloader = AiohttpDownloader(
+        host_window={'rate': 10 ** 6}, validator_store=store,
+    )
+    downloader.prepare()
+
+    @asyncio.coroutine
+    def fetch(path, conditional=True):
+        request = AiohttpRequest(url + path)
+        request.conditional = conditional
+        future = asyncio.Future()
+        yield from downloader._fetch(request, future)
+        return future.result()
+
+    # not modified by etag
+    assert not (yield from fetch('etag')).unchanged
+    assert (yield from store.get(url + 'etag'))['etag'] == '"v1"'
+    assert (yield from fetch('etag')).unchanged
+    assert conditional == ['/etag']
+
+    # not modified by body hash
+    assert not (yield from fetch('hash')).unchanged
+    assert (yield from fetch('hash')).unchanged
+    assert not (yield from fetch('hash')).unchanged
+
+    # validators are not used by not conditional requests
+    assert not (yield from fetch('etag', conditional=False)).unchanged
+    assert conditional == ['/etag']
+
+    downloader.stop()
+    server.close()
+
+
+@asyncio_test
+def test_downloader_read_until(loop=None):
+    import re
+    from aiohttp import web
+
+    page = '<html><p id="end">ü</p>' + 'x' * 10 ** 6 + '</html>'
+    short_page = '<html><p id="end">ü</p>' + 'x' * 10 ** 3 + '</html>'
+
+    def get_handler(body):
+        @asyncio.coroutine
+        def handler(request):
+            return web.Response(
+                body=body.encode(),
+                headers={'Content-Type': 'text/html; charset=utf-8'},
+            )
+        return handler
+
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/', get_handler(page))
+    app.router.add_route('GET', '/short', get_handler(short_page))
+    server = yield from loop.create_server(
+        app.make_handler(), '127.0.0.1', 0,
+    )
+    url = 'http://127.0.0.1:%s/' % server.sockets[0].getsockname()[1]
+
+    downloader = AiohttpDownloader(
+        host_window={'rate': 10 ** 6}, read_chunk_size=1024,
+    )
+    downloader.prepare()
+
+    def get_pooled():
+        return sum(
+            len(conns)
+            for conns in downloader.session.connector._conns.values()
+        )
+
+    # big rest of the page is not downloaded, connection is closed
+    request = AiohttpRequest(url)
+    request.read_until = re.compile(b'id="end".*?</p>')
+    future = asyncio.Future()
+    yield from downloader._fetch(request, future)
+    assert future.result().body == '<html><p id="end">ü</p>'
+    assert get_pooled() == 0
+
+    # short rest of the page is drained, connection is returned to the pool
+    request = AiohttpRequest(url + 'short')
+    request.read_until = re.compile(b'id="end".*?</p>')
+    future = asyncio.Future()
+    yield from downloader._fetch(request, future)
+    assert future.result().body == '<html><p id="end">ü</p>'
+    assert get_pooled() == 1
+
+    # the whole page without pattern match
+    request = AiohttpRequest(url)
+    request.read_until = re.compile(b'id="missed"')
+    future = asyncio.Future()
+    yield from downloader._fetch(request, future)
+    assert future.result().body == page
+
+    downloader.stop()
+    server.close()
+
+
+@asyncio_test
+def test_downloader_stalled_body(loop=None):
+    import time
+    from aiohttp import web
+    from pomp.core.base import BaseCrawlException
+
+    @asyncio.coroutine
+    def handler(request):
+        response = web.StreamResponse(headers={'Content-Length': '1000'})
+        yield from response.prepare(request)
+        response.write(b'<html>')
+        yield from response.drain()
+        # the rest of the body never comes in time
+        yield from asyncio.sleep(5)
+        return response
+
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/', handler)
+    server = yield from loop.create_server(
+        app.make_handler(), '127.0.0.1', 0,
+    )
+    url = 'http://127.0.0.1:%s/' % server.sockets[0].getsockname()[1]
+
+    downloader = AiohttpDownloader(
+        host_window={'rate': 10 ** 6}, request_timeout=0.2,
+    )
+    downloader.prepare()
+
+    # timed out response is closed, not released by reading the rest
+    start = time.monotonic()
+    future = asyncio.Future()
+    yield from downloader._fetch(AiohttpRequest(url), future)
+    assert time.monotonic() - start < 1
+    assert isinstance(future.result(), BaseCrawlException)
+    assert isinstance(future.result().exception, asyncio.TimeoutError)
+    assert not any(downloader.session.connector._conns.values())
+
+    downloader.stop()
+    server.close()
@@ -0,0 +1,116 @@
+import asyncio
+
+import aioredis
+from pomp.core.base import (
+    BasePipeline, BaseCrawler, BaseDownloader, BaseCrawlException,
+)
+
+from craigslist.item import CraigsListItem
+from craigslist.queue import RedisQueue
+from craigslist.crawler import ItemRequest
+from craigslist.engine import CraigsListPomp
+from craigslist.downloader import AiohttpDownloader
+from craigslist.utils import get_stage_key, get_redis_endpoint
+
+from utils import asyncio_test, mock_response
+
+
+class FilterPipeline(BasePipeline):
+
+    def process(self, crawler, item):
+        return None
+
+
+class CollectPipeline(BasePipeline):
+
+    def __init__(self):
+        self.items = []
+
+    def process(self, crawler, item):
+        self.items.append(item)
+        return item
+
+
+class FailingCrawler(BaseCrawler):
+
+    def extract_items(self, response):
+        if response.body == 'broken':
+            raise ValueError('unexpected markup')
+        return []
+
+
+@asyncio_test
+def test_engine_pipelines_timing(loop=None):
+    collect = CollectPipeline()
+    pomp = CraigsListPomp(
+        downloader=AiohttpDownloader(),
+        pipelines=(collect, FilterPipeline(), CollectPipeline()),
+    )
+    request = ItemRequest(
+        session_id='somesession',
+        url='http://test.com/',
+        city_code='sfbay',
+    )
+    item = CraigsListItem(url='http://test.com/', city_code='sfbay')
+
+    # requests are passed to the queue, items to the pipelines
+    assert list(pomp._process_items(None, [request, item, None])) == [
+        request,
+    ]
+    assert collect.items == [item]
+
+    histograms = pomp.statsd.histograms
+    assert histograms[get_stage_key(
+        'pipeline_collectpipeline', city_code='sfbay', request_type='item',
+    )].count == 1
+    assert histograms[get_stage_key(
+        'pipeline_filterpipeline', city_code='sfbay', request_type='item',
+    )].count == 1
+    pomp.statsd.close()
+
+
+@asyncio_test
+def test_engine_retry_failed_requests(loop=None):
+    redis = yield from aioredis.create_redis(get_redis_endpoint(), loop=loop)
+    yield from redis.flushall()
+
+    queue = RedisQueue(redis, max_retries=2)
+    pomp = CraigsListPomp(downloader=BaseDownloader(), queue=queue)
+    crawler = FailingCrawler()
+    pomp.prepare(crawler)
+    request = ItemRequest(
+        session_id='somesession',
+        url='http://test.com/',
+        city_code='sfbay',
+    )
+    yield from queue.put_requests(request)
+
+    @asyncio.coroutine
+    def process(response_for):
+        request = yield from queue.get_requests()
+        pomp.in_progress += 1
+        yield from pomp._process_response(crawler, response_for(request))
+
+    # download error, the request is returned to the queue
+    yield from process(lambda request: BaseCrawlException(
+        request=request, exception=asyncio.TimeoutError(),
+    ))
+    assert (yield from queue.qsize()) == 1
+    assert (yield from redis.llen(queue.processing_key)) == 0
+
+    # crawler error, the request is returned to the queue
+    def broken(request):
+        response = mock_response('data/item.html', request_instance=request)
+        response.body = 'broken'
+        return response
+    yield from process(broken)
+    assert (yield from queue.qsize()) == 1
+    assert not pomp.failed_requests
+
+    # after max retries the request is dropped
+    yield from process(broken)
+    assert (yield from queue.qsize()) == 0
+    assert (yield from redis.llen(queue.processing_key)) == 0
+    assert not (yield from redis.exists('queue:retries'))
+    assert pomp.in_progress == 0
+    pomp.statsd.close()
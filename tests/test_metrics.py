@@ -0,0 +1,170 @@
+import time
+import socket
+import asyncio
+
+from craigslist.metrics import StatsD, Histogram
+from craigslist.utils import get_statsd_client
+
+from utils import asyncio_test
+
+
+def get_server():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(1)
+    return server, 'udp://127.0.0.1:%s' % server.getsockname()[1]
+
+
+def receive(server):
+    lines = []
+    server.settimeout(0.1)
+    try:
+        while True:
+            lines.extend(server.recv(65536).decode().split('\n'))
+    except socket.timeout:
+        pass
+    return lines
+
+
+def test_statsd_aggregation():
+    server, addr = get_server()
+    statsd = StatsD(addr, interval=60)
+
+    for _ in range(1000):
+        statsd.incr('requests')
+    statsd.decr('requests', 10)
+    statsd.gauge('queue', 5)
+    statsd.gauge('queue', 7)
+    statsd.timing('fetch', 10)
+    statsd.timing('fetch', 20)
+
+    # nothing is sent before the interval
+    assert receive(server) == []
+
+    statsd.close()
+    assert sorted(receive(server)) == [
+        'fetch:10|ms', 'fetch:20|ms', 'queue:7|g', 'requests:990|c',
+    ]
+    server.close()
+
+
+def test_statsd_packets():
+    server, addr = get_server()
+    statsd = StatsD(addr, max_packet_size=100, max_samples=50)
+
+    for i in range(200):
+        statsd.timing('fetch', i)
+    lines = statsd.get_lines()
+    assert len(lines) == 50
+    assert all(line.endswith('|ms|@0.250000') for line in lines)
+
+    packets = statsd.get_packets(lines)
+    assert len(packets) > 1
+    assert all(len(packet) <= 100 for packet in packets)
+    assert b'\n'.join(packets).decode().split('\n') == lines
+
+    statsd.flush()
+    assert len(receive(server)) == 50
+    server.close()
+
+
+def test_statsd_sync_flush():
+    server, addr = get_server()
+    statsd = StatsD(addr, interval=0)
+
+    statsd.incr('imported', 10)
+    assert receive(server) == ['imported:10|c']
+
+    # idle command sends metrics by ticks
+    statsd.interval = 0.05
+    statsd.flush()
+    statsd.incr('imported', 5)
+    statsd.tick()
+    assert receive(server) == []
+    time.sleep(0.05)
+    statsd.tick()
+    assert receive(server) == ['imported:5|c']
+
+    # not configured endpoint does not break metrics
+    statsd = StatsD('udp://None:None', interval=0)
+    statsd.incr('imported')
+    statsd.close()
+    server.close()
+
+
+@asyncio_test
+def test_statsd_loop_flush(loop=None):
+    server, addr = get_server()
+    statsd = StatsD(addr, interval=0.05, loop=loop)
+
+    statsd.incr('requests')
+    statsd.incr('requests')
+    assert statsd.handle is not None
+    yield from asyncio.sleep(0.1)
+    assert statsd.handle is None
+    assert receive(server) == ['requests:2|c']
+
+    statsd.close()
+    server.close()
+
+
+@asyncio_test
+def test_statsd_shared_client(loop=None):
+    statsd = get_statsd_client()
+    assert statsd.loop is loop
+    assert get_statsd_client() is statsd
+
+    sync = get_statsd_client(sync=True)
+    assert sync.loop is None
+    assert sync is not statsd
+    assert get_statsd_client(sync=True) is sync
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in range(1, 1001):
+        histogram.record(value / 10.0)
+
+    assert histogram.count == 1000
+    for percent in (50, 95, 99):
+        # relative error is within 2 ** -6
+        assert abs(histogram.percentile(percent) - percent) <= percent / 64
+    assert histogram.percentile(100) == 100
+
+    assert Histogram().percentile(99) == 0
+
+
+def test_statsd_histogram():
+    statsd = StatsD('udp://None:None')
+    for value in range(100):
+        statsd.histogram('fetch', value)
+    # percentiles are upper bounds of histogram buckets
+    assert statsd.get_histogram_lines() == [
+        'fetch.p50:49.152|g', 'fetch.p95:94.208|g', 'fetch.p99:98.304|g',
+        'fetch.count:100|c',
+    ]
+    assert statsd.get_lines() == []
+
+
+def test_statsd_histogram_interval():
+    server, addr = get_server()
+    statsd = StatsD(addr, interval=0, histogram_interval=60)
+
+    # slow values of the first tick are not lost by the next ticks
+    for _ in range(10):
+        statsd.histogram('fetch', 1000)
+    statsd.incr('requests')
+    assert receive(server) == ['requests:1|c']
+    for _ in range(90):
+        statsd.histogram('fetch', 10)
+        statsd.tick()
+    assert receive(server) == []
+
+    statsd.last_histogram_flush -= 60
+    statsd.tick()
+    assert receive(server) == [
+        'fetch.p50:10.112|g', 'fetch.p95:1000.000|g',
+        'fetch.p99:1000.000|g', 'fetch.count:100|c',
+    ]
+    statsd.close()
+    server.close()
@@ -1,11 +1,33 @@
+import time
 import asyncio
+import datetime
 import uuid
 from io import StringIO
+from collections import namedtuple
 
-from craigslist.pipeline import KafkaPipeline, MetricsPipeline
+import msgpack
+import pytest
+from kafka import TopicPartition
+from kafka.errors import KafkaError
+
+from aiohttp import web
+
+from craigslist.pipeline import (
+    KafkaPipeline, AioKafkaPipeline, MetricsPipeline, iter_batches,
+    assign_partitions,
+)
 from craigslist.item import CraigsListItem
+from craigslist.downloader import AiohttpDownloader, AiohttpRequest
+from craigslist.utils import (
+    MsgPackSerializer, METRIC_ITEMS_SENT_KEY, METRIC_ITEMS_SEND_FAILED_KEY,
+)
+
+from utils import (
+    asyncio_test, FakeKafkaProducer, FakeAioKafkaProducer, FakeKafkaConsumer,
+)
 
-from utils import asyncio_test
+
+Record = namedtuple('Record', 'value serialized_value_size')
 
 
 def test_kafka_pipeline():
@@ -34,6 +56,231 @@ def test_kafka_pipeline():
     assert item.url in csv_file.getvalue()
 
 
+def test_item_serializer():
+    serializer = MsgPackSerializer()
+    item = CraigsListItem(
+        url='http://test.com/',
+        city_code='chicago',
+        title='kid bike',
+        price=1000,
+        photos=['http://test.com/1.jpg'],
+        ts_created=datetime.datetime(
+            2016, 2, 10, 20, 48, 1, 123456, tzinfo=datetime.timezone.utc,
+        ),
+    )
+    assert serializer.FIELDS == tuple(item.keys())
+
+    row = serializer.loads_row(serializer.dumps(item))
+    assert row == tuple(item.values())
+    assert serializer.loads(serializer.dumps(item)) == dict(item)
+
+    # items are created in UTC, naive datetimes are not packed
+    assert CraigsListItem().ts_created.tzinfo == datetime.timezone.utc
+    with pytest.raises(ValueError):
+        serializer.dumps(dict(item, ts_created=datetime.datetime.now()))
+
+    # item of the first version
+    data = msgpack.packb(dict(item, ts_created={
+        '__datetime__': True, 'as_str': '20160210T20:48:01.123456',
+    }), use_bin_type=False)
+    assert serializer.loads_row(data) == row
+
+
+def test_iter_batches():
+    consumer = FakeKafkaConsumer(
+        [Record(i, 10) for i in range(25)], per_poll=10,
+    )
+    batches = iter_batches(
+        consumer, max_records=20, max_wait_ms=500, clock=consumer.clock,
+    )
+
+    # full batch does not wait
+    assert [r.value for r in next(batches)] == list(range(20))
+    assert consumer.now < 0.1
+
+    # the rest is yielded after max wait, then empty batches
+    assert [r.value for r in next(batches)] == list(range(20, 25))
+    assert 0.5 <= consumer.now < 0.6
+    assert next(batches) == []
+    assert 1.0 <= consumer.now < 1.1
+
+    # batch is closed by size
+    consumer = FakeKafkaConsumer(
+        [Record(i, 100) for i in range(10)], per_poll=2,
+    )
+    batches = iter_batches(consumer, max_bytes=250, clock=consumer.clock)
+    assert [r.value for r in next(batches)] == [0, 1, 2, 3]
+
+
+def test_assign_partitions():
+    consumer = FakeKafkaConsumer(partitions=range(3))
+
+    # partitions are shared by workers by id modulo number of workers
+    assert assign_partitions(consumer, 'test', (0, 2), {2: 7}) == [0, 2]
+    assert consumer.positions == {
+        TopicPartition('test', 0): 0, TopicPartition('test', 2): 7,
+    }
+    assert assign_partitions(
+        FakeKafkaConsumer(partitions=range(3)), 'test', (1, 2),
+    ) == [1]
+
+    # nothing changed
+    assert assign_partitions(consumer, 'test', (0, 2)) == []
+
+    # added partitions are assigned, positions of others are kept
+    consumer.positions[TopicPartition('test', 0)] = 100
+    consumer.partitions.update((3, 4))
+    assert assign_partitions(consumer, 'test', (0, 2)) == [4]
+    assert consumer.positions == {
+        TopicPartition('test', 0): 100,
+        TopicPartition('test', 2): 7,
+        TopicPartition('test', 4): 0,
+    }
+
+
+@asyncio_test
+def test_kafka_pipeline_delivery_callbacks(loop=None):
+    pipeline = KafkaPipeline(
+        producer_class=lambda **kwargs: FakeKafkaProducer(
+            fail_every=2, **kwargs
+        ),
+        compression_type='gzip',
+    )
+    pipeline.start(None)
+
+    sent = []
+    pipeline.statsd.incr = lambda key, *args, **kwargs: sent.append(key)
+
+    # items are buffered until the producer is connected
+    for i in range(4):
+        pipeline.process(None, CraigsListItem(url='http://test.com/%s' % i))
+    yield from pipeline.flush()
+    assert pipeline.producer.config['compression_type'] == 'gzip'
+    assert len(pipeline.producer.messages) == 4
+    pipeline.stop(None)
+
+    # delivery results are reported to metrics from the event loop
+    yield from asyncio.sleep(0)
+    assert sent.count(METRIC_ITEMS_SENT_KEY) == 2
+    assert sent.count(METRIC_ITEMS_SEND_FAILED_KEY) == 2
+
+
+@asyncio_test
+def test_kafka_pipeline_probe_brokers(loop=None):
+    attempts = []
+
+    def producer_class(**kwargs):
+        attempts.append(time.time())
+        if len(attempts) < 3:
+            raise KafkaError('brokers are not ready')
+        return FakeKafkaProducer(**kwargs)
+
+    pipeline = KafkaPipeline(producer_class=producer_class)
+    ticks = []
+
+    @asyncio.coroutine
+    def tick():
+        while True:
+            ticks.append(time.time())
+            yield from asyncio.sleep(0.01)
+
+    task = asyncio.Task(tick())
+    pipeline.start(None)
+    # start does not wait for brokers
+    assert pipeline.producer is None
+    yield from pipeline.flush()
+    task.cancel()
+
+    assert len(attempts) == 3
+    assert attempts[2] - attempts[0] >= 0.3
+    # the loop is not blocked while brokers are probed
+    assert len(ticks) > 10
+    pipeline.stop(None)
+
+
+@asyncio_test
+def test_aio_kafka_pipeline_backpressure(loop=None):
+
+    @asyncio.coroutine
+    def handler(request):
+        return web.Response(body=b'<html></html>')
+
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/', handler)
+    server = yield from loop.create_server(
+        app.make_handler(), '127.0.0.1', 0,
+    )
+    url = 'http://127.0.0.1:%s/' % server.sockets[0].getsockname()[1]
+
+    downloader = AiohttpDownloader(host_window={'rate': 10 ** 6})
+    downloader.prepare()
+
+    @asyncio.coroutine
+    def download_latency():
+        start = time.time()
+        future = asyncio.Future()
+        yield from downloader._fetch(AiohttpRequest(url), future)
+        assert future.result().body
+        return time.time() - start
+
+    pipeline = AioKafkaPipeline(
+        max_buffer_size=100,
+        producer_class=lambda **kwargs: FakeAioKafkaProducer(**kwargs),
+    )
+    pipeline.start(None)
+    yield from asyncio.sleep(0)
+    producer = pipeline.producer
+
+    # kafka stalls while crawler produces more items than buffer holds
+    producer.stall()
+    for i in range(150):
+        pipeline.process(None, CraigsListItem(url='http://test.com/%s' % i))
+    drain = asyncio.ensure_future(pipeline.drain())
+
+    # crawling is paused by backpressure but event loop is not blocked
+    for _ in range(5):
+        assert (yield from download_latency()) < 0.5
+    assert not drain.done()
+    assert not producer.messages
+
+    # kafka is back, buffer is sent
+    producer.resume()
+    yield from asyncio.wait_for(drain, 1)
+    yield from asyncio.wait_for(pipeline.flush(), 1)
+    assert len(producer.messages) == 150
+
+    pipeline.stop(None)
+    downloader.stop()
+    server.close()
+
+
+@asyncio_test
+def test_aio_kafka_pipeline_flush(loop=None):
+    pipeline = AioKafkaPipeline(
+        producer_class=lambda **kwargs: FakeAioKafkaProducer(**kwargs),
+    )
+    pipeline.start(None)
+    yield from asyncio.sleep(0)
+    producer = pipeline.producer
+
+    # items of the stalled producer are delivered by flush
+    producer.stall()
+    for i in range(10):
+        pipeline.process(None, CraigsListItem(url='http://test.com/%s' % i))
+    flush = asyncio.ensure_future(pipeline.flush())
+    yield from asyncio.sleep(0.05)
+    assert not flush.done()
+    producer.resume()
+    yield from asyncio.wait_for(flush, 1)
+    assert len(producer.messages) == 10
+
+    # producer is stopped before the engine stops pipelines and the loop
+    assert producer.stopped
+    assert pipeline.producer is None
+    pipeline.stop(None)
+    assert pipeline.sender.done()
+
+
 @asyncio_test
 def test_metrics_pipeine(loop=None):
     item = CraigsListItem(
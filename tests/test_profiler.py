@@ -0,0 +1,84 @@
+import os
+import time
+import asyncio
+import tempfile
+import threading
+
+from craigslist.profiler import SamplingProfiler, profile
+
+from utils import asyncio_test
+
+
+def busy_loop(stopped):
+    while not stopped.is_set():
+        sum(range(1000))
+
+
+def test_sampling_profiler():
+    stopped = threading.Event()
+    thread = threading.Thread(target=busy_loop, args=(stopped, ), name='busy')
+    thread.start()
+
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    time.sleep(0.2)
+    profiler.stop()
+    stopped.set()
+    thread.join()
+
+    assert profiler.samples > 0
+    busy = [
+        stack for stack in profiler.stacks
+        if stack.startswith('busy;')
+    ]
+    assert busy
+    assert all('busy_loop (test_profiler.py' in stack for stack in busy)
+    # profiler does not sample itself
+    assert not any(
+        stack.startswith('profiler;') for stack in profiler.stacks
+    )
+
+
+@asyncio_test
+def test_profile(loop=None):
+
+    @asyncio.coroutine
+    def sleeper():
+        yield from asyncio.sleep(1)
+
+    def blocking():
+        time.sleep(0.2)
+
+    tasks = [asyncio.Task(sleeper()) for _ in range(3)]
+    loop.call_later(0.15, blocking)
+
+    prefix = os.path.join(tempfile.mkdtemp(), 'profile')
+    collapsed, summary = yield from profile(loop, 0.5, prefix=prefix)
+
+    with open(collapsed) as f:
+        lines = f.read().splitlines()
+    assert lines
+    # collapsed stacks of the loop thread end with the blocking call
+    assert any(
+        line.startswith('MainThread;') and
+        'blocking (test_profiler.py' in line
+        for line in lines
+    )
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+
+    with open(summary) as f:
+        text = f.read()
+    lag_line = [
+        line for line in text.splitlines()
+        if line.startswith('event loop lag')
+    ][0]
+    lag_max = float(lag_line.split('max ')[1].split('ms')[0])
+    assert lag_max >= 100
+
+    callbacks = text.split('longest callbacks:\n')[1].splitlines()
+    # header and the longest callback
+    assert 'test_profile.<locals>.blocking' in callbacks[1]
+    assert '3  test_profile.<locals>.sleeper' in text
+
+    for task in tasks:
+        task.cancel()
@@ -1,8 +1,11 @@
+import asyncio
+
 import aioredis
 
 from craigslist.utils import get_redis_endpoint
 from craigslist.queue import RedisQueue
-from craigslist.crawler import ListRequest
+from craigslist.dedup import SetDedup, SessionSetDedup, BloomDedup
+from craigslist.crawler import ListRequest, ItemRequest
 
 from utils import asyncio_test
 
@@ -34,3 +37,271 @@ def test_queue(loop=None):
     # put same request to queue again
     yield from queue.put_requests(request)
     assert (yield from queue.qsize()) == 0
+
+
+@asyncio_test
+def test_queue_put_batch(loop=None):
+
+    endpoint = get_redis_endpoint()
+    redis = yield from aioredis.create_redis(endpoint, loop=loop)
+
+    yield from redis.flushall()
+
+    queue = RedisQueue(redis)
+    queue.put_batch_size = 3
+
+    requests = [
+        ListRequest(
+            city_code='some_city',
+            session_id='some_session',
+            url='http://some.url/%s' % i,
+        ) for i in range(10)
+    ]
+
+    # duplicates in one batch are filtered too
+    yield from queue.put_requests(requests + requests[:2])
+    assert (yield from queue.qsize()) == 10
+
+    for request in requests:
+        result = yield from queue.get_requests()
+        assert request.get_identity() == result.get_identity()
+
+
+@asyncio_test
+def test_queue_prefetch(loop=None):
+
+    endpoint = get_redis_endpoint()
+    redis = yield from aioredis.create_redis(endpoint, loop=loop)
+
+    yield from redis.flushall()
+
+    queue = RedisQueue(redis, prefetch_count=5)
+
+    requests = [
+        ListRequest(
+            city_code='some_city',
+            session_id='some_session',
+            url='http://some.url/%s' % i,
+        ) for i in range(8)
+    ]
+    yield from queue.put_requests(requests)
+
+    # first call takes 5 requests to the local buffer in FIFO order
+    result = yield from queue.get_requests()
+    assert result.get_identity() == requests[0].get_identity()
+    assert len(queue.buffer) == 4
+    assert (yield from queue.qsize()) == 3
+    assert (yield from redis.llen(queue.processing_key)) == 5
+
+    # acknowledged request leaves processing list
+    yield from queue.ack_requests(result)
+    assert (yield from redis.llen(queue.processing_key)) == 4
+
+    # not acknowledged requests are recoverable
+    assert (yield from queue.requeue()) == 4
+    assert (yield from queue.qsize()) == 7
+    assert (yield from redis.llen(queue.processing_key)) == 0
+
+    result = yield from queue.get_requests()
+    assert result.get_identity() in set(
+        r.get_identity() for r in requests[1:5]
+    )
+
+
+@asyncio_test
+def test_queue_retry(loop=None):
+
+    endpoint = get_redis_endpoint()
+    redis = yield from aioredis.create_redis(endpoint, loop=loop)
+
+    yield from redis.flushall()
+
+    queue = RedisQueue(redis, max_retries=1)
+
+    requests = [
+        ListRequest(
+            city_code='some_city',
+            session_id='some_session',
+            url='http://some.url/%s' % i,
+        ) for i in range(2)
+    ]
+    yield from queue.put_requests(requests)
+
+    # failed request goes to the tail of the queue
+    result = yield from queue.get_requests()
+    assert result.get_identity() == requests[0].get_identity()
+    yield from queue.retry_requests(result)
+    assert (yield from redis.llen(queue.processing_key)) == 0
+    assert (yield from queue.qsize()) == 2
+    assert (yield from redis.hget('queue:retries', result.get_identity())) \
+        == b'1'
+
+    result = yield from queue.get_requests()
+    assert result.get_identity() == requests[1].get_identity()
+    yield from queue.ack_requests(result)
+
+    # request failed more than max retries is dropped
+    result = yield from queue.get_requests()
+    assert result.get_identity() == requests[0].get_identity()
+    yield from queue.retry_requests(result)
+    assert (yield from queue.qsize()) == 0
+    assert (yield from redis.llen(queue.processing_key)) == 0
+    assert not (yield from redis.exists('queue:retries'))
+
+    # retry counter is removed by ack
+    yield from queue.put_requests(ListRequest(
+        city_code='some_city',
+        session_id='some_session',
+        url='http://some.url/2',
+    ))
+    result = yield from queue.get_requests()
+    yield from queue.retry_requests(result)
+    result = yield from queue.get_requests()
+    yield from queue.ack_requests(result)
+    assert not (yield from redis.exists('queue:retries'))
+
+
+@asyncio_test
+def test_queue_reclaim_expired(loop=None):
+
+    endpoint = get_redis_endpoint()
+    redis = yield from aioredis.create_redis(endpoint, loop=loop)
+
+    yield from redis.flushall()
+
+    crashed = RedisQueue(redis, prefetch_count=2, lease_timeout=0.1)
+    alive = RedisQueue(redis, prefetch_count=2)
+
+    yield from crashed.put_requests([
+        ListRequest(
+            city_code='some_city',
+            session_id='some_session',
+            url='http://some.url/%s' % i,
+        ) for i in range(3)
+    ])
+
+    # crashed worker takes requests and does not renew the lease
+    yield from crashed.get_requests()
+    assert (yield from alive.qsize()) == 1
+    assert (yield from alive.reclaim_expired()) == 0
+
+    yield from asyncio.sleep(0.2)
+    assert (yield from alive.reclaim_expired()) == 2
+    assert (yield from alive.qsize()) == 3
+    assert (yield from redis.llen(crashed.processing_key)) == 0
+
+
+@asyncio_test
+def test_queue_dedup_backends(loop=None):
+
+    endpoint = get_redis_endpoint()
+    redis = yield from aioredis.create_redis(endpoint, loop=loop)
+
+    for dedup in (
+            SetDedup(),
+            SessionSetDedup(ttl=60),
+            # small layers to check layers growth
+            BloomDedup(capacity=5, error_rate=0.01)):
+
+        yield from redis.flushall()
+        queue = RedisQueue(redis, dedup=dedup)
+
+        requests = [
+            ListRequest(
+                city_code='some_city',
+                session_id='session_%s' % (i % 2),
+                url='http://some.url/%s' % i,
+            ) for i in range(20)
+        ]
+        yield from queue.put_requests(requests)
+        yield from queue.put_requests(requests)
+
+        assert (yield from queue.qsize()) == 20, dedup
+        assert (yield from dedup.size(redis)) == 20, dedup
+        assert (yield from dedup.get_keys(redis)), dedup
+
+
+@asyncio_test
+def test_session_dedup_size(loop=None):
+
+    endpoint = get_redis_endpoint()
+    redis = yield from aioredis.create_redis(endpoint, loop=loop)
+    yield from redis.flushall()
+
+    dedup = SessionSetDedup(ttl=60)
+    queue = RedisQueue(redis, dedup=dedup)
+
+    def put(session_id, count):
+        return queue.put_requests([
+            ListRequest(
+                city_code='some_city',
+                session_id=session_id,
+                url='http://some.url/%s' % i,
+            ) for i in range(count)
+        ])
+
+    yield from put('first', 3)
+    yield from put('second', 5)
+    assert (yield from dedup.size(redis)) == 8
+
+    # expired session is not counted, the next one is counted from zero
+    yield from redis.delete(dedup.key_prefix + 'first')
+    assert (yield from dedup.size(redis)) == 5
+    yield from redis.delete(dedup.key_prefix + 'second')
+    yield from put('second', 2)
+    assert (yield from dedup.size(redis)) == 2
+
+
+@asyncio_test
+def test_queue_fair_scheduling(loop=None):
+
+    endpoint = get_redis_endpoint()
+    redis = yield from aioredis.create_redis(endpoint, loop=loop)
+
+    yield from redis.flushall()
+
+    queue = RedisQueue(redis, prefetch_count=3)
+    yield from queue.set_weight('big', 2)
+
+    # big session is started first
+    yield from queue.put_requests([
+        ItemRequest(
+            city_code='sfbay',
+            session_id='big',
+            url='http://some.url/big/%s' % i,
+        ) for i in range(10)
+    ])
+    yield from queue.put_requests([
+        ItemRequest(
+            city_code='sfbay',
+            session_id='small',
+            url='http://some.url/small/%s' % i,
+        ) for i in range(3)
+    ] + [
+        ListRequest(
+            city_code='sfbay',
+            session_id='small',
+            url='http://some.url/small/list',
+        ),
+    ])
+    assert (yield from queue.flow_sizes()) == {
+        'big:sfbay': 10, 'small:sfbay': 4,
+    }
+
+    result = []
+    for _ in range(8):
+        request = yield from queue.get_requests()
+        result.append((request.session_id, type(request)))
+
+    # weighted round-robin between sessions,
+    # list requests go before item requests of the session
+    assert result == [
+        ('big', ItemRequest), ('big', ItemRequest),
+        ('small', ListRequest),
+        ('big', ItemRequest), ('big', ItemRequest),
+        ('small', ItemRequest),
+        ('big', ItemRequest), ('big', ItemRequest),
+    ]
+    # and one more request is prefetched
+    assert len(queue.buffer) == 1
+    assert (yield from queue.qsize()) == 5
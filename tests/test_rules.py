@@ -0,0 +1,48 @@
+from lxml import html
+
+from craigslist.rules import Rule, RowRule, RuleSet
+
+
+PAGE = html.fromstring('''
+<html><body>
+<ul>
+  <li data-pid="1"><a href="/1.html">one</a></li>
+  <li data-pid="2"><a href="/2.html">two</a><a href="#x">more</a></li>
+  <li><a href="/ad.html">ad</a></li>
+</ul>
+<a title="next page" href="/next">next</a>
+</body></html>
+''')
+
+
+def test_rule():
+    assert Rule('//li/a/text()')(PAGE) == ['one', 'two', 'more', 'ad']
+    assert Rule('//li/a/text()', first=True)(PAGE) == 'one'
+    assert Rule('//table/text()', first=True)(PAGE) is None
+    assert Rule('//li[@data-pid]/@data-pid', join=True)(PAGE) == '12'
+
+    # plain strings are returned
+    assert type(Rule('//li/a/text()', first=True)(PAGE)) is str
+
+
+def test_row_rule():
+    rule = RowRule('//li[@data-pid]', (
+        ('pid', Rule('@data-pid', first=True)),
+        ('link', Rule('a/@href', join=True)),
+    ))
+    assert rule(PAGE) == [
+        {'pid': '1', 'link': '/1.html'},
+        {'pid': '2', 'link': '/2.html#x'},
+    ]
+
+
+def test_rule_set():
+    rules = RuleSet((
+        ('links', Rule('//li/a/@href')),
+        ('next_page', Rule("//a[@title='next page']/@href", first=True)),
+    ))
+    assert rules.extract(PAGE) == {
+        'links': ['/1.html', '/2.html', '#x', '/ad.html'],
+        'next_page': '/next',
+    }
+    assert rules.extract(PAGE, ['next_page']) == {'next_page': '/next'}
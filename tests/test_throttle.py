@@ -0,0 +1,59 @@
+import time
+import asyncio
+
+from craigslist.throttle import HostScheduler, HostWindow, TokenBucket
+
+from utils import asyncio_test
+
+
+def test_host_window_aimd():
+    window = HostWindow('sfbay.craigslist.org', initial=4, maximum=8)
+
+    # grows while latency is flat
+    for _ in range(20):
+        window.in_flight += 1
+        window.release(latency=0.1)
+    assert window.limit > 4
+
+    # shrinks on errors
+    limit = window.limit
+    window.in_flight += 1
+    window.release(failed=True)
+    assert window.limit == limit // 2
+
+    # does not grow when latency goes up
+    window.in_flight += 1
+    window.release(latency=1.0)
+    assert window.limit == limit // 2
+
+
+@asyncio_test
+def test_host_window_limit(loop=None):
+    window = HostWindow('sfbay.craigslist.org', initial=1, rate=1000)
+
+    yield from window.acquire()
+    waiter = asyncio.ensure_future(window.acquire())
+    yield from asyncio.sleep(0.01)
+    assert not waiter.done()
+
+    window.release(latency=0.1)
+    yield from waiter
+    assert window.in_flight == 1
+
+
+@asyncio_test
+def test_token_bucket(loop=None):
+    bucket = TokenBucket(rate=20, capacity=1)
+    start = time.monotonic()
+    for _ in range(5):
+        yield from bucket.consume()
+    assert time.monotonic() - start >= 0.15
+
+
+def test_host_scheduler():
+    scheduler = HostScheduler(maximum=4)
+    window = scheduler.get_window('https://sfbay.craigslist.org/search/bia')
+    assert window is scheduler.get_window('https://sfbay.craigslist.org/')
+    other = scheduler.get_window('https://chicago.craigslist.org/')
+    assert window is not other
+    assert window.maximum == 4
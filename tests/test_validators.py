@@ -0,0 +1,61 @@
+import asyncio
+
+import aioredis
+
+from craigslist.utils import get_redis_endpoint
+from craigslist.validators import (
+    MemoryValidatorStore, RedisValidatorStore, get_body_hash,
+)
+
+from utils import asyncio_test
+
+
+@asyncio_test
+def test_memory_validator_store(loop=None):
+    store = MemoryValidatorStore(max_size=2)
+
+    assert (yield from store.get('http://a')) == {}
+
+    yield from store.set('http://a', etag='"a"', last_modified=None, hash='1')
+    assert (yield from store.get('http://a')) == {'etag': '"a"', 'hash': '1'}
+
+    # least recently used url is evicted
+    yield from store.set('http://b', hash='2')
+    yield from store.get('http://a')
+    yield from store.set('http://c', hash='3')
+    assert (yield from store.get('http://b')) == {}
+    assert (yield from store.get('http://a'))['hash'] == '1'
+
+
+@asyncio_test
+def test_redis_validator_store(loop=None):
+    endpoint = get_redis_endpoint()
+    redis = yield from aioredis.create_redis(endpoint, loop=loop)
+    yield from redis.flushall()
+
+    store = RedisValidatorStore(redis, ttl=60)
+    assert (yield from store.get('http://a')) == {}
+
+    yield from store.set(
+        'http://a', etag='"a"', last_modified='Wed, 21 Oct 2015 07:28:00 GMT',
+        hash=get_body_hash('<html></html>'),
+    )
+    assert (yield from store.get('http://a')) == {
+        'etag': '"a"',
+        'last_modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        'hash': get_body_hash(b'<html></html>'),
+    }
+    assert 0 < (yield from redis.ttl(store.get_key('http://a'))) <= 60
+
+    # old validators are replaced, the script is loaded once
+    sha = store.set_sha
+    yield from store.set('http://a', hash='1')
+    assert store.set_sha == sha
+    assert (yield from store.get('http://a')) == {'hash': '1'}
+    assert 0 < (yield from redis.ttl(store.get_key('http://a'))) <= 60
+
+    # no validators - nothing is stored
+    yield from store.set('http://a', etag=None)
+    assert not (yield from redis.exists(store.get_key('http://a')))
+
+    redis.close()
@@ -0,0 +1,114 @@
+import time
+import logging
+import asyncio
+
+from craigslist.utils import METRIC_LOOP_BLOCKED_KEY
+from craigslist.engine import CraigsListPomp
+from craigslist.watchdog import LoopWatchdog
+from craigslist.downloader import AiohttpDownloader
+
+from utils import asyncio_test
+
+
+class CollectHandler(logging.Handler):
+
+    def __init__(self):
+        super(CollectHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class RecordingWatchdog(LoopWatchdog):
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingWatchdog, self).__init__(*args, **kwargs)
+        self.lags = []
+
+    def check(self, lag):
+        self.lags.append(lag)
+        super(RecordingWatchdog, self).check(lag)
+
+
+@asyncio_test
+def test_watchdog_blocked_loop(loop=None):
+    handler = CollectHandler()
+    logger = logging.getLogger('craigslist.watchdog')
+    logger.addHandler(handler)
+
+    def blocking():
+        time.sleep(0.4)
+
+    watchdog = RecordingWatchdog(loop, interval=0.05, threshold=0.1)
+    task = asyncio.Task(watchdog.run())
+    loop.call_later(0.1, blocking)
+    yield from asyncio.sleep(0.7)
+    task.cancel()
+    yield from asyncio.sleep(0)
+    logger.removeHandler(handler)
+
+    assert watchdog.thread is None
+    assert max(watchdog.lags) >= 0.3
+    # stack of the blocking callback is logged once per stall
+    assert len(handler.messages) == 1
+    assert 'Event loop is blocked' in handler.messages[0]
+    assert 'in blocking' in handler.messages[0]
+    assert 'time.sleep(0.4)' in handler.messages[0]
+    # stall is counted by the loop thread
+    assert watchdog.statsd.counters[METRIC_LOOP_BLOCKED_KEY] == 1
+    watchdog.statsd.close()
+
+
+@asyncio_test
+def test_watchdog_throttle_engine(loop=None):
+    pomp = CraigsListPomp(
+        downloader=AiohttpDownloader(max_concurent_request_count=8),
+    )
+    pomp.queue_semaphore = pomp.get_queue_semaphore()
+    watchdog = LoopWatchdog(
+        loop, engine=pomp, threshold=0.1, slow_checks=2, recover_checks=3,
+    )
+    watchdog.mark = (0, time.monotonic() - 10)
+    pomp.dequeued = 100
+
+    # single slow check does not throttle
+    watchdog.check(0.5)
+    watchdog.check(0.01)
+    watchdog.check(0.5)
+    assert pomp.get_concurrency() == 8
+    assert pomp.dequeue_bucket is None
+
+    watchdog.check(0.5)
+    assert pomp.get_concurrency() == 4
+    assert round(pomp.dequeue_bucket.rate, 1) == 5.0
+    yield from asyncio.sleep(0)
+    for _ in range(4):
+        yield from pomp.queue_semaphore.acquire()
+    assert pomp.queue_semaphore.locked()
+
+    watchdog.check(0.5)
+    watchdog.check(0.5)
+    assert pomp.get_concurrency() == 2
+    assert round(pomp.dequeue_bucket.rate, 1) == 2.5
+
+    # recover step by step
+    for _ in range(3):
+        watchdog.check(0.01)
+    assert pomp.get_concurrency() == 4
+    assert round(pomp.dequeue_bucket.rate, 1) == 5.0
+    for _ in range(3):
+        watchdog.check(0.01)
+    assert pomp.get_concurrency() == 8
+    assert pomp.dequeue_bucket is None
+    assert watchdog.concurrency is None
+
+    # all permits are back
+    for _ in range(4):
+        pomp.queue_semaphore.release()
+    for _ in range(8):
+        yield from pomp.queue_semaphore.acquire()
+    assert pomp.queue_semaphore.locked()
+
+    watchdog.statsd.close()
+    pomp.statsd.close()
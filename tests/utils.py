@@ -2,6 +2,9 @@ import os
 import logging
 import asyncio
 
+from kafka import TopicPartition
+from kafka.future import Future
+
 from craigslist.downloader import AiohttpRequest, AiohttpResponse
 
 here = os.path.dirname(__file__)
@@ -28,3 +31,114 @@ def mock_response(filepath, request_instance=None, response_class=None):
             body=f.read()
         )
     return response
+
+
+class FakeKafkaProducer(object):
+    """In-process stand-in of kafka producer, fails every `fail_every`
+    message"""
+
+    def __init__(self, fail_every=None, **kwargs):
+        self.config = kwargs
+        self.fail_every = fail_every
+        self.messages = []
+        self.futures = []
+
+    def send(self, topic, value):
+        self.messages.append((topic, value))
+        future = Future()
+        self.futures.append(future)
+        return future
+
+    def flush(self):
+        for i, future in enumerate(self.futures, 1):
+            if self.fail_every and i % self.fail_every == 0:
+                future.failure(Exception('send failed'))
+            else:
+                future.success(None)
+        self.futures = []
+
+    def close(self):
+        pass
+
+
+class FakeAioKafkaProducer(object):
+    """In-process stand-in of asyncio kafka producer, `send` waits while
+    the producer is stalled as the real one waits for free space in full
+    batches"""
+
+    def __init__(self, loop, **kwargs):
+        self.loop = loop
+        self.config = kwargs
+        self.messages = []
+        self.stopped = False
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+
+    def stall(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    @asyncio.coroutine
+    def start(self):
+        pass
+
+    @asyncio.coroutine
+    def stop(self):
+        # delivery of the last batches
+        yield from asyncio.sleep(0.01)
+        self.stopped = True
+
+    @asyncio.coroutine
+    def send(self, topic, value):
+        yield from self.resumed.wait()
+        self.messages.append((topic, value))
+        future = asyncio.Future()
+        future.set_result(None)
+        return future
+
+
+class FakeKafkaConsumer(object):
+    """In-process stand-in of kafka consumer with fake clock, `poll` returns
+    up to `per_poll` records and waits full timeout when no records left,
+    topic `test` has `partitions`"""
+
+    def __init__(self, records=(), per_poll=10, partitions=(0, )):
+        self.records = list(records)
+        self.per_poll = per_poll
+        self.now = 0.0
+        self.partitions = set(partitions)
+        self.positions = {}
+
+    def topics(self):
+        return set(['test'])
+
+    def partitions_for_topic(self, topic):
+        return set(self.partitions) if topic == 'test' else None
+
+    def assignment(self):
+        return set(self.positions)
+
+    def assign(self, partitions):
+        # kafka-python may reset positions of reassigned partitions
+        self.positions = dict((tp, 0) for tp in partitions)
+
+    def position(self, partition):
+        return self.positions[partition]
+
+    def seek(self, partition, offset):
+        assert partition in self.positions
+        self.positions[partition] = offset
+
+    def clock(self):
+        return self.now
+
+    def poll(self, timeout_ms=0, max_records=None):
+        count = min(self.per_poll, max_records or self.per_poll)
+        polled, self.records = self.records[:count], self.records[count:]
+        if not polled:
+            self.now += timeout_ms / 1000.0
+            return {}
+        self.now += 0.001
+        return {TopicPartition('test', 0): polled}